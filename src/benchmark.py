@@ -0,0 +1,557 @@
+"""Offline pipeline benchmark using synthetic inputs.
+
+Generates synthetic rasters, GTFS and OSM inputs at a given scale (see
+`synthetic.SCALES`), times each `run.py` stage and the `utils.plot` output
+step against them, and compares the timings with a stored baseline. It can
+also check the streaming metrics against the `transport_performance` ones,
+and the metrics of the sharded OD matrix against those of `AnalyseNetwork`.
+
+Usage (from the repo root, or within the docker image)::
+
+    python src/benchmark.py --scale small --save-baseline
+    python src/benchmark.py --scale small
+    python src/benchmark.py --scale small --check-metrics
+    python src/benchmark.py --scale small --check-od
+
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import toml
+
+from pop_grid import PopGrid
+from run import run_area, CONFIG_PREFIX, LOGGER_NAME
+from streaming_metrics import streaming_transport_performance, CENTROID_CRS
+from synthetic import SCALES, generate_inputs
+from utils import plot, setup_logger
+
+BENCHMARK_DIR = "data/benchmark/"
+DEFAULT_CONFIG = "data/inputs/config/default_config.toml"
+
+# timings are compared when both the relative and absolute slowdown exceed
+# these thresholds, so sub-second noise does not fail the benchmark
+TOLERANCE = 0.2
+MIN_SECONDS = 1.0
+# relative difference allowed between the streaming and library metrics
+METRICS_RTOL = 1e-6
+# origins per OD shard of the `--check-od` runs, so several shards are used
+CHECK_OD_SHARD_SIZE = 100
+
+
+def time_plot(dirs: dict) -> float:
+    """Time `utils.plot()` of the transport performance output of a run."""
+    tp_path = glob.glob(
+        os.path.join(
+            dirs["metrics_outputs_dir"], "transport_performance_*.parquet"
+        )
+    )[0]
+    tp_gdf = gpd.read_parquet(tp_path)
+    start = time.perf_counter()
+    plot(
+        tp_gdf,
+        column="transport_performance",
+        column_control_name="Transport Performance",
+        cmap="viridis",
+        save=os.path.join(dirs["metrics_outputs_dir"], "benchmark_plot.html"),
+    )
+    return time.perf_counter() - start
+
+
+def check_metrics(dirs: dict, config_file: str, logger=None) -> dict:
+    """Compare the streaming metrics with the `transport_performance` ones.
+
+    Both metrics are compared on the run's OD matrix (the library metrics
+    being those written by the run) and on an `AnalyseNetwork` OD matrix of
+    the run's inputs (see `analyse_network_od()`), which has no distance
+    column. The run must have used the `transport_performance` metrics (i.e.
+    `STREAMING_METRICS=0` and a single threshold), and a single scenario.
+
+    Parameters
+    ----------
+    dirs : dict
+        Analysis directories of the run.
+    config_file : str
+        File name of the run's config toml, within `CONFIG_PREFIX`.
+    logger : logging.Logger, optional
+        Logger instance, by default None.
+
+    Returns
+    -------
+    dict
+        Largest relative difference of each transport performance column
+        and statistic (see `metric_differences()`), keyed by "run <name>"
+        and "analyse_network <name>".
+
+    """
+    od_dir = analyse_network_od(dirs, config_file, logger)
+    differences = {}
+    for label, od_path, expected in [
+        ("run", dirs["an_outputs_dir"], _run_metrics(dirs)),
+        (
+            "analyse_network",
+            od_dir,
+            _library_metrics(od_dir, dirs, config_file),
+        ),
+    ]:
+        actual = _streaming_metrics(od_path, dirs, config_file)
+        for name, value in metric_differences(*expected, *actual).items():
+            differences[f"{label} {name}"] = value
+    return differences
+
+
+def check_od(dirs: dict, config_file: str, logger=None) -> dict:
+    """Compare the metrics of a run with those of an `AnalyseNetwork` OD.
+
+    The `transport_performance` metrics of an `AnalyseNetwork` OD matrix of
+    the run's inputs (see `analyse_network_od()`) are compared with those
+    written by the run. The run must have used the `transport_performance`
+    metrics (i.e. `STREAMING_METRICS=0` and a single threshold), and a
+    single scenario.
+
+    Parameters
+    ----------
+    dirs : dict
+        Analysis directories of the run.
+    config_file : str
+        File name of the run's config toml, within `CONFIG_PREFIX`.
+    logger : logging.Logger, optional
+        Logger instance, by default None.
+
+    Returns
+    -------
+    dict
+        Largest relative difference of each transport performance column
+        and statistic (see `metric_differences()`).
+
+    """
+    od_dir = analyse_network_od(dirs, config_file, logger)
+    return metric_differences(
+        *_library_metrics(od_dir, dirs, config_file), *_run_metrics(dirs)
+    )
+
+
+def analyse_network_od(dirs: dict, config_file: str, logger=None) -> str:
+    """Calculate the OD matrix of a run's inputs with `AnalyseNetwork`.
+
+    The OD matrix is calculated (once per run) by
+    `transport_performance.analyse_network.AnalyseNetwork`, for the run's
+    largest thresholds and first scenario, in
+    `<files_dir>/benchmark_analyse_network/`.
+
+    Parameters
+    ----------
+    dirs : dict
+        Analysis directories of the run.
+    config_file : str
+        File name of the run's config toml, within `CONFIG_PREFIX`.
+    logger : logging.Logger, optional
+        Logger instance, by default None.
+
+    Returns
+    -------
+    str
+        Directory of the OD matrix parquet file(s).
+
+    """
+    od_dir = os.path.join(dirs["files_dir"], "benchmark_analyse_network")
+    if len(glob.glob(os.path.join(od_dir, "*.parquet"))) > 0:
+        return od_dir
+
+    # imported here, so only the checks start the JVM
+    from r5py import TransportMode
+    from transport_performance.analyse_network import AnalyseNetwork
+
+    from stages import analysis_scenarios, od_thresholds
+
+    config = toml.load(os.path.join(CONFIG_PREFIX, config_file))
+    scenario = analysis_scenarios(config)[0]
+    max_time, max_distance = od_thresholds(config)
+    grid = PopGrid.load(os.path.join(dirs["pop_outputs_dir"], "pop_grid.npz"))
+    os.makedirs(od_dir, exist_ok=True)
+    if logger is not None:
+        logger.info(f"Calculating the AnalyseNetwork OD matrix in {od_dir}...")
+    an = AnalyseNetwork(
+        grid.centroid_gdf(),
+        os.path.join(dirs["interim_osm"], "filtered.osm.pbf"),
+        glob.glob(os.path.join(dirs["interim_gtfs"], "*.zip")),
+        od_dir,
+    )
+    an.od_matrix(
+        batch_orig=False,
+        distance=max_distance,
+        departure=scenario["departure"],
+        departure_time_window=datetime.timedelta(
+            hours=config["analyse_network"]["departure_time_window"]
+        ),
+        max_time=datetime.timedelta(minutes=max_time),
+        transport_modes=[
+            TransportMode[mode] for mode in scenario["transport_modes"]
+        ],
+    )
+    del an
+    return od_dir
+
+
+def _library_metrics(od_path: str, dirs: dict, config_file: str) -> tuple:
+    """Calculate the `transport_performance` metrics of an OD matrix."""
+    from transport_performance.metrics import transport_performance
+
+    general = toml.load(os.path.join(CONFIG_PREFIX, config_file))["general"]
+    grid = PopGrid.load(os.path.join(dirs["pop_outputs_dir"], "pop_grid.npz"))
+    return transport_performance(
+        od_path,
+        grid.centroid_gdf(),
+        grid.to_gdf(),
+        travel_time_threshold=general["max_time"],
+        distance_threshold=general["max_distance"],
+        urban_centre_gdf=gpd.read_parquet(
+            os.path.join(dirs["uc_outputs_dir"], "uc_gdf.parquet")
+        ),
+    )
+
+
+def _streaming_metrics(od_path: str, dirs: dict, config_file: str) -> tuple:
+    """Calculate the streaming metrics of an OD matrix."""
+    general = toml.load(os.path.join(CONFIG_PREFIX, config_file))["general"]
+    grid = PopGrid.load(os.path.join(dirs["pop_outputs_dir"], "pop_grid.npz"))
+    return streaming_transport_performance(
+        od_path,
+        grid.to_gdf(),
+        travel_time_threshold=general["max_time"],
+        distance_threshold=general["max_distance"],
+        urban_centre_gdf=gpd.read_parquet(
+            os.path.join(dirs["uc_outputs_dir"], "uc_gdf.parquet")
+        ),
+        coords=np.column_stack(grid.centroids(CENTROID_CRS)),
+    )
+
+
+def _run_metrics(dirs: dict) -> tuple:
+    """Read the transport performance and stats written by a run."""
+    tp_df = gpd.read_parquet(
+        glob.glob(
+            os.path.join(
+                dirs["metrics_outputs_dir"], "transport_performance_*.parquet"
+            )
+        )[0]
+    )
+    stats_df = pd.read_csv(
+        glob.glob(
+            os.path.join(
+                dirs["metrics_outputs_dir"], "transport_performance_stats_*"
+            )
+        )[0]
+    )
+    return tp_df, stats_df
+
+
+def metric_differences(
+    expected_tp: pd.DataFrame,
+    expected_stats: pd.DataFrame,
+    tp_df: pd.DataFrame,
+    stats_df: pd.DataFrame,
+) -> dict:
+    """Get the largest relative differences of two transport performances.
+
+    Parameters
+    ----------
+    expected_tp : pd.DataFrame
+        Expected transport performance per cell, with an "id" column.
+    expected_stats : pd.DataFrame
+        Expected descriptive statistics.
+    tp_df : pd.DataFrame
+        Transport performance per cell to compare, with an "id" column.
+    stats_df : pd.DataFrame
+        Descriptive statistics to compare.
+
+    Returns
+    -------
+    dict
+        Largest relative difference of each transport performance column
+        and numeric statistic, keyed by name. Cells or statistics found in
+        only one of the inputs have an infinite difference.
+
+    """
+
+    def _difference(expected, actual) -> float:
+        expected = np.asarray(expected, dtype=float)
+        actual = np.asarray(actual, dtype=float)
+        if expected.shape != actual.shape:
+            return float("inf")
+        scale = np.maximum(np.abs(expected), 1e-12)
+        difference = np.abs(actual - expected) / scale
+        difference[np.isnan(expected) & np.isnan(actual)] = 0
+        return float(np.nan_to_num(difference, nan=np.inf).max(initial=0))
+
+    differences = {}
+    merged = expected_tp.merge(
+        tp_df, on="id", how="outer", suffixes=("", "_actual")
+    )
+    for column in [
+        "population",
+        "accessible_population",
+        "proximity_population",
+        "transport_performance",
+    ]:
+        differences[column] = (
+            _difference(merged[column], merged[f"{column}_actual"])
+            if f"{column}_actual" in merged.columns
+            else float("inf")
+        )
+    for column in expected_stats.columns:
+        if not pd.api.types.is_numeric_dtype(expected_stats[column]):
+            continue
+        differences[column] = (
+            _difference(expected_stats[column], stats_df[column])
+            if column in stats_df.columns
+            else float("inf")
+        )
+    return differences
+
+
+def run_benchmark(
+    scale: str,
+    repeats: int = 1,
+    env: dict = None,
+    metrics: bool = False,
+    od: bool = False,
+    logger=None,
+) -> dict:
+    """Run the pipeline against synthetic inputs and collect stage timings.
+
+    Synthetic inputs are generated (once) in `BENCHMARK_DIR/<scale>/`, which
+    is used as the working directory of the runs. The stage cache is
+    disabled, so every stage is timed.
+
+    Parameters
+    ----------
+    scale : str
+        One of the `synthetic.SCALES` keys.
+    repeats : int, optional
+        Number of runs, by default 1. The median timing of each stage is
+        reported.
+    env : dict, optional
+        Extra environment variables of the runs (e.g. `MAX_CONCURRENCY`), by
+        default None.
+    metrics : bool, optional
+        Whether to check the streaming metrics against the
+        `transport_performance` metrics of each run (see `check_metrics()`),
+        by default False. The runs then use `STREAMING_METRICS=0`.
+    od : bool, optional
+        Whether to check the metrics of each run against those of an
+        `AnalyseNetwork` OD matrix (see `check_od()`), by default False. The
+        runs then use `STREAMING_METRICS=0` and, unless set in `env`,
+        `CHECK_OD_SHARD_SIZE` origins per OD shard.
+    logger : logging.Logger, optional
+        Logger instance, by default None.
+
+    Returns
+    -------
+    dict
+        "scale", "repeats", "env" and "timings" (median wall time in
+        seconds, keyed by stage name, plus "plot" and "total"), and the
+        largest "metrics_differences" when `metrics` is set and
+        "od_differences" when `od` is set.
+
+    """
+    default_config = os.path.abspath(DEFAULT_CONFIG)
+    root = os.path.abspath(os.path.join(BENCHMARK_DIR, scale))
+    os.makedirs(root, exist_ok=True)
+
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        if logger is not None:
+            logger.info(f"Generating synthetic `{scale}` inputs in {root}...")
+        area_env = generate_inputs(".", scale, default_config)
+
+        samples = {}
+        differences = {}
+        od_differences = {}
+        for repeat in range(repeats):
+            run_env = {
+                **os.environ,
+                **area_env,
+                # unique area names, as run directories are per minute
+                "AREA_NAME": f"{area_env['AREA_NAME']}_{repeat}",
+                "USE_CACHE": "0",
+                **({"OD_SHARD_SIZE": str(CHECK_OD_SHARD_SIZE)} if od else {}),
+                **(env or {}),
+                **({"STREAMING_METRICS": "0"} if metrics or od else {}),
+            }
+            start = time.perf_counter()
+            dirs = run_area("benchmark_config.toml", run_env)
+            samples.setdefault("total", []).append(time.perf_counter() - start)
+
+            with open(os.path.join(dirs["logger_dir"], "metrics.json")) as f:
+                for record in json.load(f)["stages"]:
+                    samples.setdefault(record["stage"], []).append(
+                        record["wall_s"]
+                    )
+            samples.setdefault("plot", []).append(time_plot(dirs))
+            if metrics:
+                for name, value in check_metrics(
+                    dirs, "benchmark_config.toml", logger
+                ).items():
+                    differences[name] = max(differences.get(name, 0), value)
+            if od:
+                for name, value in check_od(
+                    dirs, "benchmark_config.toml", logger
+                ).items():
+                    od_differences[name] = max(
+                        od_differences.get(name, 0), value
+                    )
+    finally:
+        os.chdir(cwd)
+
+    results = {
+        "scale": scale,
+        "repeats": repeats,
+        "env": env or {},
+        "timings": {
+            name: round(statistics.median(values), 3)
+            for name, values in samples.items()
+        },
+    }
+    if metrics:
+        results["metrics_differences"] = differences
+    if od:
+        results["od_differences"] = od_differences
+    return results
+
+
+def compare(
+    results: dict,
+    baseline: dict,
+    tolerance: float = TOLERANCE,
+    min_seconds: float = MIN_SECONDS,
+) -> list:
+    """Compare benchmark timings with a baseline.
+
+    Parameters
+    ----------
+    results : dict
+        Benchmark results, as returned by `run_benchmark()`.
+    baseline : dict
+        Baseline benchmark results.
+    tolerance : float, optional
+        Allowed relative slowdown, by default `TOLERANCE`.
+    min_seconds : float, optional
+        Allowed absolute slowdown in seconds, by default `MIN_SECONDS`.
+
+    Returns
+    -------
+    list
+        (name, baseline seconds, current seconds) of each regressed timing.
+
+    """
+    regressions = []
+    for name, seconds in results["timings"].items():
+        base = baseline["timings"].get(name)
+        if base is None:
+            continue
+        if seconds > base * (1 + tolerance) and seconds - base > min_seconds:
+            regressions.append((name, base, seconds))
+    return regressions
+
+
+def main(argv: list = None) -> int:
+    """Run the benchmark CLI, returning 1 when timings regressed."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=list(SCALES), default="small")
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument(
+        "--baseline",
+        help="baseline JSON (default: data/benchmark/baseline_<scale>.json)",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the baseline instead of comparing",
+    )
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--min-seconds", type=float, default=MIN_SECONDS)
+    parser.add_argument(
+        "--check-metrics",
+        action="store_true",
+        help="check the streaming metrics against transport_performance",
+    )
+    parser.add_argument(
+        "--check-od",
+        action="store_true",
+        help="check the sharded OD metrics against AnalyseNetwork",
+    )
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="extra environment variable of the runs (repeatable)",
+    )
+    args = parser.parse_args(argv)
+
+    logger = setup_logger(f"{LOGGER_NAME}-benchmark")
+    env = dict(item.split("=", 1) for item in args.env)
+    results = run_benchmark(
+        args.scale,
+        args.repeats,
+        env,
+        args.check_metrics,
+        args.check_od,
+        logger,
+    )
+    for name, seconds in results["timings"].items():
+        logger.info(f"{name}: {seconds:.3f}s")
+    mismatched = []
+    for key, label in [
+        ("metrics_differences", "Streaming metrics"),
+        ("od_differences", "Sharded OD metrics"),
+    ]:
+        for name, difference in results.get(key, {}).items():
+            if difference > METRICS_RTOL:
+                mismatched.append(name)
+                logger.error(
+                    f"{label} {name} relative difference: {difference}"
+                )
+            else:
+                logger.info(
+                    f"{label} {name} relative difference: {difference}"
+                )
+    if len(mismatched) > 0:
+        return 1
+
+    baseline_path = args.baseline or os.path.join(
+        BENCHMARK_DIR, f"baseline_{args.scale}.json"
+    )
+    if args.save_baseline:
+        with open(baseline_path, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Baseline saved: {baseline_path}")
+        return 0
+
+    if not os.path.exists(baseline_path):
+        logger.warning(f"No baseline at {baseline_path}, nothing to compare.")
+        return 0
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+    for name, base, seconds in regressions:
+        logger.error(f"{name} regressed: {base:.3f}s -> {seconds:.3f}s")
+    if len(regressions) > 0:
+        return 1
+    logger.info(f"No regressions against baseline: {baseline_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,372 @@
+"""Caching utilities for run.py."""
+
+import functools
+import hashlib
+import json
+import os
+import shutil
+
+from importlib import metadata
+
+# libraries whose installed versions are part of every stage key, so cached
+# outputs are not reused after an upgrade
+KEY_PACKAGES = ["transport_performance", "r5py"]
+
+
+def file_fingerprint(path: str) -> dict:
+    """Build a cheap fingerprint of an input file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the input file.
+
+    Returns
+    -------
+    dict
+        File path, size (in bytes) and modification time (in ns). Any edit to
+        or replacement of the file will change this fingerprint.
+
+    """
+    stat = os.stat(path)
+    return {
+        "path": os.path.normpath(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def file_digest(path: str, cache_dir: str = None) -> str:
+    """Hash the content of an input file.
+
+    Unlike `file_fingerprint()`, the digest does not change when an
+    identical file is copied or re-downloaded. Digests are memoised in
+    `cache_dir/digests/`, keyed by the file fingerprint, so unchanged files
+    are only hashed once.
+
+    Parameters
+    ----------
+    path : str
+        Path to the input file.
+    cache_dir : str, optional
+        Root cache directory, by default None meaning no memo.
+
+    Returns
+    -------
+    str
+        Hex SHA-256 digest of the file content.
+
+    """
+    memo_path = None
+    if cache_dir is not None:
+        encoded = json.dumps(file_fingerprint(path), sort_keys=True).encode()
+        memo_path = os.path.join(
+            cache_dir, "digests", hashlib.sha256(encoded).hexdigest()[:24]
+        )
+        if os.path.exists(memo_path):
+            with open(memo_path, "r") as f:
+                return f.read().strip()
+
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+
+    if memo_path is not None:
+        os.makedirs(os.path.dirname(memo_path), exist_ok=True)
+        tmp_path = f"{memo_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            f.write(digest)
+        os.replace(tmp_path, memo_path)
+    return digest
+
+
+@functools.lru_cache(maxsize=None)
+def package_versions() -> tuple:
+    """Get the installed versions of `KEY_PACKAGES`.
+
+    Packages installed from a VCS URL (e.g. transport_performance from its
+    git branch) also include the installed commit, as their version is not
+    bumped for every change.
+
+    Returns
+    -------
+    tuple
+        (package, version) pairs, where the version is None when the package
+        is not installed.
+
+    """
+    versions = []
+    for package in KEY_PACKAGES:
+        try:
+            dist = metadata.distribution(package)
+        except metadata.PackageNotFoundError:
+            versions.append((package, None))
+            continue
+        version = dist.version
+        direct_url = json.loads(dist.read_text("direct_url.json") or "{}")
+        commit = direct_url.get("vcs_info", {}).get("commit_id")
+        if commit is not None:
+            version = f"{version}+{commit}"
+        versions.append((package, version))
+    return tuple(versions)
+
+
+def stage_key(
+    stage: str,
+    files: list = None,
+    config: dict = None,
+    env: dict = None,
+    upstream: list = None,
+    version: int = None,
+) -> str:
+    """Build a content-addressed key for an analysis stage.
+
+    The key also depends on the installed library versions (see
+    `package_versions()`), so upgrading them invalidates every cached stage.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage (e.g. "urban_centre").
+    files : list, optional
+        Input files read by the stage, by default None meaning no input
+        files. Each file is fingerprinted using `file_fingerprint()`.
+    config : dict, optional
+        Config TOML values used by the stage, by default None.
+    env : dict, optional
+        Environment variable values used by the stage, by default None.
+    upstream : list, optional
+        Keys of the stages this stage depends on, by default None. Including
+        these means a change to an upstream stage invalidates this stage.
+    version : int, optional
+        Version of the stage's outputs, by default None meaning the first.
+        Bumped when the stage's code changes its outputs, so outputs cached
+        by earlier code are not reused.
+
+    Returns
+    -------
+    str
+        Hex digest identifying the stage inputs.
+
+    """
+    payload = {
+        "stage": stage,
+        "files": [file_fingerprint(f) for f in sorted(files or [])],
+        "config": config or {},
+        "env": env or {},
+        "upstream": list(upstream or []),
+        "packages": dict(package_versions()),
+    }
+    # only included once bumped, so the keys of unversioned stages are kept
+    if version is not None:
+        payload["version"] = version
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()[:24]
+
+
+def _link_or_copy(src: str, dst: str) -> str:
+    """Hard link `src` to `dst`, falling back to a copy across devices."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def _stage_entry(cache_dir: str, stage: str, key: str) -> str:
+    """Get the cache entry directory of a stage key."""
+    return os.path.join(cache_dir, "stages", stage, key)
+
+
+def restore_stage(cache_dir: str, stage: str, key: str, dirs: dict) -> bool:
+    """Restore cached stage artifacts into the current run directories.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Root cache directory.
+    stage : str
+        Name of the stage.
+    key : str
+        Stage key, as returned by `stage_key()`.
+    dirs : dict
+        Mapping of artifact label to the run directory to restore into. Must
+        use the same labels as were passed to `store_stage()`.
+
+    Returns
+    -------
+    bool
+        True if the stage was restored from the cache, otherwise False.
+
+    """
+    entry = _stage_entry(cache_dir, stage, key)
+    if not os.path.isdir(entry):
+        return False
+    if any(not os.path.isdir(os.path.join(entry, label)) for label in dirs):
+        return False
+
+    for label, dst in dirs.items():
+        shutil.copytree(
+            os.path.join(entry, label),
+            dst,
+            copy_function=_link_or_copy,
+            dirs_exist_ok=True,
+        )
+    return True
+
+
+def store_stage(cache_dir: str, stage: str, key: str, dirs: dict) -> None:
+    """Store stage artifacts from the current run directories in the cache.
+
+    The entry is built in a temporary directory and renamed into place, so
+    partially written entries are never restored (e.g. when a run is killed).
+
+    Parameters
+    ----------
+    cache_dir : str
+        Root cache directory.
+    stage : str
+        Name of the stage.
+    key : str
+        Stage key, as returned by `stage_key()`.
+    dirs : dict
+        Mapping of artifact label to the run directory holding the stage's
+        artifacts.
+
+    """
+    entry = _stage_entry(cache_dir, stage, key)
+    if os.path.isdir(entry):
+        return
+
+    tmp_entry = f"{entry}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_entry, ignore_errors=True)
+    for label, src in dirs.items():
+        shutil.copytree(
+            src,
+            os.path.join(tmp_entry, label),
+            copy_function=_link_or_copy,
+        )
+
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # another run stored the same key first - keep theirs
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+
+def link_file(src: str, dst: str) -> str:
+    """Hard link a file into place, falling back to a copy across devices.
+
+    Parameters
+    ----------
+    src : str
+        Path to the file to link.
+    dst : str
+        Destination path. Any existing file at this path is replaced.
+
+    Returns
+    -------
+    str
+        The destination path.
+
+    """
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    if os.path.exists(dst):
+        os.remove(dst)
+    return _link_or_copy(src, dst)
+
+
+def cached_file(
+    cache_dir: str,
+    namespace: str,
+    key: str,
+    build,
+    suffix: str = "",
+    budget_bytes: int = None,
+) -> str:
+    """Get a file from a persistent, size-limited file cache.
+
+    Files are evicted least recently used first, once the total size of the
+    `namespace` exceeds `budget_bytes`.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Root cache directory.
+    namespace : str
+        Cache namespace (subdirectory), e.g. "rasters".
+    key : str
+        Key identifying the file, e.g. as returned by `stage_key()`.
+    build : callable
+        Function that writes the file to the path it is given. Only called
+        on a cache miss.
+    suffix : str, optional
+        File name suffix (e.g. ".tif"), by default "".
+    budget_bytes : int, optional
+        Disk budget of the namespace, by default None meaning no eviction.
+
+    Returns
+    -------
+    str
+        Path to the cached file.
+
+    """
+    namespace_dir = os.path.join(cache_dir, namespace)
+    os.makedirs(namespace_dir, exist_ok=True)
+    path = os.path.join(namespace_dir, f"{key}{suffix}")
+
+    if os.path.exists(path):
+        # mark as recently used
+        os.utime(path)
+    else:
+        tmp_path = os.path.join(
+            namespace_dir, f"{key}.tmp-{os.getpid()}{suffix}"
+        )
+        build(tmp_path)
+        os.replace(tmp_path, path)
+
+    if budget_bytes is not None:
+        evict_lru(namespace_dir, budget_bytes, keep=[path])
+    return path
+
+
+def evict_lru(directory: str, budget_bytes: int, keep: list = None) -> list:
+    """Remove the least recently used files until within a disk budget.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to evict files from (not recursive).
+    budget_bytes : int
+        Maximum total size of the files in `directory`.
+    keep : list, optional
+        Paths that must not be evicted, by default None.
+
+    Returns
+    -------
+    list
+        Paths of the evicted files.
+
+    """
+    keep = {os.path.normpath(p) for p in (keep or [])}
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if ".tmp-" in name or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    evicted = []
+    for _, size, path in sorted(entries):
+        if total <= budget_bytes:
+            break
+        if os.path.normpath(path) in keep:
+            continue
+        os.remove(path)
+        total -= size
+        evicted.append(path)
+    return evicted
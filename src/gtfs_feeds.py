@@ -0,0 +1,361 @@
+"""Per-feed GTFS processing utilities for run.py."""
+
+import copy
+import datetime
+import multiprocessing
+import os
+import pandas as pd
+import pickle
+import shutil
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union
+from transport_performance.gtfs.multi_validation import MultiGtfsInstance
+
+from cache import file_digest, link_file, stage_key
+from utils import gtfs_stops_view
+
+# columns that identify a row of the route/trip summaries (all other columns
+# are counts that are summed across feeds)
+SUMMARY_KEYS = ["date", "route_type"]
+
+
+def add_synthetic_calendar(
+    gtfs: MultiGtfsInstance, date: Union[str, list], logger=None
+):
+    """Create a synthetic calendar.txt for feeds without one.
+
+    R5PY needs calendar.txt to detect valid dates. The synthetic calendar has
+    all days set to zero (so calendar_dates.txt controls the schedule) and
+    spans either side of the analysis date(s).
+
+    Parameters
+    ----------
+    gtfs : MultiGtfsInstance
+        GTFS instances to update in place.
+    date : Union[str, list]
+        Analysis date, or list of analysis dates, in YYYYMMDD format.
+    logger : logging.Logger, optional
+        Logger instance, by default None.
+
+    """
+    for inst in gtfs.instances:
+        if inst.feed.calendar is None:
+            if logger is not None:
+                logger.warning("Creating a synthetic calendar.txt...")
+            # get unique service ids from calendar_dates.txt
+            calendar_df = pd.DataFrame(
+                inst.feed.calendar_dates.service_id.unique(),
+                columns=["service_id"],
+            )
+
+            # set all days to zero - allow calendar_dates to control schedule
+            calendar_df.loc[:, "monday"] = 0
+            calendar_df.loc[:, "tuesday"] = 0
+            calendar_df.loc[:, "wednesday"] = 0
+            calendar_df.loc[:, "thursday"] = 0
+            calendar_df.loc[:, "friday"] = 0
+            calendar_df.loc[:, "saturday"] = 0
+            calendar_df.loc[:, "sunday"] = 0
+
+            # set start/end date to be either side of the analysis date(s)
+            dates = [date] if isinstance(date, str) else date
+            start_dt = datetime.datetime.strptime(min(dates), "%Y%m%d")
+            end_dt = datetime.datetime.strptime(max(dates), "%Y%m%d")
+            calendar_df.loc[:, "start_date"] = (
+                start_dt - datetime.timedelta(days=1)
+            ).strftime("%Y%m%d")
+            calendar_df.loc[:, "end_date"] = (
+                end_dt + datetime.timedelta(days=1)
+            ).strftime("%Y%m%d")
+
+            inst.feed.calendar = calendar_df
+
+
+def gtfs_cache_key(
+    feed_paths: list,
+    gtfs_bbox: list,
+    date: Union[str, list],
+    empty_feed: bool,
+    fast_travel: bool,
+    calculate_summaries: bool,
+    cache_dir: str = None,
+    version: int = None,
+) -> str:
+    """Build the cache key of cleaned, date filtered GTFS.
+
+    The key depends on the content of the feeds (see `cache.file_digest()`)
+    rather than their paths and modification times, so copies of the same
+    feeds (e.g. re-downloaded or used by a neighbouring area with the same
+    bbox) share cache entries.
+
+    Parameters
+    ----------
+    feed_paths : list
+        Paths to the GTFS zips.
+    gtfs_bbox : list
+        Bounding box the feeds are clipped to, in EPSG:4326.
+    date : Union[str, list]
+        Analysis date, or list of analysis dates, in YYYYMMDD format.
+    empty_feed : bool
+        Whether empty feeds are deleted.
+    fast_travel : bool
+        Whether unrealistically fast travel is validated and cleaned.
+    calculate_summaries : bool
+        Whether the route/trip summaries are calculated.
+    cache_dir : str, optional
+        Root cache directory memoising the feed digests, by default None.
+    version : int, optional
+        Version of the cached entry (see `cache.stage_key()`), by default
+        None.
+
+    Returns
+    -------
+    str
+        Cache key.
+
+    """
+    return stage_key(
+        "gtfs_clean",
+        config={
+            "feeds": sorted(
+                (os.path.basename(path), file_digest(path, cache_dir))
+                for path in feed_paths
+            ),
+            # rounded, as the bbox is reprojected from the urban centre
+            "bbox": [round(x, 6) for x in gtfs_bbox],
+            "date": date,
+        },
+        env={
+            "empty_feed": empty_feed,
+            "fast_travel": fast_travel,
+            "calculate_summaries": calculate_summaries,
+        },
+        version=version,
+    )
+
+
+def process_feed(
+    feed_path: str,
+    out_dir: str,
+    gtfs_bbox: list,
+    date: Union[str, list],
+    empty_feed: bool,
+    fast_travel: bool,
+    calculate_summaries: bool,
+    cache_dir: str = None,
+) -> dict:
+    """Clip, validate, clean, date filter and save a single GTFS feed.
+
+    When `cache_dir` is given, the cleaned zip and results of the feed are
+    cached in `cache_dir/gtfs_feeds/` (keyed by `gtfs_cache_key()`), and
+    reused by later runs processing the same feed for the same bbox and
+    dates.
+
+    Parameters
+    ----------
+    feed_path : str
+        Path to the GTFS zip.
+    out_dir : str
+        Directory to save the cleaned GTFS zip to.
+    gtfs_bbox : list
+        Bounding box to clip the feed to, in EPSG:4326.
+    date : Union[str, list]
+        Analysis date, or list of analysis dates, in YYYYMMDD format.
+    empty_feed : bool
+        Whether to delete the feed (rather than raise an error) when it is
+        empty after filtering.
+    fast_travel : bool
+        Whether to validate and clean unrealistically fast travel.
+    calculate_summaries : bool
+        Whether to calculate the route/trip summaries.
+    cache_dir : str, optional
+        Root cache directory, by default None meaning no caching.
+
+    Returns
+    -------
+    dict
+        Results of the feed: "feed" (`feed_path`), "dates" (available dates
+        after clipping), "pre_clean_validity" and "post_clean_validity"
+        (validity dataframes), "route_summary" and "trip_summary" (summary
+        dataframes, or None when not calculated) and "stops_view" (view of
+        the cleaned feed, see `utils.gtfs_stops_view()`). All but "feed" are
+        empty/None when the feed was deleted.
+
+    """
+    args = (gtfs_bbox, date, empty_feed, fast_travel, calculate_summaries)
+    if cache_dir is None:
+        return _process_feed(feed_path, out_dir, *args)
+
+    # 3: results hold a "stops_view" (see `combine_stops_views()`) with the
+    # unique stop ids of `stop_times` only
+    key = gtfs_cache_key([feed_path], *args, cache_dir=cache_dir, version=3)
+    entry = os.path.join(cache_dir, "gtfs_feeds", key)
+    if not os.path.isdir(entry):
+        # build in a temporary directory, so partial entries are never used
+        tmp_entry = f"{entry}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(os.path.join(tmp_entry, "gtfs"))
+        result = _process_feed(
+            feed_path, os.path.join(tmp_entry, "gtfs"), *args
+        )
+        with open(os.path.join(tmp_entry, "result.pkl"), "wb") as f:
+            pickle.dump(result, f)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # another run stored the same feed first - use theirs
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    with open(os.path.join(entry, "result.pkl"), "rb") as f:
+        result = pickle.load(f)
+    for name in os.listdir(os.path.join(entry, "gtfs")):
+        link_file(
+            os.path.join(entry, "gtfs", name), os.path.join(out_dir, name)
+        )
+    return {**result, "feed": feed_path}
+
+
+def _process_feed(
+    feed_path: str,
+    out_dir: str,
+    gtfs_bbox: list,
+    date: Union[str, list],
+    empty_feed: bool,
+    fast_travel: bool,
+    calculate_summaries: bool,
+) -> dict:
+    """Process a single GTFS feed (see `process_feed()`), uncached."""
+    result = {
+        "feed": feed_path,
+        "dates": [],
+        "pre_clean_validity": None,
+        "post_clean_validity": None,
+        "route_summary": None,
+        "trip_summary": None,
+        "stops_view": None,
+    }
+
+    gtfs = MultiGtfsInstance(feed_path)
+    gtfs.filter_to_bbox(gtfs_bbox, delete_empty_feeds=empty_feed)
+    if len(gtfs.instances) == 0:
+        return result
+    result["dates"] = sorted(gtfs.instances[0].feed.get_dates())
+
+    gtfs.is_valid({"far_stops": fast_travel})
+    result["pre_clean_validity"] = gtfs.validity_df
+
+    gtfs.clean_feeds({"fast_travel": fast_travel})
+    gtfs.is_valid({"far_stops": fast_travel})
+    result["post_clean_validity"] = gtfs.validity_df
+
+    if calculate_summaries:
+        result["route_summary"] = gtfs.summarise_routes(to_days=False)
+        result["trip_summary"] = gtfs.summarise_trips(to_days=False)
+    result["stops_view"] = gtfs_stops_view(gtfs, stops_only=True)
+
+    gtfs.filter_to_date(date, delete_empty_feeds=empty_feed)
+    add_synthetic_calendar(gtfs, date)
+    gtfs.save_feeds(out_dir)
+    return result
+
+
+def process_feeds_parallel(
+    feed_paths: list,
+    out_dir: str,
+    gtfs_bbox: list,
+    date: Union[str, list],
+    empty_feed: bool,
+    fast_travel: bool,
+    calculate_summaries: bool,
+    workers: int,
+    cache_dir: str = None,
+) -> list:
+    """Run `process_feed()` for each GTFS feed in a process pool.
+
+    Parameters
+    ----------
+    feed_paths : list
+        Paths to the GTFS zips.
+    out_dir : str
+        Directory to save the cleaned GTFS zips to.
+    gtfs_bbox : list
+        Bounding box to clip the feeds to, in EPSG:4326.
+    date : Union[str, list]
+        Analysis date, or list of analysis dates, in YYYYMMDD format.
+    empty_feed : bool
+        Whether to delete (rather than raise an error for) empty feeds.
+    fast_travel : bool
+        Whether to validate and clean unrealistically fast travel.
+    calculate_summaries : bool
+        Whether to calculate the route/trip summaries.
+    workers : int
+        Maximum number of worker processes (one feed per worker).
+    cache_dir : str, optional
+        Root cache directory of the per-feed cache (see `process_feed()`),
+        by default None meaning no caching.
+
+    Returns
+    -------
+    list
+        `process_feed()` results, in the order of `feed_paths`.
+
+    """
+    mp_context = multiprocessing.get_context("spawn")
+    n_workers = max(1, min(workers, len(feed_paths)))
+    with ProcessPoolExecutor(n_workers, mp_context=mp_context) as pool:
+        futures = [
+            pool.submit(
+                process_feed,
+                feed_path,
+                out_dir,
+                gtfs_bbox,
+                date,
+                empty_feed,
+                fast_travel,
+                calculate_summaries,
+                cache_dir,
+            )
+            for feed_path in feed_paths
+        ]
+        return [future.result() for future in futures]
+
+
+def combine_validity(results: list, key: str) -> pd.DataFrame:
+    """Concatenate the per-feed validity dataframes of `key`."""
+    frames = [r[key] for r in results if r[key] is not None]
+    if len(frames) == 0:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
+def combine_stops_views(results: list) -> MultiGtfsInstance:
+    """Combine the per-feed stops views into one `MultiGtfsInstance`.
+
+    The combined view holds the instances of every feed, so its `viz_stops`
+    map matches the one of the feeds processed together.
+    """
+    views = [r["stops_view"] for r in results if r["stops_view"] is not None]
+    combined = copy.copy(views[0])
+    combined.instances = [inst for view in views for inst in view.instances]
+    return combined
+
+
+def combine_summaries(results: list, key: str) -> pd.DataFrame:
+    """Combine the per-feed summaries of `key`, summing counts across feeds.
+
+    Rows are identified by `SUMMARY_KEYS` and the remaining count columns
+    are totalled over feeds. Unlike the `MultiGtfsInstance` summaries of all
+    feeds together, a route or trip found in several feeds (e.g. in
+    overlapping operator and regional feeds) is counted once per feed, as
+    the feeds are summarised separately. The serial path (`GTFS_WORKERS=1`)
+    should be used when feeds share routes and exact counts are needed.
+    """
+    frames = [r[key] for r in results if r[key] is not None]
+    if len(frames) == 0:
+        return pd.DataFrame()
+    combined = pd.concat(frames, ignore_index=True)
+    keys = [c for c in SUMMARY_KEYS if c in combined.columns]
+    if len(keys) == 0:
+        return combined
+    return combined.groupby(keys, as_index=False).sum(numeric_only=True)
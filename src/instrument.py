@@ -0,0 +1,308 @@
+"""Stage timing and resource instrumentation for run.py."""
+
+import datetime
+import json
+import os
+import resource
+import signal
+import threading
+import time
+
+from importlib import metadata
+
+# library versions recorded in metrics.json, to compare runs across upgrades
+VERSIONED_PACKAGES = ["transport_performance", "r5py", "geopandas", "pandas"]
+
+# (metrics.json key, Prometheus metric name, help text) of the stage metrics
+PROMETHEUS_METRICS = [
+    ("wall_s", "tp_stage_wall_seconds", "Stage wall time in seconds."),
+    ("cpu_s", "tp_stage_cpu_seconds", "Stage CPU time in seconds."),
+    (
+        "peak_rss_bytes",
+        "tp_stage_peak_rss_bytes",
+        "Peak RSS of the stage process and its children in bytes.",
+    ),
+    ("read_bytes", "tp_stage_read_bytes", "Bytes read from storage."),
+    ("write_bytes", "tp_stage_write_bytes", "Bytes written to storage."),
+]
+
+
+def _read_proc(path: str) -> str:
+    """Read a /proc file, returning an empty string when unavailable."""
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+def _rss_bytes(pid: int) -> int:
+    """Get the current RSS of a process in bytes (0 when unavailable)."""
+    for line in _read_proc(f"/proc/{pid}/status").splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) * 1024
+    return 0
+
+
+def _descendants(pid: int) -> list:
+    """Get the pids of all (live) descendants of a process."""
+    children = {}
+    for name in os.listdir("/proc") if os.path.isdir("/proc") else []:
+        if not name.isdigit():
+            continue
+        stat = _read_proc(f"/proc/{name}/stat")
+        if stat == "":
+            continue
+        # the command name may contain spaces, so split after its ")"
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+
+    pids = []
+    stack = [pid]
+    while len(stack) > 0:
+        for child in children.get(stack.pop(), []):
+            pids.append(child)
+            stack.append(child)
+    return pids
+
+
+def tree_rss_bytes(pid: int = None) -> int:
+    """Get the total RSS of a process and its descendants in bytes."""
+    pid = pid or os.getpid()
+    return sum(_rss_bytes(p) for p in [pid] + _descendants(pid))
+
+
+def kill_tree(pid: int) -> None:
+    """Kill a process and all of its descendants (e.g. the JVM)."""
+    for p in _descendants(pid) + [pid]:
+        try:
+            os.kill(p, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def io_bytes() -> tuple:
+    """Get the (read, write) storage bytes of this process so far.
+
+    Uses /proc/self/io, so is (0, 0) on systems without it.
+    """
+    counters = {}
+    for line in _read_proc("/proc/self/io").splitlines():
+        key, _, value = line.partition(":")
+        counters[key] = int(value)
+    return counters.get("read_bytes", 0), counters.get("write_bytes", 0)
+
+
+def cpu_seconds() -> float:
+    """Get the user + system CPU time of this process and waited children."""
+    total = 0.0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+class StageMonitor:
+    """Context manager measuring the resources used by a stage.
+
+    Records the wall time, CPU time (of this process and its waited
+    children), peak RSS (of this process and all its descendants, e.g. the
+    JVM and osmosis) and the storage bytes read and written. RSS is sampled
+    every `interval` seconds in a background thread, so very short peaks may
+    be missed.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage.
+    interval : float, optional
+        RSS sampling interval in seconds, by default 0.5.
+
+    Attributes
+    ----------
+    record : dict
+        Measurements of the stage, set on exit. See `measure_record()`.
+
+    """
+
+    def __init__(self, stage: str, interval: float = 0.5):
+        self.stage = stage
+        self.interval = interval
+        self.record = None
+        self._stop = threading.Event()
+        self._peak_rss = 0
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._peak_rss = max(self._peak_rss, tree_rss_bytes())
+
+    def __enter__(self):
+        self._started_at = datetime.datetime.now().isoformat()
+        self._wall = time.perf_counter()
+        self._cpu = cpu_seconds()
+        self._io = io_bytes()
+        self._peak_rss = tree_rss_bytes()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self._stop.set()
+        self._thread.join()
+        read_bytes, write_bytes = io_bytes()
+        self.record = measure_record(
+            self.stage,
+            "failed" if exc_type is not None else "ran",
+            started_at=self._started_at,
+            wall_s=time.perf_counter() - self._wall,
+            cpu_s=cpu_seconds() - self._cpu,
+            peak_rss_bytes=max(self._peak_rss, tree_rss_bytes()),
+            read_bytes=read_bytes - self._io[0],
+            write_bytes=write_bytes - self._io[1],
+        )
+
+
+def measure_record(
+    stage: str,
+    status: str,
+    started_at: str = None,
+    wall_s: float = None,
+    cpu_s: float = None,
+    peak_rss_bytes: int = None,
+    read_bytes: int = None,
+    write_bytes: int = None,
+) -> dict:
+    """Build the metrics.json record of a stage.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage.
+    status : str
+        One of "ran", "cached" (restored from the stage cache) or "failed".
+    started_at : str, optional
+        ISO format start time, by default None.
+    wall_s : float, optional
+        Wall time in seconds, by default None.
+    cpu_s : float, optional
+        CPU time in seconds, by default None.
+    peak_rss_bytes : int, optional
+        Peak RSS in bytes, by default None.
+    read_bytes : int, optional
+        Storage bytes read, by default None.
+    write_bytes : int, optional
+        Storage bytes written, by default None.
+
+    Returns
+    -------
+    dict
+        Stage record. Unmeasured values are None.
+
+    """
+    return {
+        "stage": stage,
+        "status": status,
+        "started_at": started_at,
+        "wall_s": None if wall_s is None else round(wall_s, 3),
+        "cpu_s": None if cpu_s is None else round(cpu_s, 3),
+        "peak_rss_bytes": peak_rss_bytes,
+        "read_bytes": read_bytes,
+        "write_bytes": write_bytes,
+    }
+
+
+def package_versions() -> dict:
+    """Get the installed versions of `VERSIONED_PACKAGES`."""
+    versions = {}
+    for package in VERSIONED_PACKAGES:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def write_metrics_json(path: str, run: dict, stages: list) -> str:
+    """Write the run and stage metrics to a JSON file.
+
+    Parameters
+    ----------
+    path : str
+        Path to write to (e.g. `<logger_dir>/metrics.json`).
+    run : dict
+        Run level values (e.g. area name, total wall time).
+    stages : list
+        Stage records, as built by `measure_record()`.
+
+    Returns
+    -------
+    str
+        `path`.
+
+    """
+    with open(path, "w") as f:
+        json.dump(
+            {**run, "versions": package_versions(), "stages": stages},
+            f,
+            indent=2,
+        )
+    return path
+
+
+def _escape_label(value: str) -> str:
+    """Escape a Prometheus label value."""
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def write_prometheus_textfile(path: str, labels: dict, stages: list) -> str:
+    """Write the stage metrics in the Prometheus textfile collector format.
+
+    The file is written to a temporary file and renamed, as the node
+    exporter's textfile collector may read it at any time.
+
+    Parameters
+    ----------
+    path : str
+        Path of the `.prom` file to write.
+    labels : dict
+        Labels added to every sample (e.g. {"area": "leeds"}).
+    stages : list
+        Stage records, as built by `measure_record()`.
+
+    Returns
+    -------
+    str
+        `path`.
+
+    """
+    lines = []
+    for key, name, help_text in PROMETHEUS_METRICS + [
+        ("cached", "tp_stage_cached", "Whether the stage was restored.")
+    ]:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for record in stages:
+            value = (
+                int(record["status"] == "cached")
+                if key == "cached"
+                else record[key]
+            )
+            if value is None:
+                continue
+            sample_labels = {**labels, "stage": record["stage"]}
+            label_str = ",".join(
+                f'{k}="{_escape_label(v)}"' for k, v in sample_labels.items()
+            )
+            lines.append(f"{name}{{{label_str}}} {value}")
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+    return path
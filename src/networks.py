@@ -0,0 +1,180 @@
+"""Persistent r5 transport network cache for run.py."""
+
+import glob
+import os
+import threading
+
+from collections import OrderedDict
+
+from importlib import metadata
+
+import r5py
+
+from cache import cached_file, file_digest, stage_key
+
+# imported after r5py, which starts the JVM
+import java.io  # noqa: E402
+from com.conveyal.r5.kryo import KryoNetworkSerializer  # noqa: E402
+
+# recently used networks kept in memory by long-lived processes (see
+# `set_memo_size()`), keyed by `network_key()`
+_MEMO = OrderedDict()
+_MEMO_SIZE = 0
+_MEMO_LOCK = threading.Lock()
+
+
+class CachedTransportNetwork(r5py.TransportNetwork):
+    """An r5py `TransportNetwork` read from a serialised r5 network.
+
+    Only wraps the deserialised Java network: there is no OSM database or
+    working copy of the inputs to clean up.
+
+    Parameters
+    ----------
+    path : str
+        Path to the network file, as written by `save_network()`.
+
+    """
+
+    def __init__(self, path: str):
+        self.temporary_files = []
+        self._transport_network = KryoNetworkSerializer.read(
+            java.io.File(str(path))
+        )
+
+    def __del__(self):
+        pass
+
+
+def save_network(network: r5py.TransportNetwork, path: str) -> str:
+    """Serialise a built transport network (see `CachedTransportNetwork`)."""
+    KryoNetworkSerializer.write(
+        network._transport_network, java.io.File(str(path))
+    )
+    return path
+
+
+def network_key(osm_path: str, gtfs_paths: list, cache_dir: str) -> str:
+    """Build the cache key of a transport network.
+
+    The key depends on the content of the OSM extract and GTFS zips (see
+    `cache.file_digest()`) and the r5py version, so networks are reused by
+    runs with the same inputs in new run directories.
+    """
+    return stage_key(
+        "network",
+        config={
+            "osm": file_digest(osm_path, cache_dir),
+            "gtfs": sorted(file_digest(p, cache_dir) for p in gtfs_paths),
+        },
+        env={"r5py": metadata.version("r5py")},
+    )
+
+
+def set_memo_size(size: int) -> None:
+    """Set how many recently used networks are kept in memory.
+
+    Intended for long-lived processes (e.g. the service), where later
+    analyses of the same inputs then reuse the network without reading it.
+    Setting 0 (the default) disables the memo.
+    """
+    global _MEMO_SIZE
+    with _MEMO_LOCK:
+        _MEMO_SIZE = size
+        while len(_MEMO) > _MEMO_SIZE:
+            _MEMO.popitem(last=False)
+
+
+def cached_network(
+    osm_path: str,
+    gtfs_dir: str,
+    cache_dir: str = None,
+    network_cache_gb: float = None,
+    logger=None,
+) -> r5py.TransportNetwork:
+    """Build a transport network, or read it from the network cache.
+
+    Networks are serialised to `cache_dir/networks/`, keyed by
+    `network_key()`, and evicted least recently used first once the cache
+    exceeds `network_cache_gb`. Networks in the in-memory memo (see
+    `set_memo_size()`) are returned directly.
+
+    Parameters
+    ----------
+    osm_path : str
+        Path to the (filtered) OSM extract.
+    gtfs_dir : str
+        Directory of the (cleaned) GTFS zips.
+    cache_dir : str, optional
+        Root cache directory, by default None meaning the network is always
+        built and not cached.
+    network_cache_gb : float, optional
+        Disk budget of the network cache in GB, by default None meaning no
+        eviction.
+    logger : logging.Logger, optional
+        Logger instance, by default None.
+
+    Returns
+    -------
+    r5py.TransportNetwork
+        The transport network.
+
+    """
+    gtfs_paths = sorted(glob.glob(os.path.join(gtfs_dir, "*.zip")))
+    key = None
+    if cache_dir is not None or _MEMO_SIZE > 0:
+        key = network_key(osm_path, gtfs_paths, cache_dir)
+        with _MEMO_LOCK:
+            if key in _MEMO:
+                _MEMO.move_to_end(key)
+                if logger is not None:
+                    logger.info(f"Using transport network in memory: {key}")
+                return _MEMO[key]
+
+    if cache_dir is None:
+        network = r5py.TransportNetwork(osm_path, gtfs_paths)
+    else:
+        network = _read_or_build(
+            osm_path, gtfs_paths, key, cache_dir, network_cache_gb, logger
+        )
+
+    with _MEMO_LOCK:
+        if _MEMO_SIZE > 0:
+            _MEMO[key] = network
+            while len(_MEMO) > _MEMO_SIZE:
+                _MEMO.popitem(last=False)
+    return network
+
+
+def _read_or_build(
+    osm_path: str,
+    gtfs_paths: list,
+    key: str,
+    cache_dir: str,
+    network_cache_gb: float,
+    logger,
+) -> r5py.TransportNetwork:
+    """Read a network from the network cache, building it on a miss."""
+    built = {}
+
+    def _build(path: str) -> None:
+        if logger is not None:
+            logger.info(f"Building transport network (caching as {key})...")
+        built["network"] = r5py.TransportNetwork(osm_path, gtfs_paths)
+        save_network(built["network"], path)
+
+    path = cached_file(
+        cache_dir,
+        "networks",
+        key,
+        _build,
+        suffix=".dat",
+        budget_bytes=(
+            None if network_cache_gb is None else network_cache_gb * 1024**3
+        ),
+    )
+    if "network" in built:
+        return built["network"]
+    if logger is not None:
+        logger.info(f"Reading cached transport network: {path}")
+    return CachedTransportNetwork(path)
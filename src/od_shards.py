@@ -0,0 +1,492 @@
+"""Sharded, resumable OD matrix utilities for run.py."""
+
+import fcntl
+import json
+import numpy as np
+import os
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from concurrent.futures import ThreadPoolExecutor
+from r5py import TravelTimeMatrixComputer
+from scipy.spatial import cKDTree
+
+from streaming_metrics import great_circle_distance
+
+# shard parts and the manifest are written with these names. The manifest
+# name starts with "_" so parquet readers ignore it when reading the parts as
+# a dataset
+MANIFEST_NAME = "_manifest.json"
+PART_PREFIX = "od_shard_"
+
+# origins per part (origin block) of a compact OD matrix, when not sharded
+ORIGIN_BLOCK_SIZE = 1000
+# rows per row group of a compact part. Rows are sorted by travel time, so
+# each row group's statistics cover a narrow travel time range
+COMPACT_ROW_GROUP_ROWS = 128 * 1024
+# relative margin of the destination search radius, as the metric CRS
+# distances of the KD-tree differ slightly from the great circle distances
+# pairs are filtered by
+DISTANCE_MARGIN = 0.01
+# side of the origin tiles a shard is routed in, relative to the search
+# radius. Each tile is only routed to the destinations within range of its
+# own origins, so the destinations stay local however large the shard
+ORIGIN_TILE_FACTOR = 1.0
+
+
+def shard_origins(origin_ids: list, shard_size: int) -> list:
+    """Split origin ids into consecutive shards of at most `shard_size`.
+
+    The ids are sorted first, so the shards of an origin set are the same
+    between runs (required to resume a partially complete OD matrix).
+    """
+    origin_ids = sorted(origin_ids)
+    return [
+        origin_ids[i : i + shard_size]  # noqa: E203
+        for i in range(0, len(origin_ids), shard_size)
+    ]
+
+
+def part_path(shard_dir: str, shard: int) -> str:
+    """Get the parquet part path of a shard."""
+    return os.path.join(shard_dir, f"{PART_PREFIX}{shard:05d}.parquet")
+
+
+def read_manifest(shard_dir: str) -> dict:
+    """Read the shard manifest of `shard_dir`, or None when there is none."""
+    manifest_path = os.path.join(shard_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def write_manifest(shard_dir: str, manifest: dict) -> None:
+    """Atomically (over)write the shard manifest of `shard_dir`."""
+    manifest_path = os.path.join(shard_dir, MANIFEST_NAME)
+    tmp_path = os.path.join(shard_dir, f".{MANIFEST_NAME}.tmp-{os.getpid()}")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+class _ManifestLock:
+    """Exclusive lock of a shard manifest, across threads and processes.
+
+    Shards of one `shard_dir` may be calculated by several processes (e.g.
+    work queue workers, see `work_queue.py`), so manifest updates are
+    serialised with an advisory lock file.
+    """
+
+    def __init__(self, shard_dir: str):
+        self.path = os.path.join(shard_dir, ".manifest.lock")
+
+    def __enter__(self):
+        self._file = open(self.path, "a")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+def plan_od_shards(origin_ids: list, shard_dir: str, shard_size: int) -> tuple:
+    """Get the shards of an OD matrix, and those still to calculate.
+
+    The manifest of `shard_dir` is reset when the shard layout (origin count
+    or `shard_size`) has changed.
+
+    Returns
+    -------
+    tuple
+        Origin ids of each shard (see `shard_origins()`), and the indices of
+        the shards that are not complete.
+
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = shard_origins(origin_ids, shard_size)
+    layout = {"n_origins": len(origin_ids), "shard_size": shard_size}
+    with _ManifestLock(shard_dir):
+        manifest = read_manifest(shard_dir)
+        if manifest is None or manifest["layout"] != layout:
+            manifest = {"layout": layout, "n_shards": len(shards), "done": {}}
+            write_manifest(shard_dir, manifest)
+    todo = [
+        i
+        for i in range(len(shards))
+        if str(i) not in manifest["done"]
+        or not os.path.exists(part_path(shard_dir, i))
+    ]
+    return shards, todo
+
+
+def _metric_coords(gdf: gpd.GeoDataFrame) -> pd.DataFrame:
+    """Get the x/y coordinates (in m) of centroids, indexed by id."""
+    metric_gdf = gdf.to_crs(gdf.estimate_utm_crs())
+    return pd.DataFrame(
+        {"x": metric_gdf.geometry.x, "y": metric_gdf.geometry.y}
+    ).set_index(gdf["id"].values)
+
+
+def _lonlat_coords(gdf: gpd.GeoDataFrame) -> pd.DataFrame:
+    """Get the EPSG:4326 lon/lat coordinates of centroids, indexed by id."""
+    lonlat_gdf = gdf.to_crs("EPSG:4326")
+    return pd.DataFrame(
+        {"lon": lonlat_gdf.geometry.x, "lat": lonlat_gdf.geometry.y}
+    ).set_index(gdf["id"].values)
+
+
+def _add_distance(
+    travel_times: pd.DataFrame, lonlat: pd.DataFrame, max_distance: float
+) -> pd.DataFrame:
+    """Add the great circle "distance" (km) and drop pairs beyond it.
+
+    The distance is that of the proximity population of the metrics (see
+    `streaming_metrics.great_circle_distance()`).
+    """
+    origin = lonlat.loc[travel_times["from_id"]].to_numpy()
+    destination = lonlat.loc[travel_times["to_id"]].to_numpy()
+    travel_times["distance"] = great_circle_distance(
+        origin[:, 0], origin[:, 1], destination[:, 0], destination[:, 1]
+    )
+    return travel_times[travel_times["distance"] <= max_distance]
+
+
+class DestinationIndex:
+    """KD-tree of the destination centroids, to prune out of range pairs.
+
+    Destinations farther than the maximum distance from every origin of an
+    origin tile (see `origin_tiles()`) are dropped before routing, rather
+    than after (see `_add_distance()`).
+
+    Parameters
+    ----------
+    coords : pd.DataFrame
+        Metric x/y coordinates of the centroids, indexed by id (see
+        `_metric_coords()`).
+    destination_ids : list
+        Ids of the destination centroids.
+    max_distance : float
+        Maximum great circle origin-destination distance, in km.
+
+    """
+
+    def __init__(
+        self, coords: pd.DataFrame, destination_ids: list, max_distance: float
+    ):
+        self.coords = coords
+        self.destination_ids = np.asarray(destination_ids)
+        self.tree = cKDTree(coords.loc[self.destination_ids].to_numpy())
+        # beyond the threshold, as `_add_distance()` filters the pairs by
+        # their great circle distance
+        self.radius = max_distance * 1000 * (1 + DISTANCE_MARGIN)
+
+    def candidates(self, origin_ids: list) -> tuple:
+        """Get the destinations within range of any of the origins.
+
+        Returns
+        -------
+        tuple
+            Ids of the destinations within range of at least one origin, and
+            the number of origin-destination pairs within range.
+
+        """
+        neighbours = self.tree.query_ball_point(
+            self.coords.loc[origin_ids].to_numpy(), self.radius
+        )
+        n_pairs = sum(len(n) for n in neighbours)
+        if n_pairs == 0:
+            return self.destination_ids[:0], 0
+        within = np.unique(np.concatenate(neighbours).astype(int))
+        return self.destination_ids[within], n_pairs
+
+    def origin_tiles(self, origin_ids: list) -> list:
+        """Group origins into square tiles of about the search radius.
+
+        Returns
+        -------
+        list
+            Origin ids of each tile holding at least one origin.
+
+        """
+        origin_ids = np.asarray(origin_ids)
+        if len(origin_ids) == 0:
+            return []
+        tiles = np.floor(
+            self.coords.loc[origin_ids].to_numpy()
+            / (self.radius * ORIGIN_TILE_FACTOR)
+        ).astype(np.int64)
+        _, tile = np.unique(tiles, axis=0, return_inverse=True)
+        tile = tile.ravel()
+        return [origin_ids[tile == i] for i in range(tile.max() + 1)]
+
+    def count_pairs(self, origin_ids: list) -> int:
+        """Count the origin-destination pairs within range."""
+        return int(
+            self.tree.query_ball_point(
+                self.coords.loc[origin_ids].to_numpy(),
+                self.radius,
+                return_length=True,
+            ).sum()
+        )
+
+
+def write_part(
+    travel_times: pd.DataFrame, path: str, compact: bool = False
+) -> None:
+    """Write the travel times of a shard to a parquet part.
+
+    Parameters
+    ----------
+    travel_times : pd.DataFrame
+        Travel times, with "from_id", "to_id", "travel_time" (minutes, null
+        when unreachable) and "distance" columns.
+    path : str
+        Parquet part path.
+    compact : bool, optional
+        Whether to write the compact format, by default False: int32 ids and
+        nullable uint16 travel times, sorted by travel time with the nulls
+        last (so row group statistics allow travel time predicates to skip
+        row groups), dictionary encoding and zstd compression. Readers get
+        the nulls back as NaN (e.g. `pd.read_parquet()`).
+
+    Raises
+    ------
+    ValueError
+        When compact and the ids or travel times do not fit the narrow types.
+
+    """
+    if not compact:
+        travel_times.to_parquet(path, index=False)
+        return
+
+    for col, dtype in [
+        ("from_id", np.int32),
+        ("to_id", np.int32),
+        ("travel_time", np.uint16),
+    ]:
+        limits = np.iinfo(dtype)
+        if len(travel_times) > 0 and (
+            travel_times[col].min() < limits.min
+            or travel_times[col].max() > limits.max
+        ):
+            raise ValueError(
+                f"`{col}` values do not fit the compact OD format ({dtype})."
+            )
+    from_id = travel_times["from_id"].to_numpy(np.int32)
+    to_id = travel_times["to_id"].to_numpy(np.int32)
+    travel_time = travel_times["travel_time"].to_numpy(float).round()
+    # nulls last, as np.lexsort sorts nan last
+    order = np.lexsort((to_id, from_id, travel_time))
+    unreachable = np.isnan(travel_time[order])
+    # built without pandas metadata, so pandas reads the nullable travel
+    # times as float (nulls as NaN) rather than the nullable integer dtype
+    table = pa.table(
+        {
+            "from_id": from_id[order],
+            "to_id": to_id[order],
+            "travel_time": pa.array(
+                np.where(unreachable, 0, travel_time[order]).astype(np.uint16),
+                mask=unreachable,
+            ),
+            "distance": travel_times["distance"].to_numpy(float)[order],
+        }
+    )
+    pq.write_table(
+        table,
+        path,
+        row_group_size=COMPACT_ROW_GROUP_ROWS,
+        compression="zstd",
+        use_dictionary=True,
+        write_statistics=True,
+    )
+
+
+def compute_od_shards(
+    network,
+    centroid_gdf: gpd.GeoDataFrame,
+    shard_dir: str,
+    shard_size: int,
+    max_distance: float,
+    departure,
+    departure_time_window,
+    max_time,
+    transport_modes: list,
+    destination_col: str = "within_urban_centre",
+    workers: int = 1,
+    compact: bool = False,
+    only: list = None,
+    logger=None,
+) -> list:
+    """Calculate an OD matrix one origin shard at a time.
+
+    The origins of each shard are grouped into tiles (see
+    `DestinationIndex.origin_tiles()`), and each tile is only routed to the
+    destinations within `max_distance` of at least one of its origins (see
+    `DestinationIndex`). Each shard's
+    travel times are written to their own parquet part in
+    `shard_dir` and recorded in its manifest once complete. Shards already
+    recorded in the manifest are skipped, so an interrupted calculation
+    resumes from the missing shards (see `plan_od_shards()`).
+
+    Parameters
+    ----------
+    network : r5py.TransportNetwork
+        Transport network to route on.
+    centroid_gdf : gpd.GeoDataFrame
+        Population centroids, with an "id" column. All centroids are used as
+        origins.
+    shard_dir : str
+        Directory to write the parquet parts and manifest to.
+    shard_size : int
+        Maximum number of origins per shard.
+    max_distance : float
+        Maximum great circle origin-destination distance, in km.
+    departure : datetime.datetime
+        Departure date and time.
+    departure_time_window : datetime.timedelta
+        Departure time window.
+    max_time : datetime.timedelta
+        Maximum travel time.
+    transport_modes : list
+        r5py transport modes.
+    destination_col : str, optional
+        Boolean column of `centroid_gdf` flagging the destinations, by
+        default "within_urban_centre".
+    workers : int, optional
+        Number of shards to calculate concurrently, by default 1. Shards share
+        `network`, so memory does not grow with the number of workers.
+    compact : bool, optional
+        Whether to write the parts in the compact format (see
+        `write_part()`), by default False.
+    only : list, optional
+        Indices of the shards to calculate (when not complete), by default
+        None meaning all shards. Used to spread the shards of one OD matrix
+        across processes.
+    logger : logging.Logger, optional
+        Logger instance, by default None.
+
+    Returns
+    -------
+    list
+        Paths to the parquet parts, in shard order.
+
+    """
+    centroid_gdf = centroid_gdf.to_crs("EPSG:4326")
+    shards, todo = plan_od_shards(
+        centroid_gdf["id"].tolist(), shard_dir, shard_size
+    )
+    n_complete = len(shards) - len(todo)
+    if only is not None:
+        todo = [i for i in todo if i in only]
+    if logger is not None:
+        logger.info(
+            f"{n_complete} of {len(shards)} OD shards already complete, "
+            f"calculating {len(todo)} using {workers} workers..."
+        )
+    if len(todo) == 0:
+        return [part_path(shard_dir, i) for i in range(len(shards))]
+
+    destinations = centroid_gdf[centroid_gdf[destination_col]][
+        ["id", "geometry"]
+    ]
+    coords = _metric_coords(centroid_gdf)
+    lonlat = _lonlat_coords(centroid_gdf)
+    index = DestinationIndex(coords, destinations["id"], max_distance)
+    if logger is not None:
+        # only the origins of the shards to calculate, so a single shard
+        # (e.g. a work queue item) does not query the whole grid
+        todo_origins = [i for shard in todo for i in shards[shard]]
+        n_candidates = index.count_pairs(todo_origins)
+        n_pairs = len(todo_origins) * len(destinations)
+        logger.info(
+            f"{n_candidates} of {n_pairs} OD pairs of the shards to "
+            f"calculate ({100 * n_candidates / max(n_pairs, 1):.1f}%) are "
+            f"within {max_distance} km"
+        )
+
+    def _compute_shard(shard: int) -> None:
+        origins = centroid_gdf[centroid_gdf["id"].isin(shards[shard])][
+            ["id", "geometry"]
+        ]
+        # routed per origin tile, as the destinations within range of a
+        # whole shard (e.g. of all origins) may cover most of the grid
+        tiles = index.origin_tiles(shards[shard])
+        parts = []
+        n_candidates = 0
+        n_routed = 0
+        for tile in tiles:
+            candidate_ids, n_tile = index.candidates(tile)
+            if len(candidate_ids) == 0:
+                # no destination in range of the tile
+                continue
+            n_candidates += n_tile
+            n_routed += len(tile) * len(candidate_ids)
+            parts.append(
+                TravelTimeMatrixComputer(
+                    network,
+                    origins=origins[origins["id"].isin(tile)],
+                    destinations=destinations[
+                        destinations["id"].isin(candidate_ids)
+                    ],
+                    departure=departure,
+                    departure_time_window=departure_time_window,
+                    max_time=max_time,
+                    transport_modes=transport_modes,
+                ).compute_travel_times()
+            )
+        if logger is not None:
+            logger.debug(
+                f"OD shard {shard}: routed {len(origins)} origins in "
+                f"{len(tiles)} tiles ({n_routed} routed pairs, "
+                f"{n_candidates} candidate pairs)"
+            )
+        if len(parts) == 0:
+            # no destination in range of the shard
+            travel_times = pd.DataFrame(
+                {
+                    "from_id": origins["id"].iloc[:0],
+                    "to_id": destinations["id"].iloc[:0],
+                    "travel_time": pd.Series(dtype=float),
+                }
+            )
+        else:
+            travel_times = pd.concat(parts, ignore_index=True)
+        # unreachable pairs (null travel times) are kept, as they count
+        # towards the proximity population of the metrics
+        travel_times = _add_distance(travel_times, lonlat, max_distance)
+
+        # write to a hidden temporary file and rename, so a killed run never
+        # leaves a partial part behind
+        path = part_path(shard_dir, shard)
+        tmp_path = os.path.join(
+            shard_dir, f".{os.path.basename(path)}.tmp-{os.getpid()}"
+        )
+        write_part(travel_times, tmp_path, compact=compact)
+        os.replace(tmp_path, path)
+
+        # re-read, as other threads or processes may have updated it
+        with _ManifestLock(shard_dir):
+            manifest = read_manifest(shard_dir)
+            manifest["done"][str(shard)] = len(travel_times)
+            write_manifest(shard_dir, manifest)
+            n_done = len(manifest["done"])
+        if logger is not None:
+            logger.info(
+                f"OD shard {shard} complete ({n_done}/{len(shards)}): "
+                f"{len(travel_times)} pairs of {n_candidates} candidates"
+            )
+
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            # consume the results, so shard errors are raised
+            list(pool.map(_compute_shard, todo))
+    else:
+        for shard in todo:
+            _compute_shard(shard)
+
+    return [part_path(shard_dir, i) for i in range(len(shards))]
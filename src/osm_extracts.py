@@ -0,0 +1,325 @@
+"""OSM extract cache utilities for run.py."""
+
+import glob
+import hashlib
+import json
+import math
+import os
+
+from pathlib import Path
+from transport_performance.osm.osm_utils import filter_osm
+
+from cache import file_fingerprint, link_file
+
+# bbox of the country-level extract of an OSM input, covering all of it
+COUNTRY_BBOX = [-180.0, -90.0, 180.0, 90.0]
+
+
+def bbox_contains(outer: list, inner: list) -> bool:
+    """Check whether bbox `outer` contains bbox `inner`.
+
+    Both bboxes are in (left, bottom, right, top) order.
+    """
+    return (
+        outer[0] <= inner[0]
+        and outer[1] <= inner[1]
+        and outer[2] >= inner[2]
+        and outer[3] >= inner[3]
+    )
+
+
+def bbox_area(bbox: list) -> float:
+    """Calculate the (planar) area of a bbox in (l, b, r, t) order."""
+    return (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+
+
+def snap_bbox(bbox: list, grid_deg: float) -> list:
+    """Snap a bbox outwards onto a regular lon/lat grid."""
+    return [
+        max(-180.0, math.floor(bbox[0] / grid_deg) * grid_deg),
+        max(-90.0, math.floor(bbox[1] / grid_deg) * grid_deg),
+        min(180.0, math.ceil(bbox[2] / grid_deg) * grid_deg),
+        min(90.0, math.ceil(bbox[3] / grid_deg) * grid_deg),
+    ]
+
+
+def _extracts_dir(cache_dir: str, osm_file: Path) -> str:
+    """Get the extract directory of an OSM input version."""
+    fingerprint = json.dumps(file_fingerprint(str(osm_file)), sort_keys=True)
+    version = hashlib.sha256(fingerprint.encode()).hexdigest()[:24]
+    return os.path.join(cache_dir, "osm", version)
+
+
+def find_extract(
+    cache_dir: str, osm_file: Path, bbox: list, tag_filter: bool
+) -> dict:
+    """Find the smallest cached extract of `osm_file` containing `bbox`.
+
+    An extract can serve a request when its bbox contains `bbox` and it was
+    either filtered using the same `tag_filter`, or not tag filtered at all.
+    The country-level extract (see `country_extract()`) is not considered.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Root cache directory.
+    osm_file : Path
+        Path to the (country-level) OSM input.
+    bbox : list
+        Requested bbox in EPSG:4326, in (left, bottom, right, top) order.
+    tag_filter : bool
+        Requested `filter_osm` tag filter.
+
+    Returns
+    -------
+    dict
+        Extract metadata ("path", "bbox", "tag_filter"), or None when no
+        cached extract contains `bbox`.
+
+    """
+    extracts = []
+    for meta_path in glob.glob(
+        os.path.join(_extracts_dir(cache_dir, osm_file), "*.json")
+    ):
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        if meta.get("country", False) or not os.path.exists(meta["path"]):
+            continue
+        if meta["tag_filter"] not in (tag_filter, False):
+            continue
+        if bbox_contains(meta["bbox"], bbox):
+            extracts.append(meta)
+
+    if len(extracts) == 0:
+        return None
+    return min(extracts, key=lambda meta: bbox_area(meta["bbox"]))
+
+
+def add_extract(
+    cache_dir: str,
+    osm_file: Path,
+    bbox: list,
+    tag_filter: bool,
+    source: Path = None,
+    country: bool = False,
+) -> dict:
+    """Clip an OSM input (or an extract of it) to `bbox` and cache it.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Root cache directory.
+    osm_file : Path
+        Path to the OSM input to clip.
+    bbox : list
+        Bbox of the extract in EPSG:4326, in (left, bottom, right, top)
+        order.
+    tag_filter : bool
+        `filter_osm` tag filter of the extract.
+    source : Path, optional
+        Extract of `osm_file` to clip instead of `osm_file`, by default None.
+    country : bool, optional
+        Whether this is the country-level extract (see `country_extract()`),
+        by default False.
+
+    Returns
+    -------
+    dict
+        Extract metadata ("path", "bbox", "tag_filter", "country").
+
+    """
+    extracts_dir = _extracts_dir(cache_dir, osm_file)
+    os.makedirs(extracts_dir, exist_ok=True)
+    encoded = json.dumps([list(bbox), tag_filter]).encode()
+    name = hashlib.sha256(encoded).hexdigest()[:24]
+    path = os.path.join(extracts_dir, f"{name}.osm.pbf")
+
+    # write to temporary files and rename, so concurrent runs never see a
+    # partial extract
+    tmp_path = os.path.join(extracts_dir, f"{name}.tmp-{os.getpid()}.osm.pbf")
+    filter_osm(
+        pbf_pth=Path(source or osm_file),
+        out_pth=Path(tmp_path),
+        bbox=bbox,
+        tag_filter=tag_filter,
+    )
+    os.replace(tmp_path, path)
+
+    meta = {
+        "path": path,
+        "bbox": list(bbox),
+        "tag_filter": tag_filter,
+        "country": country,
+    }
+    meta_path = os.path.join(extracts_dir, f"{name}.json")
+    with open(f"{meta_path}.tmp-{os.getpid()}", "w") as f:
+        json.dump(meta, f)
+    os.replace(f"{meta_path}.tmp-{os.getpid()}", meta_path)
+    return meta
+
+
+def country_extract(cache_dir: str, osm_file: Path, tag_filter: bool) -> dict:
+    """Get the tag filtered country-level extract of an OSM input.
+
+    The extract covers the whole OSM input (see `COUNTRY_BBOX`), and is
+    built once per OSM input version, so later grid block extracts are
+    clipped from it rather than from the (larger) unfiltered input.
+
+    Returns
+    -------
+    dict
+        Extract metadata (see `add_extract()`), or None when `tag_filter` is
+        False, as the extract would then be the OSM input itself.
+
+    """
+    if not tag_filter:
+        return None
+    encoded = json.dumps([COUNTRY_BBOX, tag_filter]).encode()
+    name = hashlib.sha256(encoded).hexdigest()[:24]
+    meta_path = os.path.join(
+        _extracts_dir(cache_dir, osm_file), f"{name}.json"
+    )
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        if os.path.exists(meta["path"]):
+            # mark as recently used
+            os.utime(meta["path"])
+            return meta
+    return add_extract(
+        cache_dir, osm_file, COUNTRY_BBOX, tag_filter, country=True
+    )
+
+
+def evict_extracts(cache_dir: str, budget_bytes: int, keep: list) -> list:
+    """Remove the least recently used OSM extracts until within a budget.
+
+    Extracts of every OSM input version count towards the budget, so those
+    of replaced inputs are removed first.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Root cache directory.
+    budget_bytes : int
+        Maximum total size of the cached extracts.
+    keep : list
+        Paths of the extracts that must not be evicted.
+
+    Returns
+    -------
+    list
+        Paths of the evicted extracts.
+
+    """
+    keep = {os.path.normpath(p) for p in keep}
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, "osm", "*", "*.osm.pbf")):
+        if ".tmp-" in os.path.basename(path):
+            continue
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    evicted = []
+    for _, size, path in sorted(entries):
+        if total <= budget_bytes:
+            break
+        if os.path.normpath(path) in keep:
+            continue
+        # the metadata first, so the extract is never found without its file
+        meta_path = f"{path[: -len('.osm.pbf')]}.json"
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        os.remove(path)
+        total -= size
+        evicted.append(path)
+    return evicted
+
+
+def cached_filter_osm(
+    osm_file: Path,
+    out_path: Path,
+    bbox: list,
+    tag_filter: bool,
+    cache_dir: str,
+    grid_deg: float = 2.0,
+    osm_cache_gb: float = None,
+    logger=None,
+) -> Path:
+    """Crop an OSM input to a bbox, using cached extracts where possible.
+
+    The smallest cached extract containing `bbox` is re-clipped, instead of
+    the full OSM input. When no cached extract contains `bbox`, an extract
+    of `bbox` snapped outwards onto a `grid_deg` grid is cached first. With
+    `tag_filter`, this grid block is clipped from the country-level extract
+    (see `country_extract()`), so the OSM input is scanned once per OSM
+    input version. Without, there is nothing to filter the input by, and it
+    is scanned once per grid block. Extracts are evicted least recently
+    used first once they exceed `osm_cache_gb`.
+
+    Parameters
+    ----------
+    osm_file : Path
+        Path to the (country-level) OSM input.
+    out_path : Path
+        Path to write the cropped OSM to.
+    bbox : list
+        Bbox to crop to in EPSG:4326, in (left, bottom, right, top) order.
+    tag_filter : bool
+        `filter_osm` tag filter.
+    cache_dir : str
+        Root cache directory.
+    grid_deg : float, optional
+        Size of the grid (in degrees) that new cached extracts are snapped
+        to, by default 2.0.
+    osm_cache_gb : float, optional
+        Disk budget of the extract cache in GB, by default None meaning no
+        eviction.
+    logger : logging.Logger, optional
+        Logger instance, by default None.
+
+    Returns
+    -------
+    Path
+        `out_path`.
+
+    """
+    extract = find_extract(cache_dir, osm_file, bbox, tag_filter)
+    country = None
+    if extract is None:
+        coarse_bbox = snap_bbox(bbox, grid_deg)
+        country = country_extract(cache_dir, osm_file, tag_filter)
+        if logger is not None:
+            logger.info(f"Caching new OSM extract for bbox {coarse_bbox}...")
+        extract = add_extract(
+            cache_dir,
+            osm_file,
+            coarse_bbox,
+            tag_filter,
+            source=None if country is None else country["path"],
+        )
+    else:
+        # mark as recently used
+        os.utime(extract["path"])
+        if logger is not None:
+            logger.info(f"Using cached OSM extract for bbox {extract['bbox']}")
+
+    if extract["bbox"] == list(bbox) and extract["tag_filter"] == tag_filter:
+        link_file(extract["path"], str(out_path))
+    else:
+        filter_osm(
+            pbf_pth=Path(extract["path"]),
+            out_pth=out_path,
+            bbox=bbox,
+            tag_filter=tag_filter,
+        )
+
+    if osm_cache_gb is not None:
+        evict_extracts(
+            cache_dir,
+            int(osm_cache_gb * 1024**3),
+            keep=[extract["path"]]
+            + ([] if country is None else [country["path"]]),
+        )
+    return out_path
@@ -0,0 +1,170 @@
+"""Background output writer for run.py."""
+
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+# per-process sinks, keyed by number of writer threads and shared by the
+# stages running in that process
+_SINKS = {}
+_SINKS_LOCK = threading.Lock()
+
+
+class OutputSink:
+    """Bounded thread pool writing output files in the background.
+
+    Write jobs (e.g. `gdf.to_parquet`, `utils.plot`) are submitted with
+    `submit()`, which returns once the job is queued, so the caller can carry
+    on computing while outputs are serialised. At most `max_pending` jobs
+    are queued or running at once: `submit()` blocks beyond that, bounding
+    the memory held by the objects waiting to be written.
+
+    Submitted objects must not be modified by the caller afterwards. Jobs
+    are tracked per submitting thread, so concurrent analyses in one process
+    (e.g. the service) only wait for their own writes.
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of writer threads, by default 2.
+    max_pending : int, optional
+        Maximum number of queued or running jobs, by default 8.
+
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 8):
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(
+            workers, thread_name_prefix="output-sink"
+        )
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def submit(
+        self, func: Callable, *args, description: str = None, **kwargs
+    ) -> Future:
+        """Queue a write job, called as `func(*args, **kwargs)`.
+
+        Parameters
+        ----------
+        func : Callable
+            Function writing the output.
+        *args
+            Positional arguments of `func`.
+        description : str, optional
+            Description of the output (e.g. its path) used in error
+            messages, by default None meaning the function name.
+        **kwargs
+            Keyword arguments of `func`.
+
+        Returns
+        -------
+        Future
+            Future of the write job.
+
+        """
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(func, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.description = description or getattr(
+            func, "__qualname__", repr(func)
+        )
+        future.add_done_callback(lambda _: self._slots.release())
+        with self._lock:
+            self._pending.setdefault(threading.get_ident(), []).append(future)
+        return future
+
+    def take(self) -> list:
+        """Take the futures of this thread's jobs since the last call."""
+        with self._lock:
+            return self._pending.pop(threading.get_ident(), [])
+
+    def flush(self, futures: list = None, logger=None) -> None:
+        """Wait for write jobs, raising the first error.
+
+        Parameters
+        ----------
+        futures : list, optional
+            Futures to wait for, by default None meaning the jobs this thread
+            submitted since the last `take()`.
+        logger : logging.Logger, optional
+            Logger to report each failed write to, by default None.
+
+        Raises
+        ------
+        RuntimeError
+            When any write failed (chained to the first failure).
+
+        """
+        futures = self.take() if futures is None else futures
+        failed = []
+        for future in futures:
+            error = future.exception()
+            if error is None:
+                continue
+            failed.append((future.description, error))
+            if logger is not None:
+                logger.error(
+                    f"Failed to write {future.description}: {error!r}"
+                )
+        if len(failed) > 0:
+            raise RuntimeError(
+                f"{len(failed)} output write(s) failed: "
+                f"{[description for description, _ in failed]}"
+            ) from failed[0][1]
+
+    def shutdown(self) -> None:
+        """Wait for all jobs and stop the writer threads."""
+        self._pool.shutdown(wait=True)
+
+
+def get_sink(workers: int = 2) -> OutputSink:
+    """Get the output sink of this process, creating it when needed.
+
+    Sinks are kept per number of writer threads, and never replaced, so
+    concurrent analyses in one process (e.g. service jobs with different
+    "output_writers") each keep flushing the sink they submitted to.
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of writer threads of the sink, by default 2.
+
+    Returns
+    -------
+    OutputSink
+        The process' output sink with `workers` threads.
+
+    """
+    with _SINKS_LOCK:
+        if workers not in _SINKS:
+            _SINKS[workers] = OutputSink(workers, max_pending=4 * workers)
+        return _SINKS[workers]
+
+
+def write(writers: int, func: Callable, *args, **kwargs) -> None:
+    """Write an output in the background, or now when the sink is disabled.
+
+    Parameters
+    ----------
+    writers : int
+        Number of writer threads of the process' sink (see `get_sink()`),
+        i.e. the run's "output_writers". Setting 0 calls `func` immediately.
+    func : Callable
+        Function writing the output.
+    *args
+        Positional arguments of `func`.
+    **kwargs
+        Keyword arguments of `func` (and the `description` of the job).
+
+    """
+    if writers > 0:
+        get_sink(writers).submit(func, *args, **kwargs)
+        return
+    kwargs.pop("description", None)
+    func(*args, **kwargs)
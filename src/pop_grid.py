@@ -0,0 +1,261 @@
+"""Array-backed population grid for run.py."""
+
+import math
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+
+from dataclasses import dataclass
+from pyproj import Transformer
+from rasterio.features import geometry_mask
+from rasterio.transform import rowcol
+from rasterio.windows import Window
+
+# CRS of the materialised centroids, as routed by r5py (see `PopGrid`)
+CENTROID_CRS = "EPSG:4326"
+
+
+@dataclass
+class PopGrid:
+    """Population grid cells, held as arrays rather than geometries.
+
+    Cells are the (row, col) pixels of a north-up raster grid. Centroids
+    are computed on demand as coordinate arrays, and cell polygons are only
+    built by `to_gdf()`, for outputs and maps.
+
+    Attributes
+    ----------
+    transform : tuple
+        Affine transform (a, b, c, d, e, f) of the grid's pixel corners.
+    crs : str
+        CRS of the grid, as WKT.
+    rows : np.ndarray
+        Row of each cell (int32).
+    cols : np.ndarray
+        Column of each cell (int32).
+    ids : np.ndarray
+        Id of each cell (int64), unique within the grid.
+    population : np.ndarray
+        Population of each cell.
+    within_urban_centre : np.ndarray
+        Whether each cell is within the urban centre, or None when unknown.
+
+    """
+
+    transform: tuple
+    crs: str
+    rows: np.ndarray
+    cols: np.ndarray
+    ids: np.ndarray
+    population: np.ndarray
+    within_urban_centre: np.ndarray = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def centroids(self, crs: str = None) -> tuple:
+        """Get the x and y coordinate arrays of the cell centroids.
+
+        Parameters
+        ----------
+        crs : str, optional
+            CRS of the coordinates, by default None meaning the grid's CRS.
+
+        Returns
+        -------
+        tuple
+            x and y coordinates, as arrays in cell order.
+
+        """
+        a, b, c, d, e, f = self.transform
+        cols = self.cols + 0.5
+        rows = self.rows + 0.5
+        x = a * cols + b * rows + c
+        y = d * cols + e * rows + f
+        if crs is None:
+            return x, y
+        return Transformer.from_crs(self.crs, crs, always_xy=True).transform(
+            x, y
+        )
+
+    def _attributes(self) -> pd.DataFrame:
+        """Get the cell attributes, as columns of the materialised cells."""
+        attributes = pd.DataFrame(
+            {"id": self.ids, "population": self.population}
+        )
+        if self.within_urban_centre is not None:
+            attributes["within_urban_centre"] = self.within_urban_centre
+        return attributes
+
+    def centroid_gdf(self, crs: str = CENTROID_CRS) -> gpd.GeoDataFrame:
+        """Build the cell centroids GeoDataFrame (e.g. for routing).
+
+        Parameters
+        ----------
+        crs : str, optional
+            CRS of the centroids, by default `CENTROID_CRS`.
+
+        Returns
+        -------
+        gpd.GeoDataFrame
+            Centroid points, with "id", "population" and (when known)
+            "within_urban_centre" columns.
+
+        """
+        x, y = self.centroids(crs)
+        return gpd.GeoDataFrame(
+            self._attributes(), geometry=gpd.points_from_xy(x, y), crs=crs
+        )
+
+    def to_gdf(self, crs: str = None) -> gpd.GeoDataFrame:
+        """Build the cell polygons GeoDataFrame (for outputs and maps).
+
+        Parameters
+        ----------
+        crs : str, optional
+            CRS of the polygons, by default None meaning the grid's CRS.
+
+        Returns
+        -------
+        gpd.GeoDataFrame
+            Cell polygons, with "id", "population" and (when known)
+            "within_urban_centre" columns.
+
+        """
+        a, b, c, _, e, f = self.transform
+        left = a * self.cols + b * self.rows + c
+        top = e * self.rows + f
+        cells = gpd.GeoDataFrame(
+            self._attributes(),
+            geometry=shapely.box(left, top + e, left + a, top),
+            crs=self.crs,
+        )
+        return cells if crs is None else cells.to_crs(crs)
+
+    def save(self, path: str) -> str:
+        """Save the grid arrays to an .npz file (see `load()`)."""
+        arrays = {
+            "transform": np.asarray(self.transform, dtype=float),
+            "crs": np.asarray(self.crs),
+            "rows": self.rows,
+            "cols": self.cols,
+            "ids": self.ids,
+            "population": self.population,
+        }
+        if self.within_urban_centre is not None:
+            arrays["within_urban_centre"] = self.within_urban_centre
+        with open(path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        return path
+
+    @classmethod
+    def load(cls, path: str) -> "PopGrid":
+        """Load a grid saved by `save()`."""
+        with np.load(path) as arrays:
+            return cls(
+                tuple(arrays["transform"].tolist()),
+                str(arrays["crs"]),
+                arrays["rows"],
+                arrays["cols"],
+                arrays["ids"],
+                arrays["population"],
+                (
+                    arrays["within_urban_centre"]
+                    if "within_urban_centre" in arrays
+                    else None
+                ),
+            )
+
+
+def read_pop_grid(
+    pop_input: str,
+    aoi_bounds,
+    threshold: float = None,
+    urban_centre_bounds=None,
+    bounds_crs=None,
+) -> PopGrid:
+    """Read the population cells within an AOI, without building geometries.
+
+    Replaces `RasterPop.get_pop()`: only the raster window covering the AOI
+    is read, and the cells are those whose centre is within the AOI, with a
+    population of at least `threshold`.
+
+    Parameters
+    ----------
+    pop_input : str
+        Population raster (north-up).
+    aoi_bounds : shapely.Geometry
+        Area of interest.
+    threshold : float, optional
+        Minimum population of a cell, by default None meaning all cells with
+        data.
+    urban_centre_bounds : shapely.Geometry, optional
+        Urban centre, by default None. Cells whose centre is within it are
+        flagged in `within_urban_centre`.
+    bounds_crs : optional
+        CRS of `aoi_bounds` and `urban_centre_bounds`, by default None
+        meaning the raster's CRS.
+
+    Returns
+    -------
+    PopGrid
+        Population cells. Ids are the cells' row major index within the AOI
+        window.
+
+    """
+    with rasterio.open(pop_input) as src:
+        geometries = [aoi_bounds, urban_centre_bounds]
+        if bounds_crs is not None:
+            geometries = [
+                (
+                    None
+                    if g is None
+                    else gpd.GeoSeries([g], crs=bounds_crs)
+                    .to_crs(src.crs)
+                    .iloc[0]
+                )
+                for g in geometries
+            ]
+        aoi, uc = geometries
+
+        left, bottom, right, top = aoi.bounds
+        (row_start, row_stop), (col_start, col_stop) = rowcol(
+            src.transform, [left, right], [top, bottom], op=math.floor
+        )
+        row_start, col_start = max(row_start, 0), max(col_start, 0)
+        row_stop = min(row_stop + 1, src.height)
+        col_stop = min(col_stop + 1, src.width)
+        window = Window(
+            col_start, row_start, col_stop - col_start, row_stop - row_start
+        )
+        data = src.read(1, window=window, masked=True)
+        transform = src.window_transform(window)
+        crs = src.crs.to_wkt()
+
+    keep = geometry_mask(
+        [aoi], out_shape=data.shape, transform=transform, invert=True
+    )
+    keep &= ~np.ma.getmaskarray(data)
+    values = data.filled(np.nan).astype(float)
+    keep &= np.isfinite(values)
+    if threshold is not None:
+        keep &= values >= threshold
+    rows, cols = np.nonzero(keep)
+
+    within = None
+    if uc is not None:
+        within = geometry_mask(
+            [uc], out_shape=data.shape, transform=transform, invert=True
+        )[rows, cols]
+    return PopGrid(
+        tuple(transform)[:6],
+        crs,
+        rows.astype(np.int32),
+        cols.astype(np.int32),
+        (rows.astype(np.int64) * data.shape[1] + cols),
+        values[rows, cols],
+        within,
+    )
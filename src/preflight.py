@@ -0,0 +1,325 @@
+"""Fast input validation for run.py.
+
+Checks an area's config, environment variables and inputs using cheap
+header/metadata reads only, so misconfigured runs fail in seconds rather
+than after minutes of raster merging.
+"""
+
+import csv
+import glob
+import io
+import os
+import zipfile
+
+from utils import gtfs_osm_subdir_name, raster_input_files
+
+# required config values, and their allowed types ("max_time" and
+# "max_distance" may instead be listed as "max_times" and "max_distances")
+REQUIRED_CONFIG = {
+    "general": {
+        "date": str,
+        "max_time": (int, float),
+        "max_distance": (int, float),
+    },
+    "urban_centre": {"buffer_size": (int, float), "subset_regex": str},
+    "population": {"subset_regex": str, "threshold": (int, float)},
+    "osm": {"tag_filter": bool},
+    "analyse_network": {
+        "departure_hour": int,
+        "departure_minute": int,
+        "departure_time_window": (int, float),
+    },
+}
+
+# thresholds that may be listed (see `stages.analysis_thresholds()`)
+SWEEP_CONFIG = ["max_time", "max_distance"]
+
+# environment variables parsed as 0/1 flags, integers and floats
+FLAG_ENV = [
+    "EMPTY_FEED",
+    "FAST_TRAVEL",
+    "CALCULATE_SUMMARIES",
+    "BATCH_ORIG",
+    "USE_CACHE",
+    "STREAMING_METRICS",
+    "COMPACT_MAPS",
+    "ISOLATE_STAGES",
+    "COMPACT_OD",
+    "CHECK_ONLY",
+]
+INT_ENV = [
+    "GTFS_WORKERS",
+    "MAX_CONCURRENCY",
+    "OD_SHARD_SIZE",
+    "OD_WORKERS",
+    "OUTPUT_WRITERS",
+]
+FLOAT_ENV = [
+    "RASTER_CACHE_GB",
+    "NETWORK_CACHE_GB",
+    "OSM_CACHE_GB",
+    "MEMORY_CEILING_GB",
+    "STAGE_MEMORY_LIMIT_GB",
+]
+
+
+def _floats(value: str, n: int) -> list:
+    """Parse `n` comma separated floats, or return None when invalid."""
+    try:
+        values = [float(x) for x in str(value).split(",")]
+    except ValueError:
+        return None
+    return values if len(values) == n else None
+
+
+def check_config(config: dict) -> list:
+    """Check the config has the required values, of the expected types."""
+    problems = []
+    for section, keys in REQUIRED_CONFIG.items():
+        if section not in config:
+            problems.append(f"Config is missing the `[{section}]` section.")
+            continue
+        for key, types in keys.items():
+            if f"{key}s" in config[section] and key in SWEEP_CONFIG:
+                continue
+            if key not in config[section]:
+                problems.append(f"Config is missing `{section}.{key}`.")
+            elif not isinstance(config[section][key], types) or (
+                types is int and isinstance(config[section][key], bool)
+            ):
+                problems.append(
+                    f"Config `{section}.{key}` has an invalid value: "
+                    f"{config[section][key]!r}"
+                )
+
+    for key in SWEEP_CONFIG:
+        values = config.get("general", {}).get(f"{key}s")
+        if values is not None and (
+            not isinstance(values, list)
+            or len(values) == 0
+            or not all(
+                isinstance(v, (int, float))
+                and not isinstance(v, bool)
+                and v > 0
+                for v in values
+            )
+        ):
+            problems.append(
+                f"Config `general.{key}s` must be a list of positive numbers."
+            )
+
+    network = config.get("analyse_network", {})
+    for key in ["dates", "departures", "transport_modes"]:
+        if key in network and not isinstance(network[key], list):
+            problems.append(f"Config `analyse_network.{key}` must be a list.")
+    for departure in network.get("departures", []):
+        try:
+            hour, minute = (int(x) for x in str(departure).split(":"))
+            if not (0 <= hour < 24 and 0 <= minute < 60):
+                raise ValueError
+        except ValueError:
+            problems.append(f"Invalid departure (HH:MM): {departure!r}")
+    return problems
+
+
+def check_env(env: dict) -> list:
+    """Check the area environment variables can be parsed."""
+    problems = []
+    for name in ["COUNTRY_NAME", "AREA_NAME", "BBOX", "CENTRE"]:
+        if env.get(name) in (None, "None", ""):
+            problems.append(f"{name} is a required environment variable.")
+
+    bbox = _floats(env.get("BBOX"), 4)
+    if env.get("BBOX") not in (None, "None", "") and (
+        bbox is None or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]
+    ):
+        problems.append(
+            f"BBOX must be 4 comma separated numbers (min x, min y, max x, "
+            f"max y): {env.get('BBOX')!r}"
+        )
+    if (
+        env.get("CENTRE") not in (None, "None", "")
+        and _floats(env.get("CENTRE"), 2) is None
+    ):
+        problems.append(
+            f"CENTRE must be 2 comma separated numbers: {env.get('CENTRE')!r}"
+        )
+
+    for names, parse in [(FLAG_ENV, int), (INT_ENV, int), (FLOAT_ENV, float)]:
+        for name in names:
+            value = env.get(name)
+            if value is None:
+                continue
+            try:
+                parsed = parse(value)
+            except ValueError:
+                problems.append(f"{name} must be a number: {value!r}")
+                continue
+            if name in FLAG_ENV and parsed not in (0, 1):
+                problems.append(f"{name} must be 0 or 1: {value!r}")
+    return problems
+
+
+def check_raster_coverage(
+    files: list, bbox: list, bbox_crs: str, centre: list, centre_crs: str
+) -> list:
+    """Check raster tiles cover the bbox and contain the centre.
+
+    Only the raster headers (bounds and CRS) are read.
+    """
+    # imported here, so the other checks do not wait on GDAL
+    import rasterio
+
+    from rasterio.warp import transform, transform_bounds
+
+    if len(files) == 0:
+        return []
+    intersects = False
+    contains_centre = False
+    for path in files:
+        with rasterio.open(path) as src:
+            left, bottom, right, top = src.bounds
+            b_left, b_bottom, b_right, b_top = transform_bounds(
+                bbox_crs, src.crs, *bbox
+            )
+            xs, ys = transform(centre_crs, src.crs, [centre[1]], [centre[0]])
+        intersects |= (
+            b_left < right
+            and b_right > left
+            and b_bottom < top
+            and b_top > bottom
+        )
+        contains_centre |= left <= xs[0] <= right and bottom <= ys[0] <= top
+
+    problems = []
+    directory = os.path.dirname(files[0])
+    if not intersects:
+        problems.append(f"BBOX does not intersect any raster in {directory}.")
+    if not contains_centre:
+        problems.append(f"CENTRE is not within any raster in {directory}.")
+    return problems
+
+
+def gtfs_date_range(zip_path: str) -> tuple:
+    """Get the (first, last) service date of a GTFS zip.
+
+    Only `calendar.txt` and `calendar_dates.txt` are read from the zip.
+    Returns None when neither has any dates.
+    """
+    dates = []
+    with zipfile.ZipFile(zip_path) as zf:
+        names = {os.path.basename(name): name for name in zf.namelist()}
+        for file_name, columns in [
+            ("calendar.txt", ["start_date", "end_date"]),
+            ("calendar_dates.txt", ["date"]),
+        ]:
+            if file_name not in names:
+                continue
+            with zf.open(names[file_name]) as f:
+                reader = csv.DictReader(io.TextIOWrapper(f, "utf-8-sig"))
+                for row in reader:
+                    dates.extend(row[c].strip() for c in columns if row.get(c))
+    if len(dates) == 0:
+        return None
+    return min(dates), max(dates)
+
+
+def check_gtfs_dates(zip_paths: list, dates: list) -> list:
+    """Check each analysis date is within the service range of a feed."""
+    ranges = {}
+    problems = []
+    for path in zip_paths:
+        try:
+            ranges[path] = gtfs_date_range(path)
+        except (zipfile.BadZipFile, KeyError, UnicodeDecodeError) as error:
+            problems.append(f"Unable to read GTFS {path}: {error}")
+    covered = [r for r in ranges.values() if r is not None]
+    for date in dates:
+        if not any(first <= date <= last for first, last in covered):
+            extent = (
+                f"{min(r[0] for r in covered)} to {max(r[1] for r in covered)}"
+                if len(covered) > 0
+                else "no dates"
+            )
+            problems.append(
+                f"No GTFS feed runs on analysis date {date} (feeds cover "
+                f"{extent})."
+            )
+    return problems
+
+
+def preflight(config: dict, env: dict) -> list:
+    """Run all checks of an area's config, environment variables and inputs.
+
+    Parameters
+    ----------
+    config : dict
+        Config TOML values.
+    env : dict
+        Area set-up, keyed by environment variable name, including defaults.
+
+    Returns
+    -------
+    list
+        Description of each problem found (empty when all checks pass).
+
+    """
+    problems = check_config(config) + check_env(env)
+
+    try:
+        subdir = gtfs_osm_subdir_name(
+            env.get("COUNTRY_NAME"), env.get("GTFS_OSM_SUBDIR")
+        )
+    except Exception as error:
+        return problems + [str(error)]
+    osm_files = glob.glob(f"data/inputs/{subdir}/osm/*.pbf")
+    if len(osm_files) != 1:
+        problems.append(
+            f"Expected 1 OSM file in data/inputs/{subdir}/osm/, found "
+            f"{len(osm_files)}."
+        )
+    gtfs_files = sorted(glob.glob(f"data/inputs/{subdir}/gtfs/*.zip"))
+    if len(gtfs_files) == 0:
+        problems.append(f"No GTFS zips found in data/inputs/{subdir}/gtfs/.")
+
+    # later checks need a valid config and area
+    if len(problems) > 0:
+        return problems
+
+    bbox = _floats(env["BBOX"], 4)
+    centre = _floats(env["CENTRE"], 2)
+    for section, input_dir in [
+        ("urban_centre", "data/inputs/urban_centre/"),
+        ("population", "data/inputs/population/"),
+    ]:
+        files = raster_input_files(input_dir, config[section]["subset_regex"])
+        if len(files) == 0:
+            problems.append(
+                f"No rasters in {input_dir} match `{section}.subset_regex`."
+            )
+        problems += check_raster_coverage(
+            files, bbox, env["BBOX_CRS"], centre, env["CENTRE_CRS"]
+        )
+
+    dates = config["analyse_network"].get("dates", [config["general"]["date"]])
+    problems += check_gtfs_dates(gtfs_files, [str(d) for d in dates])
+    return problems
+
+
+def run_preflight(config: dict, env: dict, logger=None) -> None:
+    """Run `preflight()`, raising all problems found.
+
+    Raises
+    ------
+    ValueError
+        When any check fails, listing every problem found.
+
+    """
+    problems = preflight(config, env)
+    if len(problems) > 0:
+        raise ValueError(
+            "Preflight checks failed:\n"
+            + "\n".join(f"- {problem}" for problem in problems)
+        )
+    if logger is not None:
+        logger.info("Preflight checks passed.")
@@ -0,0 +1,139 @@
+"""Windowed raster utilities for run.py."""
+
+import math
+import os
+import rasterio
+
+from rasterio.merge import merge
+from rasterio.warp import transform_bounds
+
+from utils import raster_input_files
+
+
+def snap_bounds(bounds: tuple, origin: tuple, step: float) -> tuple:
+    """Snap bounds outwards onto a regular grid.
+
+    Parameters
+    ----------
+    bounds : tuple
+        Bounds to snap, in (left, bottom, right, top) order.
+    origin : tuple
+        (x, y) coordinate of a grid corner, e.g. a raster's top left corner.
+    step : float
+        Grid spacing, in the units of `bounds`.
+
+    Returns
+    -------
+    tuple
+        Snapped bounds, in (left, bottom, right, top) order.
+
+    """
+    x0, y0 = origin
+    left, bottom, right, top = bounds
+    return (
+        x0 + math.floor((left - x0) / step) * step,
+        y0 + math.floor((bottom - y0) / step) * step,
+        x0 + math.ceil((right - x0) / step) * step,
+        y0 + math.ceil((top - y0) / step) * step,
+    )
+
+
+def merge_raster_window(
+    input_dir: str,
+    subset_regex: str,
+    bounds: tuple,
+    output_file: str,
+    bounds_crs: str = None,
+    snap: float = None,
+) -> str:
+    """Merge only the window of the input raster tiles that covers `bounds`.
+
+    The tiles intersecting `bounds` form a virtual mosaic, from which only the
+    requested window is read. This means memory and disk I/O scale with the
+    size of `bounds` rather than the size of the tiles.
+
+    Parameters
+    ----------
+    input_dir : str
+        Directory containing the input raster (.tif) tiles.
+    subset_regex : str
+        Regex pattern used to subset the raster tiles.
+    bounds : tuple
+        Bounds of the window to read, in (left, bottom, right, top) order.
+    output_file : str
+        Path to write the merged window to (GeoTIFF).
+    bounds_crs : str, optional
+        CRS of `bounds`, by default None meaning the CRS of the tiles.
+    snap : float, optional
+        Grid spacing to snap the window outwards to, in the units of the tile
+        CRS, by default None meaning the window is snapped to the tile
+        resolution only. Use a multiple of any later resample factor, so the
+        resampled window aligns with the resampled tiles.
+
+    Returns
+    -------
+    str
+        Path to the merged window.
+
+    Raises
+    ------
+    FileNotFoundError
+        When no raster tiles match `subset_regex`.
+    ValueError
+        When none of the raster tiles intersect `bounds`.
+
+    """
+    files = raster_input_files(input_dir, subset_regex)
+    if len(files) == 0:
+        raise FileNotFoundError(
+            f"No raster files in {input_dir} match '{subset_regex}'."
+        )
+
+    datasets = [rasterio.open(f) for f in files]
+    try:
+        crs = datasets[0].crs
+        if bounds_crs is not None:
+            bounds = transform_bounds(bounds_crs, crs, *bounds)
+
+        # snap onto the tile grid, so no cells are split
+        transform = datasets[0].transform
+        bounds = snap_bounds(
+            bounds, (transform.c, transform.f), snap or transform.a
+        )
+
+        left, bottom, right, top = bounds
+        tiles = [
+            ds
+            for ds in datasets
+            if ds.bounds.left < right
+            and ds.bounds.right > left
+            and ds.bounds.bottom < top
+            and ds.bounds.top > bottom
+        ]
+        if len(tiles) == 0:
+            raise ValueError(
+                f"No raster files in {input_dir} intersect bounds {bounds}."
+            )
+
+        # only the intersecting window of each tile is read
+        mosaic, mosaic_transform = merge(tiles, bounds=bounds)
+        profile = tiles[0].profile.copy()
+    finally:
+        for ds in datasets:
+            ds.close()
+
+    for key in ["blockxsize", "blockysize", "tiled"]:
+        profile.pop(key, None)
+    profile.update(
+        driver="GTiff",
+        height=mosaic.shape[1],
+        width=mosaic.shape[2],
+        count=mosaic.shape[0],
+        transform=mosaic_transform,
+        compress="lzw",
+    )
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    with rasterio.open(output_file, "w", **profile) as dst:
+        dst.write(mosaic)
+
+    return output_file
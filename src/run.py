@@ -1,99 +1,307 @@
 """src/run.py."""
 
 import datetime
-import geopandas as gpd
-import pandas as pd
 import glob
+import multiprocessing
 import os
+import time
 import toml
 
-from shapely.geometry import box
-from transport_performance.urban_centres.raster_uc import UrbanCentre
-from transport_performance.population.rasterpop import RasterPop
-from transport_performance.gtfs.multi_validation import MultiGtfsInstance
-from transport_performance.osm.osm_utils import filter_osm
-from transport_performance.analyse_network import AnalyseNetwork
-from transport_performance.metrics import transport_performance
-from transport_performance.utils.raster import (
-    sum_resample_file,
-    merge_raster_files,
-)
-from r5py import TransportMode
 from pathlib import Path
-from copy import deepcopy
-from branca import colormap
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from instrument import write_metrics_json, write_prometheus_textfile
+from preflight import preflight, run_preflight
 from utils import (
     create_dir_structure,
     setup_logger,
-    plot,
     env_var_none_defence,
     gtfs_osm_subdir_name,
+    read_area_manifest,
 )
 
 # set the container logger name
 LOGGER_NAME = "tp-docker-analysis"
 CONFIG_PREFIX = "data/inputs/config/"
+CACHE_DIR = "data/cache/"
+
+# defaults of the optional area set-up values (matches docker-compose.yaml)
+AREA_DEFAULTS = {
+    "BBOX_CRS": "EPSG:4326",
+    "CENTRE_CRS": "EPSG:4326",
+    "BUFFER_ESTIMATION_CRS": "EPSG:27700",
+    "EMPTY_FEED": "0",
+    "FAST_TRAVEL": "1",
+    "CALCULATE_SUMMARIES": "1",
+    "BATCH_ORIG": "0",
+    "GTFS_OSM_SUBDIR": "None",
+    "USE_CACHE": "1",
+    "RASTER_CACHE_GB": "20",
+    "NETWORK_CACHE_GB": "20",
+    "OSM_CACHE_GB": "20",
+    "GTFS_WORKERS": "1",
+    "MAX_CONCURRENCY": "1",
+    "MEMORY_CEILING_GB": "0",
+    "OD_SHARD_SIZE": "0",
+    "OD_WORKERS": "1",
+    "COMPACT_OD": "0",
+    "OD_QUEUE": "None",
+    "STREAMING_METRICS": "0",
+    "COMPACT_MAPS": "0",
+    "OUTPUT_WRITERS": "0",
+    "ISOLATE_STAGES": "0",
+    "STAGE_MEMORY_LIMIT_GB": "0",
+    "CHECK_ONLY": "0",
+    "PROMETHEUS_TEXTFILE_DIR": "None",
+}
 
 
 def main():
     """Execute end-to-end analysis."""
-    # read and split out config into separate configs to minimise line lengths
-    config_file = os.path.join(CONFIG_PREFIX, os.getenv("CONFIG_FILE"))
+    batch_manifest = os.getenv("BATCH_MANIFEST")
+    if batch_manifest not in (None, "None", ""):
+        run_batch(
+            os.getenv("CONFIG_FILE"),
+            batch_manifest,
+            workers=int(os.getenv("BATCH_WORKERS", "1")),
+        )
+    else:
+        run_area(os.getenv("CONFIG_FILE"), dict(os.environ))
+
+
+def run_batch(config_file: str, manifest_file: str, workers: int = 1) -> None:
+    """Execute end-to-end analysis of several areas in one process pool.
+
+    The country-level raster inputs are merged (and resampled) once and shared
+    between all areas, and each worker process is reused across areas, so the
+    python stack and JVM are only started once per worker.
+
+    Parameters
+    ----------
+    config_file : str
+        File name of the config toml, within `CONFIG_PREFIX`.
+    manifest_file : str
+        File name of the area manifest (.toml or .csv), within
+        `CONFIG_PREFIX`. See `utils.read_area_manifest()` for the format.
+    workers : int, optional
+        Number of areas to analyse concurrently, by default 1.
+
+    Raises
+    ------
+    ValueError
+        When any area fails the preflight checks (see
+        `preflight.preflight()`). No area is analysed.
+    RuntimeError
+        When the analysis of one or more areas fails. The remaining areas are
+        still analysed.
+
+    """
+    # imported here, so preflight failures are reported without waiting on
+    # the geospatial stack
+    from stages import merge_uc_rasters, merge_pop_rasters
+
+    config = toml.load(os.path.join(CONFIG_PREFIX, config_file))
+    areas = read_area_manifest(os.path.join(CONFIG_PREFIX, manifest_file))
+
+    # check every area before merging any rasters
+    problems = []
+    for area in areas:
+        problems += [
+            f"{area.get('AREA_NAME')}: {problem}"
+            for problem in preflight(
+                config, {**AREA_DEFAULTS, **os.environ, **area}
+            )
+        ]
+    if len(problems) > 0:
+        raise ValueError(
+            "Preflight checks failed:\n"
+            + "\n".join(f"- {problem}" for problem in problems)
+        )
+    if bool(int({**AREA_DEFAULTS, **os.environ}["CHECK_ONLY"])):
+        setup_logger(f"{LOGGER_NAME}-batch").info(
+            f"Preflight checks passed for {len(areas)} areas."
+        )
+        return
+
+    dirs = create_dir_structure("batch", add_time=True)
+    logger = setup_logger(
+        f"{LOGGER_NAME}-batch",
+        file_name=os.path.join(dirs["logger_dir"], "batch_analysis.txt"),
+    )
+    logger.info(f"Analysing {len(areas)} areas from {manifest_file}")
+    logger.info(f"Using config file: {config_file}")
+    logger.info(f"Using workers: {workers}")
+
+    # merge the country-level rasters once for all areas (via the cache)
+    env = {**AREA_DEFAULTS, **os.environ}
+    raster_cache_gb = float(env["RASTER_CACHE_GB"])
+    if not bool(int(env["USE_CACHE"])) or raster_cache_gb <= 0:
+        raster_cache_gb = None
+    shared = {}
+    if not config["urban_centre"].get("windowed_read", False):
+        shared["merged_uc_file"] = merge_uc_rasters(
+            dirs,
+            config["urban_centre"],
+            logger,
+            CACHE_DIR,
+            raster_cache_gb=raster_cache_gb,
+        )
+    if not config["population"].get("windowed_read", False):
+        shared["pop_input"] = merge_pop_rasters(
+            dirs,
+            config["population"],
+            logger,
+            CACHE_DIR,
+            raster_cache_gb=raster_cache_gb,
+        )
+
+    # areas inherit the container env vars, overridden by the manifest
+    failed = []
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=mp_context) as pool:
+        futures = {
+            pool.submit(
+                run_area, config_file, {**os.environ, **area}, shared
+            ): area["AREA_NAME"]
+            for area in areas
+        }
+        for future in as_completed(futures):
+            area_name = futures[future]
+            try:
+                area_dirs = future.result()
+                logger.info(f"{area_name} complete: {area_dirs['files_dir']}")
+            except Exception:
+                logger.exception(f"{area_name} failed.")
+                failed.append(area_name)
+
+    if len(failed) > 0:
+        raise RuntimeError(f"Analysis failed for areas: {failed}")
+    logger.info(f"*** Batch analysis of {len(areas)} areas complete! ***")
+
+
+def run_area(
+    config_file: str,
+    env: dict,
+    shared: dict = None,
+    logger_name: str = LOGGER_NAME,
+    run_name: str = None,
+    config_overrides: dict = None,
+) -> dict:
+    """Execute end-to-end analysis of a single area.
+
+    The analysis stages are declared as a stage graph (see
+    `stages.build_stages()`), and independent stages run concurrently in up
+    to `MAX_CONCURRENCY` worker processes, within `MEMORY_CEILING_GB`.
+
+    Parameters
+    ----------
+    config_file : str
+        File name of the config toml, within `CONFIG_PREFIX`.
+    env : dict
+        Area set-up, keyed by environment variable name (e.g. "AREA_NAME").
+        Optional values that are missing take their docker-compose defaults.
+    shared : dict, optional
+        Paths to pre-processed inputs shared between areas, by default None
+        meaning all inputs are processed within this run. Supported keys are
+        "merged_uc_file" (merged urban centre raster) and "pop_input" (merged
+        and resampled population raster).
+    logger_name : str, optional
+        Name of the run logger, by default `LOGGER_NAME`. Concurrent runs in
+        one process (e.g. the service) need distinct names.
+    run_name : str, optional
+        Name of the run directory (before its timestamp), by default None
+        meaning the area name.
+    config_overrides : dict, optional
+        Config values overriding those of `config_file`, keyed by TOML
+        section, by default None.
+
+    Returns
+    -------
+    dict
+        Directory structure paths of this run, or None when `CHECK_ONLY` is
+        set (only the preflight checks are run).
+
+    Raises
+    ------
+    ValueError
+        When the config, environment variables or inputs fail the preflight
+        checks (see `preflight.preflight()`).
+
+    """
+    # imported here, so preflight failures are reported without waiting on
+    # the geospatial stack
+    from scheduler import run_stages
+    from stages import build_stages
+
+    shared = shared or {}
+    env = {**AREA_DEFAULTS, **env}
+
+    # read the config
+    config_file = os.path.join(CONFIG_PREFIX, config_file)
     config = toml.load(config_file)
-    general_config = config["general"]
-    uc_config = config["urban_centre"]
-    pop_config = config["population"]
-    osm_config = config["osm"]
-    analyse_net_config = config["analyse_network"]
+    for section, values in (config_overrides or {}).items():
+        config.setdefault(section, {}).update(values)
+
+    # fail fast on bad config, env vars or inputs, before any heavy work
+    run_preflight(config, env)
+    if bool(int(env.get("CHECK_ONLY"))):
+        setup_logger(logger_name).info(
+            f"Preflight checks passed for {env.get('AREA_NAME')}."
+        )
+        return None
 
     # get environmental variables
-    country_name = os.getenv("COUNTRY_NAME")
-    area_name = os.getenv("AREA_NAME")
-    bbox = [float(x) for x in os.getenv("BBOX").split(",")]
-    bbox_crs = os.getenv("BBOX_CRS")
-    centre = [float(x) for x in os.getenv("CENTRE").split(",")]
-    centre_crs = os.getenv("CENTRE_CRS")
-    buffer_estimation_crs = os.getenv("BUFFER_ESTIMATION_CRS")
-    empty_feed = bool(int(os.getenv("EMPTY_FEED")))
-    fast_travel = bool(int(os.getenv("FAST_TRAVEL")))
-    calculate_summaries = bool(int(os.getenv("CALCULATE_SUMMARIES")))
-    batch_orig = bool(int(os.getenv("BATCH_ORIG")))
-    gtfs_osm_subdir = os.getenv("GTFS_OSM_SUBDIR")
+    country_name = env.get("COUNTRY_NAME")
+    area_name = env.get("AREA_NAME")
+    bbox_crs = env.get("BBOX_CRS")
+    centre_crs = env.get("CENTRE_CRS")
+    buffer_estimation_crs = env.get("BUFFER_ESTIMATION_CRS")
+    empty_feed = bool(int(env.get("EMPTY_FEED")))
+    fast_travel = bool(int(env.get("FAST_TRAVEL")))
+    calculate_summaries = bool(int(env.get("CALCULATE_SUMMARIES")))
+    batch_orig = bool(int(env.get("BATCH_ORIG")))
+    gtfs_osm_subdir = env.get("GTFS_OSM_SUBDIR")
+    use_cache = bool(int(env.get("USE_CACHE")))
+    raster_cache_gb = float(env.get("RASTER_CACHE_GB"))
+    network_cache_gb = float(env.get("NETWORK_CACHE_GB"))
+    osm_cache_gb = float(env.get("OSM_CACHE_GB"))
+    gtfs_workers = int(env.get("GTFS_WORKERS"))
+    max_concurrency = int(env.get("MAX_CONCURRENCY"))
+    memory_ceiling_gb = float(env.get("MEMORY_CEILING_GB"))
+    od_shard_size = int(env.get("OD_SHARD_SIZE"))
+    od_workers = int(env.get("OD_WORKERS"))
+    compact_od = bool(int(env.get("COMPACT_OD")))
+    od_queue = env.get("OD_QUEUE")
+    if od_queue in ("None", ""):
+        od_queue = None
+    streaming_metrics = bool(int(env.get("STREAMING_METRICS")))
+    compact_maps = bool(int(env.get("COMPACT_MAPS")))
+    output_writers = int(env.get("OUTPUT_WRITERS"))
+    isolate_stages = bool(int(env.get("ISOLATE_STAGES")))
+    stage_memory_limit_gb = float(env.get("STAGE_MEMORY_LIMIT_GB"))
 
     # check required env vars are not None
     env_var_none_defence(country_name, "COUNTRY_NAME")
     env_var_none_defence(area_name, "AREA_NAME")
-    env_var_none_defence(bbox, "BBOX")
-    env_var_none_defence(centre, "CENTRE")
+    env_var_none_defence(env.get("BBOX"), "BBOX")
+    env_var_none_defence(env.get("CENTRE"), "CENTRE")
+    bbox = [float(x) for x in env.get("BBOX").split(",")]
+    centre = [float(x) for x in env.get("CENTRE").split(",")]
 
     # correct the gtfs osm sub directory
     gtfs_osm_subdir = gtfs_osm_subdir_name(country_name, gtfs_osm_subdir)
 
-    # immediate error handling (to fail fast)
-    # TODO: add in other immediate input error handling
-    osm_file = glob.glob(f"data/inputs/{gtfs_osm_subdir}/osm/*.pbf")
-    if len(osm_file) == 0:
-        raise FileNotFoundError("No OSM input data found.")
-    elif len(osm_file) > 1:
-        raise ValueError(
-            "Too many OSM files in input folder. Unable to determine correct "
-            "input. Remove unnecessary inputs from this directory."
-        )
-    else:
-        osm_file = Path(osm_file[0])
+    # a single OSM file (see `preflight.preflight()`)
+    osm_file = Path(glob.glob(f"data/inputs/{gtfs_osm_subdir}/osm/*.pbf")[0])
 
     # create directory structure upfront
     dirs = create_dir_structure(
-        area_name.replace(" ", "_").replace("-", "_"), add_time=True
+        (run_name or area_name).replace(" ", "_").replace("-", "_"),
+        add_time=True,
     )
 
-    logger = setup_logger(
-        LOGGER_NAME,
-        file_name=os.path.join(
-            dirs["logger_dir"], f"{area_name}_analysis.txt"
-        ),
-    )
+    log_file = os.path.join(dirs["logger_dir"], f"{area_name}_analysis.txt")
+    logger = setup_logger(logger_name, file_name=log_file)
     logger.info(f"Analysing transport performane of {area_name}")
     logger.info(f"Created analysis directory structure at {dirs['files_dir']}")
     logger.info(f"Using config file: {config_file}")
@@ -109,348 +317,131 @@ def main():
     logger.info(f"Using calculate_summaries: {calculate_summaries}")
     logger.info(f"Using batch_orig: {batch_orig}")
     logger.info(f"Using gtfs_osm_subdir: {gtfs_osm_subdir}")
-
-    logger.info("Detecting urban centre...")
-    # put bbox into a geopandas dataframe for `get_urban_centre` input
-    bbox_gdf = gpd.GeoDataFrame(geometry=[box(*bbox)], crs=bbox_crs)
-    if bbox_crs != "ESRI:54009":
-        logger.info(f"Convering bbox_gdf from {bbox_crs} to 'ESRI:54009'")
-        bbox_gdf.to_crs("ESRI:54009", inplace=True)
-
-    # merge input raster files
-    logger.info("Merging input urban centre raster files...")
-    merged_uc_file = os.path.join(
-        dirs["interim_uc"], "urban_centre_merged.tif"
-    )
-    merge_raster_files(
-        "data/inputs/urban_centre/",
-        os.path.dirname(merged_uc_file),
-        os.path.basename(merged_uc_file),
-        subset_regex=uc_config["subset_regex"],
-    )
-
-    # detect urban centre
-    uc = UrbanCentre(merged_uc_file)
-    uc_gdf = uc.get_urban_centre(
-        bbox_gdf,
-        centre=tuple(centre),
-        centre_crs=centre_crs,
-        buffer_size=uc_config["buffer_size"],
-        buffer_estimation_crs=buffer_estimation_crs,
-    )
-
-    # set the index to the label column to make filtering easier
-    uc_gdf.set_index("label", inplace=True)
-
-    # visualise outputs
-    m = uc_gdf[::-1].reset_index().explore("label", cmap="viridis")
-    uc_map_path = os.path.join(dirs["uc_outputs_dir"], "urban_centre.html")
-    m.save(uc_map_path)
-    logger.info(f"Saved urban centre map: {uc_map_path}")
-
-    uc_output_path = os.path.join(dirs["uc_outputs_dir"], "uc_gdf.parquet")
-    uc_gdf.to_parquet(uc_output_path, index=False)
-    logger.info(f"Saved urban centre output to parquet: {uc_output_path}")
-
-    logger.debug("Removing `uc` memory allocation...")
-    del uc  # remove uc memory alloc
-    logger.info("Urban centre detection complete.")
-
-    # merge input population raster files
-    logger.info("Merging input population raster files...")
-    merged_pop_file = os.path.join(
-        dirs["interim_pop"], "population_merged.tif"
-    )
-    merge_raster_files(
-        "data/inputs/population/",
-        os.path.dirname(merged_pop_file),
-        os.path.basename(merged_pop_file),
-        subset_regex=pop_config["subset_regex"],
-    )
-
-    logger.info("Resampling population data...")
-    pop_filename = os.path.basename(merged_pop_file).replace(
-        ".tif", "_resampled.tif"
-    )
-    pop_input = os.path.join(dirs["interim_pop"], pop_filename)
-    sum_resample_file(merged_pop_file, pop_input)
-
-    # extract geometries from urban centre detection
-    logger.info("Pre-process population data using detected urban centre...")
-    aoi_bounds = uc_gdf.loc["buffer"].geometry
-    urban_centre_bounds = uc_gdf.loc["vectorized_uc"].geometry
-
-    # get population data
-    rp = RasterPop(pop_input)
-    pop_gdf, centroid_gdf = rp.get_pop(
-        aoi_bounds,
-        threshold=pop_config["threshold"],
-        urban_centre_bounds=urban_centre_bounds,
-    )
-    plot_output = os.path.join(dirs["pop_outputs_dir"], "population.html")
-    plot(
-        pop_gdf,
-        column="population",
-        column_control_name="Population",
-        cmap="viridis",
-        uc_gdf=uc_gdf[0:1],
-        save=plot_output,
-    )
-    logger.info(f"Saved population map: {plot_output}")
-
-    pop_outputs_centroids = os.path.join(
-        dirs["pop_outputs_dir"], "pop_centroid.parquet"
-    )
-    rp.centroid_gdf.to_parquet(pop_outputs_centroids, index=False)
-    logger.info(
-        f"Saved population centroids to parquet: {pop_outputs_centroids}"
-    )
-
-    pop_outputs_gdf = os.path.join(dirs["pop_outputs_dir"], "pop_grid.parquet")
-    rp.pop_gdf.to_parquet(pop_outputs_gdf, index=False)
-    logger.info(f"Save population gdf to parquet: {pop_outputs_gdf}")
-
-    logger.debug("Removing `rp` memory allocation...")
-    del rp  # removing rp memory alloc
-    logger.info("Population pre-processing complete.")
-
-    logger.info("Reading GTFS inputs...")
-    gtfs = MultiGtfsInstance(f"data/inputs/{gtfs_osm_subdir}/gtfs/*.zip")
-
-    logger.info("Clipping GTFS data to urban centre bounding box...")
-    gtfs_bbox = list(uc_gdf.to_crs("EPSG:4326").loc["bbox"].geometry.bounds)
-    gtfs.filter_to_bbox(gtfs_bbox, delete_empty_feeds=empty_feed)
-
-    # display min, max, and no unique dates across all GTFS inputs
-    gtfs_dates = set()
-    for inst in gtfs.instances:
-        gtfs_dates.update(inst.feed.get_dates())
-    logger.info(
-        f"{len(gtfs_dates)} dates available between {min(gtfs_dates)} & "
-        f"{max(gtfs_dates)}."
-    )
-
-    logger.info("Validating filtered GTFS...")
-    gtfs.is_valid({"far_stops": fast_travel})
-    pre_clean_valid_path = os.path.join(
-        dirs["gtfs_outputs_dir"], "pre_clean_validity.csv"
-    )
-    gtfs.validity_df.to_csv(pre_clean_valid_path, index=False)
-    logger.info(f"Pre-cleaning validity data saved: {pre_clean_valid_path}")
-
-    logger.info("Cleaning filtered GTFS...")
-    gtfs.clean_feeds({"fast_travel": fast_travel})
-
-    logger.info("Validating filtered GTFS post cleaning...")
-    gtfs.is_valid({"far_stops": fast_travel})
-    post_clean_valid_path = os.path.join(
-        dirs["gtfs_outputs_dir"], "post_clean_validity.csv"
-    )
-    gtfs.validity_df.to_csv(post_clean_valid_path, index=False)
-    logger.info(f"Post-cleaning validity data saved: {post_clean_valid_path}")
-
-    if calculate_summaries:
-        post_clean_route_summary_path = os.path.join(
-            dirs["gtfs_outputs_dir"], "post_cleaning_routes_summary.csv"
-        )
-        route_summary = gtfs.summarise_routes(to_days=False)
-        route_summary.to_csv(post_clean_route_summary_path, index=False)
-        logger.info(
-            "Post-cleaning routes summary saved: "
-            f"{post_clean_route_summary_path}"
-        )
-
-        post_clean_trip_summary_path = os.path.join(
-            dirs["gtfs_outputs_dir"], "post_clean_trips_summary.csv"
-        )
-        trip_summary = gtfs.summarise_trips(to_days=False)
-        trip_summary.to_csv(post_clean_trip_summary_path, index=False)
-        logger.info(
-            "Post-cleaning trips summary saved: "
-            f"{post_clean_trip_summary_path}"
+    logger.info(f"Using use_cache: {use_cache}")
+    logger.info(f"Using raster_cache_gb: {raster_cache_gb}")
+    logger.info(f"Using network_cache_gb: {network_cache_gb}")
+    logger.info(f"Using osm_cache_gb: {osm_cache_gb}")
+    logger.info(f"Using gtfs_workers: {gtfs_workers}")
+    logger.info(f"Using max_concurrency: {max_concurrency}")
+    logger.info(f"Using memory_ceiling_gb: {memory_ceiling_gb}")
+    logger.info(f"Using od_shard_size: {od_shard_size}")
+    logger.info(f"Using od_workers: {od_workers}")
+    logger.info(f"Using compact_od: {compact_od}")
+    logger.info(f"Using od_queue: {od_queue}")
+    logger.info(f"Using streaming_metrics: {streaming_metrics}")
+    logger.info(f"Using compact_maps: {compact_maps}")
+    logger.info(f"Using output_writers: {output_writers}")
+    logger.info(f"Using isolate_stages: {isolate_stages}")
+    logger.info(f"Using stage_memory_limit_gb: {stage_memory_limit_gb}")
+    logger.info("Preflight checks passed.")
+
+    # the raster/network caches are disabled with the stage cache, or a zero
+    # budget. A zero OSM cache budget only disables eviction
+    if not use_cache or raster_cache_gb <= 0:
+        raster_cache_gb = None
+    if not use_cache or network_cache_gb <= 0:
+        network_cache_gb = None
+    if osm_cache_gb <= 0:
+        osm_cache_gb = None
+
+    # run context passed to each stage (must be picklable, for the workers)
+    ctx = {
+        "config": config,
+        "dirs": dirs,
+        "shared": shared,
+        "logger_name": logger_name,
+        "log_file": log_file,
+        "cache_dir": CACHE_DIR,
+        "country_name": country_name,
+        "area_name": area_name,
+        "bbox": bbox,
+        "bbox_crs": bbox_crs,
+        "centre": centre,
+        "centre_crs": centre_crs,
+        "buffer_estimation_crs": buffer_estimation_crs,
+        "empty_feed": empty_feed,
+        "fast_travel": fast_travel,
+        "calculate_summaries": calculate_summaries,
+        "batch_orig": batch_orig,
+        "use_cache": use_cache,
+        "raster_cache_gb": raster_cache_gb,
+        "network_cache_gb": network_cache_gb,
+        "osm_cache_gb": osm_cache_gb,
+        "gtfs_workers": gtfs_workers,
+        "od_shard_size": od_shard_size,
+        "od_workers": od_workers,
+        "compact_od": compact_od,
+        "od_queue": od_queue,
+        "streaming_metrics": streaming_metrics,
+        "compact_maps": compact_maps,
+        "output_writers": output_writers,
+        "stage_memory_limit_gb": stage_memory_limit_gb,
+        "osm_file": osm_file,
+        "gtfs_path": f"data/inputs/{gtfs_osm_subdir}/gtfs/*.zip",
+        "filtered_osm_path": Path(
+            os.path.join(dirs["interim_osm"], "filtered.osm.pbf")
+        ),
+    }
+    stage_metrics = []
+    started_at = datetime.datetime.now().isoformat()
+    start = time.perf_counter()
+    status = "failed"
+    try:
+        run_stages(
+            build_stages(ctx),
+            ctx,
+            max_workers=max_concurrency,
+            memory_ceiling_gb=(
+                memory_ceiling_gb if memory_ceiling_gb > 0 else None
+            ),
+            cache_dir=CACHE_DIR if use_cache else None,
+            metrics=stage_metrics,
+            isolate=isolate_stages,
         )
-    else:
-        logger.warning(
-            "`CALCULATE_SUMMARIES`=False, route/trip summaries were skipped."
+        status = "complete"
+    finally:
+        # written for failed runs too, to see where they failed
+        _write_run_metrics(
+            dirs,
+            {
+                "area_name": area_name,
+                "country_name": country_name,
+                "status": status,
+                "started_at": started_at,
+                "wall_s": round(time.perf_counter() - start, 3),
+                "max_concurrency": max_concurrency,
+            },
+            stage_metrics,
+            env.get("PROMETHEUS_TEXTFILE_DIR"),
+            logger,
         )
 
-    # TODO: remove when fix is implemented
-    # some GTFS do not have stop_code (optional column in GTFS) and this limits
-    # `viz_stop`. This creates a dummy `stop_code` column that duplicates the
-    # `stop_id` data for the purposes of plotting. Create a copy to prevent
-    # working on the original (prevents saving edited data later)
-    viz_gtfs = deepcopy(gtfs)
-    for inst in viz_gtfs.instances:
-        if "stop_code" not in inst.feed.stops.columns:
-            inst.feed.stops["stop_code"] = inst.feed.stops["stop_id"]
-
-    stops_map_path = os.path.join(dirs["gtfs_outputs_dir"], "stops.html")
-    viz_gtfs.viz_stops(stops_map_path, return_viz=False)
-    logger.info(f"Post-cleaning stops map saved: {stops_map_path}")
-
-    logger.info("Writing cleaned GTFS to file...")
-    gtfs.filter_to_date(general_config["date"], delete_empty_feeds=empty_feed)
-
-    # manually create a synthetic calendar.txt for R5PY to detect valid dates
-    for inst in gtfs.instances:
-        if inst.feed.calendar is None:
-            logger.warning("Creating a synthetic calendar.txt...")
-            # get unique service ids from calendar_dates.txt
-            calendar_df = pd.DataFrame(
-                inst.feed.calendar_dates.service_id.unique(),
-                columns=["service_id"],
-            )
-
-            # set all days to zero - allow calendar_dates to control schedule
-            calendar_df.loc[:, "monday"] = 0
-            calendar_df.loc[:, "tuesday"] = 0
-            calendar_df.loc[:, "wednesday"] = 0
-            calendar_df.loc[:, "thursday"] = 0
-            calendar_df.loc[:, "friday"] = 0
-            calendar_df.loc[:, "saturday"] = 0
-            calendar_df.loc[:, "sunday"] = 0
-
-            # set start/end date to be either side of analysis date
-            date_dt = datetime.datetime.strptime(
-                general_config["date"], "%Y%m%d"
-            )
-            calendar_df.loc[:, "start_date"] = (
-                date_dt - datetime.timedelta(days=1)
-            ).strftime("%Y%m%d")
-            calendar_df.loc[:, "end_date"] = (
-                date_dt + datetime.timedelta(days=1)
-            ).strftime("%Y%m%d")
-
-            inst.feed.calendar = calendar_df
-
-    gtfs.save_feeds(dirs["interim_gtfs"])
-    logger.debug("Removing `gtfs` memory allocation...")
-    del gtfs  # remove gtfs memory alloc
-    del viz_gtfs  # remove viz_gtfs alloc TODO: remove when fix is implemented
-    logger.info("GTFS processing complete.")
-
-    logger.info("Cropping OSM input to urban centre BBOX...")
-    osm_bbox = list(uc_gdf.to_crs("EPSG:4326").loc["bbox"].geometry.bounds)
-    filtered_osm_path = Path(
-        os.path.join(dirs["interim_osm"], "filtered.osm.pbf")
-    )
-    filter_osm(
-        pbf_pth=osm_file,
-        out_pth=filtered_osm_path,
-        bbox=osm_bbox,
-        tag_filter=osm_config["tag_filter"],
-    )
-    logger.info("OSM cropping complete.")
-
-    logger.info("Building transport network...")
-    gtfs_filtered_paths = glob.glob(f"{dirs['interim_gtfs']}/*.zip")
-    an = AnalyseNetwork(
-        centroid_gdf,
-        filtered_osm_path,
-        gtfs_filtered_paths,
-        dirs["an_outputs_dir"],
-    )
-
-    logger.info("Calculating OD matrix...")
-    analysis_dt = datetime.datetime.strptime(general_config["date"], "%Y%m%d")
-    an.od_matrix(
-        batch_orig=batch_orig,
-        distance=general_config["max_distance"],
-        departure=datetime.datetime(
-            analysis_dt.year,
-            analysis_dt.month,
-            analysis_dt.day,
-            analyse_net_config["departure_hour"],
-            analyse_net_config["departure_minute"],
-        ),
-        departure_time_window=datetime.timedelta(
-            hours=analyse_net_config["departure_time_window"],
-        ),
-        max_time=datetime.timedelta(
-            minutes=general_config["max_time"],
-        ),
-        transport_modes=[TransportMode.TRANSIT],
-    )
-    logger.info(f"OD matrix written to: {dirs['an_outputs_dir']}")
-    logger.debug("Removing `an` memory allocation...")
-    del an  # remove an memory alloc
-    logger.info("Transport network analysis complete.")
-
-    logger.info("Calculating the transport performance...")
-    tp_df, stats_df = transport_performance(
-        dirs["an_outputs_dir"],
-        centroid_gdf,
-        pop_gdf,
-        travel_time_threshold=general_config["max_time"],
-        distance_threshold=general_config["max_distance"],
-        urban_centre_name=area_name.title(),
-        urban_centre_country=country_name.title(),
-        urban_centre_gdf=uc_gdf.reset_index(),
-    )
-    logger.info("Transport performance calculated. Saving output files...")
-    suffix = (
-        f"{area_name}_{general_config['date']}_public_transit_"
-        f"{general_config['max_time']}"
-    )
-    tp_plot_path = os.path.join(
-        dirs["metrics_outputs_dir"], f"transport_performance_{suffix}.html"
-    )
-    tp_plot_const_cmap_path = os.path.join(
-        dirs["metrics_outputs_dir"],
-        f"transport_performance_const_cmap_{suffix}.html",
-    )
-    tp_output_path = os.path.join(
-        dirs["metrics_outputs_dir"], f"transport_performance_{suffix}.parquet"
-    )
-    tp_stats_path = os.path.join(
-        dirs["metrics_outputs_dir"],
-        f"transport_performance_stats_{suffix}.csv",
-    )
-    plot(
-        tp_df,
-        column="transport_performance",
-        column_control_name="Transport Performance",
-        uc_gdf=uc_gdf[0:1],
-        cmap="viridis",
-        caption="Transport Performance (%)",
-        save=tp_plot_path,
-    )
-    const_cmap = colormap.LinearColormap(
-        colors=[
-            "#440154",
-            "#414487",
-            "#2A788E",
-            "#22A884",
-            "#7AD151",
-            "#FDE725",
-        ],
-        vmin=0,
-        vmax=100,
-        max_labels=11,
-        tick_labels=list(range(0, 110, 10)),
-    )
-    plot(
-        tp_df,
-        column="transport_performance",
-        column_control_name="Transport Performance",
-        uc_gdf=uc_gdf[0:1],
-        cmap=const_cmap,
-        caption="Transport Performance (%)",
-        save=tp_plot_const_cmap_path,
-    )
-    stats_df.to_csv(tp_stats_path, index=False)
-    tp_df.to_parquet(tp_output_path, index=False)
-    logger.info(f"Transport performance map saved: {tp_plot_path}")
-    logger.info(
-        "Transport performance map (constant cmap) saved: "
-        f"{tp_plot_const_cmap_path}"
-    )
-    logger.info(f"Transport performance stats saved: {tp_stats_path}")
-    logger.info(f"Transport performance parquet saved: {tp_output_path}")
-
     logger.info(
         f"*** Transport performance analysis of {area_name} " "complete! ***"
     )
+    return dirs
+
+
+def _write_run_metrics(
+    dirs: dict,
+    run: dict,
+    stage_metrics: list,
+    prometheus_dir: str,
+    logger,
+) -> None:
+    """Write metrics.json, and the Prometheus textfile when enabled."""
+    metrics_path = write_metrics_json(
+        os.path.join(dirs["logger_dir"], "metrics.json"), run, stage_metrics
+    )
+    logger.info(f"Run metrics saved: {metrics_path}")
+    if prometheus_dir not in (None, "None", ""):
+        area = run["area_name"].replace(" ", "_").replace("-", "_")
+        prom_path = write_prometheus_textfile(
+            os.path.join(prometheus_dir, f"tp_analysis_{area}.prom"),
+            {"area": run["area_name"], "country": run["country_name"]},
+            stage_metrics,
+        )
+        logger.info(f"Prometheus textfile saved: {prom_path}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,363 @@
+"""Dependency-aware stage scheduler for run.py."""
+
+import logging
+import multiprocessing
+import time
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, field
+from typing import Callable
+
+from cache import restore_stage, store_stage
+from instrument import StageMonitor, kill_tree, measure_record, tree_rss_bytes
+from output_sink import get_sink
+from utils import setup_logger
+
+
+@dataclass
+class Stage:
+    """An analysis stage in the stage graph.
+
+    Attributes
+    ----------
+    name : str
+        Unique name of the stage.
+    func : Callable
+        Stage function, called as `func(ctx, inputs)` where `inputs` maps the
+        names of `deps` to their return values. Must be a module level
+        function (or a `functools.partial` of one), so it can run in a worker
+        process.
+    deps : list
+        Names of the stages this stage depends on.
+    memory_gb : float
+        Estimated peak memory of the stage, in GB. Used to keep concurrently
+        running stages within the memory ceiling.
+    key : str
+        Stage cache key (see `cache.stage_key()`), or None to never cache.
+    cache_dirs : dict
+        Mapping of artifact label to run directory holding stage artifacts.
+    load : Callable
+        Function called as `load(ctx)` to reload the stage's return value
+        after restoring it from the cache, or None when the stage returns
+        None.
+    memory_limit_gb : float
+        Maximum RSS of the stage's process tree, in GB, or None for no
+        limit. Only enforced when stages run isolated (see `run_stages()`).
+
+    """
+
+    name: str
+    func: Callable
+    deps: list = field(default_factory=list)
+    memory_gb: float = 0.0
+    key: str = None
+    cache_dirs: dict = None
+    load: Callable = None
+    memory_limit_gb: float = None
+
+
+def _execute(stage: str, func: Callable, ctx: dict, inputs: dict) -> tuple:
+    """Run a stage function in a worker process, logging to the run log.
+
+    Background output writes of the stage are flushed before returning.
+    Returns the stage's return value and its `instrument.StageMonitor`
+    record.
+    """
+    logger = setup_logger(ctx["logger_name"], file_name=ctx.get("log_file"))
+    with StageMonitor(stage) as monitor:
+        result = func(ctx, inputs)
+        if ctx.get("output_writers", 0) > 0:
+            get_sink(ctx["output_writers"]).flush(logger=logger)
+    return result, monitor.record
+
+
+def _child(conn, stage: str, func: Callable, ctx: dict, inputs: dict):
+    """Run a stage in an isolated child process, sending back the outcome."""
+    try:
+        conn.send(("ok", _execute(stage, func, ctx, inputs)))
+    except BaseException as error:
+        logging.getLogger(ctx["logger_name"]).exception(
+            f"`{stage}` stage failed"
+        )
+        try:
+            conn.send(("error", error))
+        except Exception:
+            # the exception can not be pickled
+            conn.send(("error", RuntimeError(repr(error))))
+    finally:
+        conn.close()
+
+
+def _run_isolated(
+    stage: Stage, ctx: dict, inputs: dict, interval: float = 0.5
+) -> tuple:
+    """Run a stage in a new child process, enforcing its memory limit.
+
+    The child exits once the stage completes, so all of its memory
+    (including any JVM started by r5py) is returned to the OS. Returns the
+    stage's return value and its `instrument.StageMonitor` record.
+
+    Raises
+    ------
+    MemoryError
+        When the RSS of the child's process tree exceeds the stage's
+        `memory_limit_gb`. The process tree is killed.
+    RuntimeError
+        When the child exits without a result (e.g. killed by the OOM
+        killer).
+
+    """
+    mp_context = multiprocessing.get_context("spawn")
+    receiver, sender = mp_context.Pipe(duplex=False)
+    process = mp_context.Process(
+        target=_child,
+        args=(sender, stage.name, stage.func, ctx, inputs),
+        name=f"stage-{stage.name}",
+    )
+    process.start()
+    sender.close()
+
+    limit_bytes = None
+    if stage.memory_limit_gb:
+        limit_bytes = stage.memory_limit_gb * 1024**3
+    try:
+        while not receiver.poll(interval):
+            if not process.is_alive():
+                break
+            if limit_bytes is None:
+                continue
+            rss = tree_rss_bytes(process.pid)
+            if rss > limit_bytes:
+                kill_tree(process.pid)
+                raise MemoryError(
+                    f"`{stage.name}` stage exceeded its memory limit of "
+                    f"{stage.memory_limit_gb} GB (RSS {rss / 1024**3:.2f} GB)"
+                    " and was stopped. Increase the limit using the "
+                    "`STAGE_MEMORY_LIMIT_GB` environment variable or the "
+                    "`[stage_memory_limit_gb]` config section."
+                )
+        if not receiver.poll():
+            process.join()
+            raise RuntimeError(
+                f"`{stage.name}` stage process exited with code "
+                f"{process.exitcode} before completing (a negative code is "
+                "the signal that killed it, e.g. -9 from the OOM killer)."
+            )
+        status, payload = receiver.recv()
+    finally:
+        receiver.close()
+        process.join()
+    if status == "error":
+        raise payload
+    return payload
+
+
+def run_stages(
+    stages: list,
+    ctx: dict,
+    max_workers: int = 1,
+    memory_ceiling_gb: float = None,
+    cache_dir: str = None,
+    metrics: list = None,
+    isolate: bool = False,
+) -> dict:
+    """Run a stage graph, running independent stages concurrently.
+
+    A stage starts once all of its dependencies have completed, at most
+    `max_workers` stages run at once, and a stage is held back while the
+    estimated memory of the running stages plus its own would exceed
+    `memory_ceiling_gb` (unless nothing else is running). With `max_workers`
+    set to 1, stages run one after another in the current process.
+
+    With `isolate` set, every stage instead runs in its own short-lived
+    child process (see `_run_isolated()`), which exits once the stage
+    completes. Only the stage inputs and return values are exchanged with
+    this process, so memory released by a stage is returned to the OS, and
+    each stage's `memory_limit_gb` is enforced.
+
+    When the context's "output_writers" is above 0, stages queue their
+    output files on the process' `output_sink.OutputSink`. Stages running
+    in the current process then return while their outputs are written, and
+    are only stored in the stage cache once those writes complete. All
+    writes are complete (or raised) when this returns.
+
+    Parameters
+    ----------
+    stages : list
+        `Stage` instances, in their preferred run order.
+    ctx : dict
+        Run context passed to every stage function. Must be picklable when
+        `max_workers` is greater than 1, and contain the "logger_name" (and
+        optionally "log_file") of the run logger.
+    max_workers : int, optional
+        Maximum number of concurrently running stages, by default 1.
+    memory_ceiling_gb : float, optional
+        Maximum total estimated memory of concurrently running stages, by
+        default None meaning no ceiling.
+    cache_dir : str, optional
+        Root stage cache directory, by default None meaning the stage cache
+        is not used.
+    metrics : list, optional
+        List to append the timing and resource record of each stage to (see
+        `instrument.measure_record()`), by default None meaning the records
+        are discarded. Records are appended in completion order, including
+        for failed stages.
+    isolate : bool, optional
+        Whether to run each stage in its own child process, by default
+        False.
+
+    Returns
+    -------
+    dict
+        Return value of each stage, keyed by stage name.
+
+    Raises
+    ------
+    ValueError
+        When a stage depends on an unknown stage, or the stage graph has a
+        cycle.
+
+    """
+    logger = logging.getLogger(ctx["logger_name"])
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        missing = set(stage.deps) - names
+        if len(missing) > 0:
+            raise ValueError(f"`{stage.name}` depends on unknown {missing}.")
+
+    pending = list(stages)
+    running = {}
+    results = {}
+    metrics = [] if metrics is None else metrics
+    # (stage, futures) of completed stages with queued output writes
+    writing = []
+    sink = None
+    if ctx.get("output_writers", 0) > 0:
+        sink = get_sink(ctx["output_writers"])
+
+    def _restore(stage: Stage) -> bool:
+        if cache_dir is None or stage.key is None:
+            return False
+        start = time.perf_counter()
+        if not restore_stage(
+            cache_dir, stage.name, stage.key, stage.cache_dirs
+        ):
+            return False
+        logger.info(f"Restored `{stage.name}` stage from cache: {stage.key}")
+        results[stage.name] = stage.load(ctx) if stage.load else None
+        metrics.append(
+            measure_record(
+                stage.name, "cached", wall_s=time.perf_counter() - start
+            )
+        )
+        return True
+
+    def _run_inline(stage: Stage, inputs: dict):
+        monitor = StageMonitor(stage.name)
+        try:
+            with monitor:
+                return stage.func(ctx, inputs)
+        finally:
+            metrics.append(monitor.record)
+
+    def _store(stage: Stage) -> None:
+        if cache_dir is not None and stage.key is not None:
+            store_stage(cache_dir, stage.name, stage.key, stage.cache_dirs)
+            logger.info(f"Stored `{stage.name}` stage in cache: {stage.key}")
+
+    def _complete(stage: Stage, result, futures: list = None) -> None:
+        results[stage.name] = result
+        if futures:
+            writing.append((stage, futures))
+        else:
+            _store(stage)
+
+    def _flush_writes(block: bool = False) -> None:
+        for stage, futures in list(writing):
+            if not block and not all(f.done() for f in futures):
+                continue
+            writing.remove((stage, futures))
+            sink.flush(futures, logger=logger)
+            _store(stage)
+
+    pool = None
+    if isolate:
+        # threads waiting on (and watching) one child process per stage
+        pool = ThreadPoolExecutor(max_workers)
+    elif max_workers > 1:
+        pool = ProcessPoolExecutor(
+            max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            _flush_writes()
+            started = False
+            for stage in list(pending):
+                if not all(dep in results for dep in stage.deps):
+                    continue
+                if _restore(stage):
+                    pending.remove(stage)
+                    started = True
+                    continue
+
+                inputs = {dep: results[dep] for dep in stage.deps}
+                if pool is None:
+                    pending.remove(stage)
+                    result = _run_inline(stage, inputs)
+                    _complete(stage, result, sink.take() if sink else None)
+                    started = True
+                    continue
+
+                # hold back stages exceeding the concurrency/memory limits
+                running_gb = sum(s.memory_gb for s in running.values())
+                if len(running) >= max_workers:
+                    break
+                if (
+                    memory_ceiling_gb is not None
+                    and len(running) > 0
+                    and running_gb + stage.memory_gb > memory_ceiling_gb
+                ):
+                    continue
+                logger.info(f"Starting `{stage.name}` stage in a worker...")
+                if isolate:
+                    future = pool.submit(_run_isolated, stage, ctx, inputs)
+                else:
+                    future = pool.submit(
+                        _execute, stage.name, stage.func, ctx, inputs
+                    )
+                running[future] = stage
+                pending.remove(stage)
+                started = True
+
+            if started:
+                continue
+            if len(running) == 0:
+                raise ValueError(
+                    "Unable to schedule stages (cyclic dependencies): "
+                    f"{[stage.name for stage in pending]}"
+                )
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    result, record = future.result()
+                except Exception:
+                    metrics.append(measure_record(stage.name, "failed"))
+                    raise
+                metrics.append(record)
+                _complete(stage, result)
+        _flush_writes(block=True)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+        # never leave writes running behind a failed run
+        if sink is not None:
+            wait([f for _, futures in writing for f in futures] + sink.take())
+
+    return results
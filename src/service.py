@@ -0,0 +1,371 @@
+"""Long-lived analysis service.
+
+Keeps the python stack, the JVM and recently used transport networks warm,
+and runs area analyses submitted over a local HTTP API from a job queue.
+
+Usage (from the repo root, or within the docker image)::
+
+    python src/service.py --port 8765 --workers 1
+
+Endpoints:
+
+- `POST /jobs`: submit a job. The JSON body has "env" (area set-up, keyed by
+  environment variable name as for `run.py`, limited to `JOB_ENV`), and
+  optionally "config_file" (file name within `data/inputs/config/`) and
+  "config" (values overriding the config TOML, keyed by section).
+- `GET /jobs`: list all jobs.
+- `GET /jobs/<id>`: get the status of a job.
+- `GET /jobs/<id>/outputs`: list the output files of a job.
+- `GET /health`: get the number of queued and running jobs.
+
+"""
+
+import argparse
+import datetime
+import json
+import os
+import queue
+import re
+import threading
+import toml
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from networks import set_memo_size
+from preflight import preflight
+from run import AREA_DEFAULTS, CONFIG_PREFIX, LOGGER_NAME, run_area
+from utils import close_logger, setup_logger
+
+SERVICE_DEFAULTS = {
+    "SERVICE_HOST": "127.0.0.1",
+    "SERVICE_PORT": "8765",
+    "SERVICE_WORKERS": "1",
+    "SERVICE_JOB_HISTORY": "1000",
+    "NETWORK_MEMO_SIZE": "2",
+}
+
+# environment variables a job must set (see `run.run_area()`)
+REQUIRED_ENV = ["COUNTRY_NAME", "AREA_NAME", "BBOX", "CENTRE"]
+# environment variables a job may set. The others (e.g. paths such as
+# `OD_QUEUE`, `GTFS_OSM_SUBDIR` and `PROMETHEUS_TEXTFILE_DIR`, and resource
+# limits) are those of the service
+JOB_ENV = REQUIRED_ENV + [
+    "BBOX_CRS",
+    "CENTRE_CRS",
+    "BUFFER_ESTIMATION_CRS",
+    "EMPTY_FEED",
+    "FAST_TRAVEL",
+    "CALCULATE_SUMMARIES",
+    "BATCH_ORIG",
+    "OD_SHARD_SIZE",
+    "COMPACT_OD",
+    "STREAMING_METRICS",
+    "COMPACT_MAPS",
+    "CHECK_ONLY",
+]
+# job values used in input and run directory names, which must match
+# `NAME_PATTERN` (so cannot point outside `data/`)
+NAME_ENV = ["COUNTRY_NAME", "AREA_NAME"]
+NAME_PATTERN = re.compile(r"[\w -]+")
+
+
+class JobQueue:
+    """Queue of analysis jobs, run by a pool of worker threads.
+
+    Each job runs `run.run_area()` in this process, with its own logger and
+    run directory, so concurrent jobs do not share log handlers or outputs.
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of jobs run concurrently, by default 1.
+    logger : logging.Logger, optional
+        Service logger, by default None.
+    history : int, optional
+        Number of finished (complete or failed) jobs kept, by default 1000.
+        The records of older finished jobs are removed.
+
+    """
+
+    def __init__(self, workers: int = 1, logger=None, history: int = 1000):
+        self.logger = logger
+        self.history = history
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"job-worker-{i}")
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, request: dict) -> dict:
+        """Validate and queue a job request, returning the job status.
+
+        Raises
+        ------
+        ValueError
+            When the request is missing required values, sets environment
+            variables other than `JOB_ENV`, has names not matching
+            `NAME_PATTERN`, its config file is not within `CONFIG_PREFIX` or
+            does not exist, or it fails the preflight checks (see
+            `preflight.preflight()`).
+
+        """
+        env = request.get("env", {})
+        if not isinstance(env, dict):
+            raise ValueError("`env` must be an object.")
+        missing = [name for name in REQUIRED_ENV if not env.get(name)]
+        if len(missing) > 0:
+            raise ValueError(f"`env` is missing required values: {missing}")
+        not_allowed = set(env) - set(JOB_ENV)
+        if len(not_allowed) > 0:
+            raise ValueError(
+                f"`env` has values jobs cannot set: {sorted(not_allowed)}"
+            )
+        for name in NAME_ENV:
+            if not NAME_PATTERN.fullmatch(str(env[name])):
+                raise ValueError(
+                    f"`{name}` may only hold letters, digits, spaces, `_` "
+                    "and `-`."
+                )
+        config_file = request.get(
+            "config_file", os.getenv("CONFIG_FILE", "default_config.toml")
+        )
+        config_prefix = os.path.realpath(CONFIG_PREFIX)
+        config_path = os.path.realpath(
+            os.path.join(CONFIG_PREFIX, str(config_file))
+        )
+        if os.path.commonpath([config_prefix, config_path]) != config_prefix:
+            raise ValueError(
+                f"Config file must be within {CONFIG_PREFIX}: {config_file}"
+            )
+        if not os.path.isfile(config_path):
+            raise ValueError(f"Config file not found: {config_file}")
+        config = request.get("config", {})
+        if not isinstance(config, dict) or not all(
+            isinstance(values, dict) for values in config.values()
+        ):
+            raise ValueError("`config` must be an object of TOML sections.")
+        merged = toml.load(os.path.join(CONFIG_PREFIX, config_file))
+        for section, values in config.items():
+            merged.setdefault(section, {}).update(values)
+        problems = preflight(
+            merged,
+            {
+                **AREA_DEFAULTS,
+                **os.environ,
+                **{name: str(value) for name, value in env.items()},
+            },
+        )
+        if len(problems) > 0:
+            raise ValueError(f"Preflight checks failed: {problems}")
+
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "status": "queued",
+            "config_file": config_file,
+            "config": config,
+            "env": {name: str(value) for name, value in env.items()},
+            "submitted_at": datetime.datetime.now().isoformat(),
+            "started_at": None,
+            "finished_at": None,
+            "error": None,
+            "outputs": None,
+        }
+        with self._lock:
+            self._jobs[job["id"]] = job
+            status = dict(job)
+        self._queue.put(job["id"])
+        if self.logger is not None:
+            self.logger.info(
+                f"Queued job {job['id']}: {job['env']['AREA_NAME']}"
+            )
+        return status
+
+    def get(self, job_id: str) -> dict:
+        """Get the status of a job, or None when it does not exist."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def list(self) -> list:
+        """Get the status of all jobs, in submission order."""
+        with self._lock:
+            return [dict(job) for job in self._jobs.values()]
+
+    def counts(self) -> dict:
+        """Count the jobs of each status."""
+        counts = {}
+        for job in self.list():
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return counts
+
+    def _update(self, job_id: str, **values) -> None:
+        with self._lock:
+            self._jobs[job_id].update(values)
+
+    def _expire(self) -> None:
+        """Remove the oldest finished jobs beyond `history`."""
+        with self._lock:
+            finished = [
+                job_id
+                for job_id, job in self._jobs.items()
+                if job["status"] in ("complete", "failed")
+            ]
+            for job_id in finished[: max(len(finished) - self.history, 0)]:
+                del self._jobs[job_id]
+
+    def _work(self) -> None:
+        while True:
+            job = self.get(self._queue.get())
+            self._update(
+                job["id"],
+                status="running",
+                started_at=datetime.datetime.now().isoformat(),
+            )
+            logger_name = f"{LOGGER_NAME}-{job['id']}"
+            try:
+                # job values override the service's own environment
+                dirs = run_area(
+                    job["config_file"],
+                    {**os.environ, **job["env"]},
+                    logger_name=logger_name,
+                    run_name=f"{job['env']['AREA_NAME']}_{job['id']}",
+                    config_overrides=job["config"],
+                )
+                self._update(job["id"], status="complete", outputs=dirs)
+            except Exception as error:
+                if self.logger is not None:
+                    self.logger.exception(f"Job {job['id']} failed.")
+                self._update(
+                    job["id"],
+                    status="failed",
+                    error=f"{type(error).__name__}: {error}",
+                )
+            finally:
+                # close the job's log file, as the service outlives the job
+                close_logger(logger_name)
+                self._update(
+                    job["id"], finished_at=datetime.datetime.now().isoformat()
+                )
+                self._expire()
+                self._queue.task_done()
+
+
+def _output_files(job: dict) -> list:
+    """List the output files of a completed job."""
+    files = []
+    outputs_dir = job["outputs"]["outputs_dir"]
+    for root, _, names in os.walk(outputs_dir):
+        files.extend(os.path.join(root, name) for name in sorted(names))
+    return sorted(files)
+
+
+def make_handler(jobs: JobQueue, logger=None) -> type:
+    """Build the HTTP request handler class of a job queue."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code: int, body) -> None:
+            payload = json.dumps(body, indent=2, default=str).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self) -> None:
+            parts = [p for p in self.path.split("?")[0].split("/") if p]
+            if parts == ["health"]:
+                self._send(200, {"status": "ok", "jobs": jobs.counts()})
+            elif parts == ["jobs"]:
+                self._send(200, jobs.list())
+            elif len(parts) in (2, 3) and parts[0] == "jobs":
+                job = jobs.get(parts[1])
+                if job is None:
+                    self._send(404, {"error": f"Unknown job: {parts[1]}"})
+                elif len(parts) == 2:
+                    self._send(200, job)
+                elif parts[2] != "outputs":
+                    self._send(404, {"error": f"Unknown path: {self.path}"})
+                elif job["outputs"] is None:
+                    self._send(
+                        409, {**job, "error": f"Job is {job['status']}"}
+                    )
+                else:
+                    self._send(
+                        200, {"id": job["id"], "files": _output_files(job)}
+                    )
+            else:
+                self._send(404, {"error": f"Unknown path: {self.path}"})
+
+        def do_POST(self) -> None:
+            if self.path.rstrip("/") != "/jobs":
+                self._send(404, {"error": f"Unknown path: {self.path}"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(request, dict):
+                    raise ValueError("The request body must be an object.")
+                self._send(202, jobs.submit(request))
+            except ValueError as error:
+                # includes JSON decoding errors
+                self._send(400, {"error": str(error)})
+
+        def log_message(self, format: str, *args) -> None:
+            if logger is not None:
+                logger.debug(format % args)
+
+    return Handler
+
+
+def main(argv: list = None) -> None:
+    """Run the analysis service until interrupted."""
+    env = {**SERVICE_DEFAULTS, **os.environ}
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default=env["SERVICE_HOST"])
+    parser.add_argument("--port", type=int, default=int(env["SERVICE_PORT"]))
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(env["SERVICE_WORKERS"]),
+        help="number of jobs run concurrently",
+    )
+    parser.add_argument(
+        "--job-history",
+        type=int,
+        default=int(env["SERVICE_JOB_HISTORY"]),
+        help="number of finished jobs kept",
+    )
+    parser.add_argument(
+        "--network-memo",
+        type=int,
+        default=int(env["NETWORK_MEMO_SIZE"]),
+        help="number of transport networks kept in memory",
+    )
+    args = parser.parse_args(argv)
+
+    logger = setup_logger(f"{LOGGER_NAME}-service")
+    set_memo_size(args.network_memo)
+    jobs = JobQueue(args.workers, logger, history=args.job_history)
+    server = ThreadingHTTPServer(
+        (args.host, args.port), make_handler(jobs, logger)
+    )
+    logger.info(
+        f"Serving on http://{args.host}:{args.port} with {args.workers} "
+        f"worker(s) and {args.network_memo} network(s) kept in memory"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping service...")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
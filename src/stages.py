@@ -0,0 +1,1382 @@
+"""Pipeline stages of run.py, declared as a stage graph."""
+
+import datetime
+import functools
+import geopandas as gpd
+import pandas as pd
+import glob
+import hashlib
+import itertools
+import logging
+import numpy as np
+import os
+
+from shapely.geometry import box
+from typing import Union
+from transport_performance.urban_centres.raster_uc import UrbanCentre
+from transport_performance.gtfs.multi_validation import MultiGtfsInstance
+from transport_performance.osm.osm_utils import filter_osm
+from transport_performance.metrics import transport_performance
+from transport_performance.utils.raster import (
+    sum_resample_file,
+    merge_raster_files,
+)
+from branca import colormap
+
+from gtfs_feeds import (
+    add_synthetic_calendar,
+    gtfs_cache_key,
+    process_feeds_parallel,
+    combine_validity,
+    combine_stops_views,
+    combine_summaries,
+)
+from osm_extracts import cached_filter_osm
+from pop_grid import PopGrid, read_pop_grid
+from output_sink import get_sink, write
+from rasters import merge_raster_window
+from scheduler import Stage
+from streaming_metrics import streaming_threshold_performance, CENTROID_CRS
+from utils import plot, raster_input_files, gtfs_stops_view, compact_layer
+from cache import (
+    stage_key,
+    cached_file,
+    link_file,
+    restore_stage,
+    store_stage,
+)
+
+# factor the population rasters are sum resampled by (100 m to 1 km cells)
+RESAMPLE_FACTOR = 10
+
+# grid spacing (m) windowed raster reads are snapped to, so the resampled
+# window aligns with the resampled country-level raster
+WINDOW_SNAP = 1000
+
+# estimated peak memory (GB) of each stage, used by the scheduler to keep
+# concurrent stages within `MEMORY_CEILING_GB`. Override these using the
+# optional `[stage_memory_gb]` config TOML section.
+STAGE_MEMORY_GB = {
+    "urban_centre": 2.0,
+    "population": 4.0,
+    "gtfs": 4.0,
+    "osm": 1.0,
+    "analyse_network": 8.0,
+    "metrics": 2.0,
+}
+
+
+def build_stages(ctx: dict) -> list:
+    """Declare the stage graph of an area analysis.
+
+    Population processing, GTFS processing and OSM cropping only depend on
+    the urban centre, so can run concurrently. The OD matrix joins on all
+    three, and the metrics follow the OD matrix.
+
+    Parameters
+    ----------
+    ctx : dict
+        Run context of the area, as built by `run.run_area()`.
+
+    Returns
+    -------
+    list
+        `scheduler.Stage` instances, in their serial run order.
+
+    """
+    config = ctx["config"]
+    dirs = ctx["dirs"]
+    memory_gb = {**STAGE_MEMORY_GB, **config.get("stage_memory_gb", {})}
+    # memory limits (GB) of isolated stage processes, 0 meaning no limit
+    memory_limit_gb = {
+        name: config.get("stage_memory_limit_gb", {}).get(
+            name, ctx["stage_memory_limit_gb"]
+        )
+        or None
+        for name in STAGE_MEMORY_GB
+    }
+
+    uc_key = stage_key(
+        "urban_centre",
+        files=raster_input_files(
+            "data/inputs/urban_centre/",
+            config["urban_centre"]["subset_regex"],
+        ),
+        config=config["urban_centre"],
+        env={
+            "bbox": ctx["bbox"],
+            "bbox_crs": ctx["bbox_crs"],
+            "centre": ctx["centre"],
+            "centre_crs": ctx["centre_crs"],
+            "buffer_estimation_crs": ctx["buffer_estimation_crs"],
+            "compact_maps": ctx["compact_maps"],
+        },
+    )
+    pop_key = stage_key(
+        "population",
+        files=raster_input_files(
+            "data/inputs/population/", config["population"]["subset_regex"]
+        ),
+        config=config["population"],
+        env={"compact_maps": ctx["compact_maps"]},
+        upstream=[uc_key],
+        # 2: array population grid (see `pop_grid.PopGrid`)
+        version=2,
+    )
+    gtfs_key = stage_key(
+        "gtfs",
+        files=glob.glob(ctx["gtfs_path"]),
+        config={"date": scenario_dates(config)},
+        env={
+            "empty_feed": ctx["empty_feed"],
+            "fast_travel": ctx["fast_travel"],
+            "calculate_summaries": ctx["calculate_summaries"],
+        },
+        upstream=[uc_key],
+        # 2: parallel runs draw the `viz_stops` stops map
+        version=2,
+    )
+    osm_key = stage_key(
+        "osm",
+        files=[ctx["osm_file"]],
+        config=config["osm"],
+        upstream=[uc_key],
+    )
+    # the OD matrix only depends on the largest thresholds, so adding
+    # smaller thresholds reuses it
+    od_max_time, od_max_distance = od_thresholds(config)
+    od_key = stage_key(
+        "analyse_network",
+        config={
+            "general": {
+                "date": config["general"]["date"],
+                "max_time": od_max_time,
+                "max_distance": od_max_distance,
+            },
+            "network": config["analyse_network"],
+        },
+        env={
+            "batch_orig": ctx["batch_orig"],
+            "od_shard_size": ctx["od_shard_size"],
+            "compact_od": ctx["compact_od"],
+            "od_queue": ctx["od_queue"] is not None,
+        },
+        upstream=[pop_key, gtfs_key, osm_key],
+        # 2: shards keep the unreachable pairs within the maximum distance
+        # 3: every OD matrix is calculated in shards
+        version=3,
+    )
+    # shards persist in the cache between runs, so a killed run can resume
+    od_shard_dir = None
+    if ctx["use_cache"]:
+        od_shard_dir = os.path.join(ctx["cache_dir"], "od_shards", od_key)
+    metrics_key = stage_key(
+        "metrics",
+        config=config["general"],
+        env={
+            "area_name": ctx["area_name"],
+            "country_name": ctx["country_name"],
+            "streaming_metrics": ctx["streaming_metrics"],
+            "compact_maps": ctx["compact_maps"],
+        },
+        upstream=[uc_key, pop_key, od_key],
+    )
+
+    return [
+        Stage(
+            "urban_centre",
+            detect_urban_centre,
+            memory_gb=memory_gb["urban_centre"],
+            memory_limit_gb=memory_limit_gb["urban_centre"],
+            key=uc_key,
+            cache_dirs={"outputs": dirs["uc_outputs_dir"]},
+            load=load_urban_centre,
+        ),
+        Stage(
+            "population",
+            process_population,
+            deps=["urban_centre"],
+            memory_gb=memory_gb["population"],
+            memory_limit_gb=memory_limit_gb["population"],
+            key=pop_key,
+            cache_dirs={"outputs": dirs["pop_outputs_dir"]},
+            load=load_population,
+        ),
+        Stage(
+            "gtfs",
+            process_gtfs,
+            deps=["urban_centre"],
+            memory_gb=memory_gb["gtfs"],
+            memory_limit_gb=memory_limit_gb["gtfs"],
+            key=gtfs_key,
+            cache_dirs={
+                "interim": dirs["interim_gtfs"],
+                "outputs": dirs["gtfs_outputs_dir"],
+            },
+        ),
+        Stage(
+            "osm",
+            crop_osm,
+            deps=["urban_centre"],
+            memory_gb=memory_gb["osm"],
+            memory_limit_gb=memory_limit_gb["osm"],
+            key=osm_key,
+            cache_dirs={"interim": dirs["interim_osm"]},
+        ),
+        Stage(
+            "analyse_network",
+            functools.partial(od_matrix, shard_dir=od_shard_dir),
+            deps=["population", "gtfs", "osm"],
+            memory_gb=memory_gb["analyse_network"],
+            memory_limit_gb=memory_limit_gb["analyse_network"],
+            key=od_key,
+            cache_dirs={"outputs": dirs["an_outputs_dir"]},
+        ),
+        Stage(
+            "metrics",
+            calculate_metrics,
+            deps=["urban_centre", "population", "analyse_network"],
+            memory_gb=memory_gb["metrics"],
+            memory_limit_gb=memory_limit_gb["metrics"],
+            key=metrics_key,
+            cache_dirs={"outputs": dirs["metrics_outputs_dir"]},
+        ),
+    ]
+
+
+def _merged_raster_key(input_dir: str, subset_regex: str) -> str:
+    """Build the raster cache key of a merged raster."""
+    return stage_key(
+        "merge_raster",
+        files=raster_input_files(input_dir, subset_regex),
+        config={"subset_regex": subset_regex},
+    )
+
+
+def _merge_rasters(
+    input_dir: str,
+    subset_regex: str,
+    merged_file: str,
+    cache_dir: str,
+    raster_cache_gb: float = None,
+) -> str:
+    """Merge input rasters, reusing the raster cache when enabled.
+
+    When `raster_cache_gb` is None the rasters are merged directly into
+    `merged_file`. Otherwise the merged raster is taken from (or added to) the
+    raster cache, keyed by the input file set and `subset_regex`, and linked
+    to `merged_file`.
+    """
+    if raster_cache_gb is None:
+        merge_raster_files(
+            input_dir,
+            os.path.dirname(merged_file),
+            os.path.basename(merged_file),
+            subset_regex=subset_regex,
+        )
+        return merged_file
+
+    cached = cached_file(
+        cache_dir,
+        "rasters",
+        _merged_raster_key(input_dir, subset_regex),
+        lambda path: merge_raster_files(
+            input_dir,
+            os.path.dirname(path),
+            os.path.basename(path),
+            subset_regex=subset_regex,
+        ),
+        suffix=".tif",
+        budget_bytes=int(raster_cache_gb * 1024**3),
+    )
+    return link_file(cached, merged_file)
+
+
+def _resample_raster(
+    merged_file: str,
+    resampled_file: str,
+    merged_key: str,
+    cache_dir: str,
+    raster_cache_gb: float = None,
+) -> str:
+    """Sum resample a raster, reusing the raster cache when enabled.
+
+    The cache key is built from the merged raster's key (see
+    `_merged_raster_key()`) and the resampling parameters (and, as every
+    stage key, the transport_performance version).
+    """
+    if raster_cache_gb is None:
+        sum_resample_file(
+            merged_file, resampled_file, resample_factor=RESAMPLE_FACTOR
+        )
+        return resampled_file
+
+    key = stage_key(
+        "sum_resample",
+        config={"resample_factor": RESAMPLE_FACTOR},
+        upstream=[merged_key],
+    )
+    cached = cached_file(
+        cache_dir,
+        "rasters",
+        key,
+        lambda path: sum_resample_file(
+            merged_file, path, resample_factor=RESAMPLE_FACTOR
+        ),
+        suffix=".tif",
+        budget_bytes=int(raster_cache_gb * 1024**3),
+    )
+    return link_file(cached, resampled_file)
+
+
+def merge_uc_rasters(
+    dirs: dict,
+    uc_config: dict,
+    logger,
+    cache_dir: str,
+    raster_cache_gb: float = None,
+) -> str:
+    """Merge the urban centre input rasters into the interim directory."""
+    logger.info("Merging input urban centre raster files...")
+    merged_uc_file = os.path.join(
+        dirs["interim_uc"], "urban_centre_merged.tif"
+    )
+    return _merge_rasters(
+        "data/inputs/urban_centre/",
+        uc_config["subset_regex"],
+        merged_uc_file,
+        cache_dir,
+        raster_cache_gb=raster_cache_gb,
+    )
+
+
+def merge_pop_rasters(
+    dirs: dict,
+    pop_config: dict,
+    logger,
+    cache_dir: str,
+    raster_cache_gb: float = None,
+) -> str:
+    """Merge and resample the population input rasters into interim."""
+    logger.info("Merging input population raster files...")
+    merged_pop_file = os.path.join(
+        dirs["interim_pop"], "population_merged.tif"
+    )
+    _merge_rasters(
+        "data/inputs/population/",
+        pop_config["subset_regex"],
+        merged_pop_file,
+        cache_dir,
+        raster_cache_gb=raster_cache_gb,
+    )
+
+    logger.info("Resampling population data...")
+    pop_filename = os.path.basename(merged_pop_file).replace(
+        ".tif", "_resampled.tif"
+    )
+    pop_input = os.path.join(dirs["interim_pop"], pop_filename)
+    return _resample_raster(
+        merged_pop_file,
+        pop_input,
+        _merged_raster_key(
+            "data/inputs/population/", pop_config["subset_regex"]
+        ),
+        cache_dir,
+        raster_cache_gb=raster_cache_gb,
+    )
+
+
+def _window_pop_raster(
+    dirs: dict, pop_config: dict, uc_gdf: gpd.GeoDataFrame, logger
+) -> str:
+    """Read and resample only the population raster window within the AOI."""
+    logger.info("Reading population raster window within AOI bbox...")
+    window_file = os.path.join(dirs["interim_pop"], "population_window.tif")
+    merge_raster_window(
+        "data/inputs/population/",
+        pop_config["subset_regex"],
+        tuple(uc_gdf.loc[["bbox"]].total_bounds),
+        window_file,
+        bounds_crs=uc_gdf.crs,
+        snap=WINDOW_SNAP,
+    )
+
+    logger.info("Resampling population data window...")
+    pop_input = window_file.replace(".tif", "_resampled.tif")
+    sum_resample_file(window_file, pop_input, resample_factor=RESAMPLE_FACTOR)
+    return pop_input
+
+
+def detect_urban_centre(ctx: dict, inputs: dict) -> gpd.GeoDataFrame:
+    """Detect the urban centre and save its outputs.
+
+    The shared "merged_uc_file" (see `run.run_batch()`) is used when set.
+    Otherwise the input rasters are merged into this run's interim directory
+    (via the raster cache, unless "raster_cache_gb" is None).
+    """
+    logger = logging.getLogger(ctx["logger_name"])
+    dirs = ctx["dirs"]
+    uc_config = ctx["config"]["urban_centre"]
+    bbox_crs = ctx["bbox_crs"]
+    merged_uc_file = ctx["shared"].get("merged_uc_file")
+    logger.info("Detecting urban centre...")
+
+    # put bbox into a geopandas dataframe for `get_urban_centre` input
+    bbox_gdf = gpd.GeoDataFrame(geometry=[box(*ctx["bbox"])], crs=bbox_crs)
+    if bbox_crs != "ESRI:54009":
+        logger.info(f"Convering bbox_gdf from {bbox_crs} to 'ESRI:54009'")
+        bbox_gdf.to_crs("ESRI:54009", inplace=True)
+
+    if uc_config.get("windowed_read", False):
+        logger.info("Reading urban centre raster window within bbox...")
+        merged_uc_file = merge_raster_window(
+            "data/inputs/urban_centre/",
+            uc_config["subset_regex"],
+            tuple(bbox_gdf.total_bounds),
+            os.path.join(dirs["interim_uc"], "urban_centre_window.tif"),
+            bounds_crs=bbox_gdf.crs,
+        )
+    elif merged_uc_file is None:
+        merged_uc_file = merge_uc_rasters(
+            dirs,
+            uc_config,
+            logger,
+            ctx["cache_dir"],
+            raster_cache_gb=ctx["raster_cache_gb"],
+        )
+    else:
+        logger.info(f"Using shared urban centre raster: {merged_uc_file}")
+
+    # detect urban centre
+    uc = UrbanCentre(merged_uc_file)
+    uc_gdf = uc.get_urban_centre(
+        bbox_gdf,
+        centre=tuple(ctx["centre"]),
+        centre_crs=ctx["centre_crs"],
+        buffer_size=uc_config["buffer_size"],
+        buffer_estimation_crs=ctx["buffer_estimation_crs"],
+    )
+
+    # set the index to the label column to make filtering easier
+    uc_gdf.set_index("label", inplace=True)
+
+    # visualise outputs
+    uc_map_gdf = uc_gdf[::-1].reset_index()
+    if ctx["compact_maps"]:
+        uc_map_gdf = compact_layer(uc_map_gdf, "label")
+    m = uc_map_gdf.explore("label", cmap="viridis")
+    uc_map_path = os.path.join(dirs["uc_outputs_dir"], "urban_centre.html")
+    write(ctx["output_writers"], m.save, uc_map_path, description=uc_map_path)
+    logger.info(f"Saved urban centre map: {uc_map_path}")
+
+    # keep the label column, so the output can be reloaded with its index
+    uc_output_path = os.path.join(dirs["uc_outputs_dir"], "uc_gdf.parquet")
+    write(
+        ctx["output_writers"],
+        uc_gdf.reset_index().to_parquet,
+        uc_output_path,
+        index=False,
+        description=uc_output_path,
+    )
+    logger.info(f"Saved urban centre output to parquet: {uc_output_path}")
+
+    logger.debug("Removing `uc` memory allocation...")
+    del uc  # remove uc memory alloc
+    logger.info("Urban centre detection complete.")
+    return uc_gdf
+
+
+def load_urban_centre(ctx: dict) -> gpd.GeoDataFrame:
+    """Reload the urban centre saved by a previous run."""
+    return gpd.read_parquet(
+        os.path.join(ctx["dirs"]["uc_outputs_dir"], "uc_gdf.parquet")
+    ).set_index("label")
+
+
+def process_population(ctx: dict, inputs: dict) -> PopGrid:
+    """Merge, resample and clip the population data and save its outputs.
+
+    The shared "pop_input" (see `run.run_batch()`) is used when set.
+    Otherwise the input rasters are merged and resampled into this run's
+    interim directory (via the raster cache, unless "raster_cache_gb" is
+    None). The population grid is returned as arrays (see
+    `pop_grid.PopGrid`), and only built as polygons for the outputs.
+    """
+    logger = logging.getLogger(ctx["logger_name"])
+    dirs = ctx["dirs"]
+    pop_config = ctx["config"]["population"]
+    uc_gdf = inputs["urban_centre"]
+    pop_input = ctx["shared"].get("pop_input")
+
+    if pop_config.get("windowed_read", False):
+        pop_input = _window_pop_raster(dirs, pop_config, uc_gdf, logger)
+    elif pop_input is None:
+        pop_input = merge_pop_rasters(
+            dirs,
+            pop_config,
+            logger,
+            ctx["cache_dir"],
+            raster_cache_gb=ctx["raster_cache_gb"],
+        )
+    else:
+        logger.info(f"Using shared population raster: {pop_input}")
+
+    # extract geometries from urban centre detection
+    logger.info("Pre-process population data using detected urban centre...")
+    aoi_bounds = uc_gdf.loc["buffer"].geometry
+    urban_centre_bounds = uc_gdf.loc["vectorized_uc"].geometry
+
+    # get population data
+    grid = read_pop_grid(
+        pop_input,
+        aoi_bounds,
+        threshold=pop_config["threshold"],
+        urban_centre_bounds=urban_centre_bounds,
+        bounds_crs=uc_gdf.crs,
+    )
+    logger.info(f"Read {len(grid)} population cells.")
+    pop_gdf = grid.to_gdf()
+    plot_output = os.path.join(dirs["pop_outputs_dir"], "population.html")
+    write(
+        ctx["output_writers"],
+        plot,
+        (
+            compact_layer(pop_gdf, "population")
+            if ctx["compact_maps"]
+            else pop_gdf
+        ),
+        column="population",
+        column_control_name="Population",
+        cmap="viridis",
+        uc_gdf=uc_gdf[0:1],
+        save=plot_output,
+        description=plot_output,
+    )
+    logger.info(f"Saved population map: {plot_output}")
+
+    pop_outputs_centroids = os.path.join(
+        dirs["pop_outputs_dir"], "pop_centroid.parquet"
+    )
+    write(
+        ctx["output_writers"],
+        grid.centroid_gdf().to_parquet,
+        pop_outputs_centroids,
+        index=False,
+        description=pop_outputs_centroids,
+    )
+    logger.info(
+        f"Saved population centroids to parquet: {pop_outputs_centroids}"
+    )
+
+    pop_outputs_gdf = os.path.join(dirs["pop_outputs_dir"], "pop_grid.parquet")
+    write(
+        ctx["output_writers"],
+        pop_gdf.to_parquet,
+        pop_outputs_gdf,
+        index=False,
+        description=pop_outputs_gdf,
+    )
+    logger.info(f"Save population gdf to parquet: {pop_outputs_gdf}")
+
+    # the arrays are reloaded by later stages of cached runs
+    pop_outputs_grid = os.path.join(dirs["pop_outputs_dir"], "pop_grid.npz")
+    grid.save(pop_outputs_grid)
+    logger.info(f"Saved population grid arrays: {pop_outputs_grid}")
+
+    logger.debug("Removing `pop_gdf` memory allocation...")
+    del pop_gdf  # removing pop_gdf memory alloc
+    logger.info("Population pre-processing complete.")
+    return grid
+
+
+def load_population(ctx: dict) -> PopGrid:
+    """Reload the population grid saved by a previous run."""
+    return PopGrid.load(
+        os.path.join(ctx["dirs"]["pop_outputs_dir"], "pop_grid.npz")
+    )
+
+
+def process_gtfs(ctx: dict, inputs: dict) -> None:
+    """Clip, validate, clean and date filter GTFS and save its outputs.
+
+    When "gtfs_workers" is greater than 1, each feed is processed
+    independently in a process pool (see `_process_gtfs_parallel()`).
+
+    When "use_cache" is True, the cleaned GTFS and outputs are cached by
+    feed content, bbox, dates and cleaning flags (see
+    `gtfs_feeds.gtfs_cache_key()`), per feed when processed in parallel.
+    Unlike the stage cache, this is reused across areas sharing a bbox and
+    across copies of the same feeds.
+    """
+    logger = logging.getLogger(ctx["logger_name"])
+    dirs = ctx["dirs"]
+    date = scenario_dates(ctx["config"])
+    empty_feed = ctx["empty_feed"]
+    fast_travel = ctx["fast_travel"]
+    calculate_summaries = ctx["calculate_summaries"]
+    uc_gdf = inputs["urban_centre"]
+
+    gtfs_bbox = list(uc_gdf.to_crs("EPSG:4326").loc["bbox"].geometry.bounds)
+    feed_paths = sorted(glob.glob(ctx["gtfs_path"]))
+    cache_dir = ctx["cache_dir"] if ctx["use_cache"] else None
+    if ctx["gtfs_workers"] > 1:
+        _process_gtfs_parallel(
+            dirs,
+            feed_paths,
+            gtfs_bbox,
+            date,
+            empty_feed,
+            fast_travel,
+            calculate_summaries,
+            ctx["gtfs_workers"],
+            logger,
+            output_writers=ctx["output_writers"],
+            cache_dir=cache_dir,
+        )
+        logger.info("GTFS processing complete.")
+        return
+
+    gtfs_dirs = {
+        "interim": dirs["interim_gtfs"],
+        "outputs": dirs["gtfs_outputs_dir"],
+    }
+    if cache_dir is not None:
+        gtfs_key = gtfs_cache_key(
+            feed_paths,
+            gtfs_bbox,
+            date,
+            empty_feed,
+            fast_travel,
+            calculate_summaries,
+            cache_dir=cache_dir,
+        )
+        if restore_stage(cache_dir, "gtfs_clean", gtfs_key, gtfs_dirs):
+            logger.info(f"Restored cleaned GTFS from cache: {gtfs_key}")
+            return
+
+    logger.info("Reading GTFS inputs...")
+    gtfs = MultiGtfsInstance(ctx["gtfs_path"])
+
+    logger.info("Clipping GTFS data to urban centre bounding box...")
+    gtfs.filter_to_bbox(gtfs_bbox, delete_empty_feeds=empty_feed)
+
+    # display min, max, and no unique dates across all GTFS inputs
+    gtfs_dates = set()
+    for inst in gtfs.instances:
+        gtfs_dates.update(inst.feed.get_dates())
+    logger.info(
+        f"{len(gtfs_dates)} dates available between {min(gtfs_dates)} & "
+        f"{max(gtfs_dates)}."
+    )
+
+    logger.info("Validating filtered GTFS...")
+    gtfs.is_valid({"far_stops": fast_travel})
+    pre_clean_valid_path = os.path.join(
+        dirs["gtfs_outputs_dir"], "pre_clean_validity.csv"
+    )
+    write(
+        ctx["output_writers"],
+        gtfs.validity_df.copy().to_csv,
+        pre_clean_valid_path,
+        index=False,
+        description=pre_clean_valid_path,
+    )
+    logger.info(f"Pre-cleaning validity data saved: {pre_clean_valid_path}")
+
+    logger.info("Cleaning filtered GTFS...")
+    gtfs.clean_feeds({"fast_travel": fast_travel})
+
+    logger.info("Validating filtered GTFS post cleaning...")
+    gtfs.is_valid({"far_stops": fast_travel})
+    post_clean_valid_path = os.path.join(
+        dirs["gtfs_outputs_dir"], "post_clean_validity.csv"
+    )
+    write(
+        ctx["output_writers"],
+        gtfs.validity_df.copy().to_csv,
+        post_clean_valid_path,
+        index=False,
+        description=post_clean_valid_path,
+    )
+    logger.info(f"Post-cleaning validity data saved: {post_clean_valid_path}")
+
+    if calculate_summaries:
+        post_clean_route_summary_path = os.path.join(
+            dirs["gtfs_outputs_dir"], "post_cleaning_routes_summary.csv"
+        )
+        route_summary = gtfs.summarise_routes(to_days=False)
+        write(
+            ctx["output_writers"],
+            route_summary.to_csv,
+            post_clean_route_summary_path,
+            index=False,
+            description=post_clean_route_summary_path,
+        )
+        logger.info(
+            "Post-cleaning routes summary saved: "
+            f"{post_clean_route_summary_path}"
+        )
+
+        post_clean_trip_summary_path = os.path.join(
+            dirs["gtfs_outputs_dir"], "post_clean_trips_summary.csv"
+        )
+        trip_summary = gtfs.summarise_trips(to_days=False)
+        write(
+            ctx["output_writers"],
+            trip_summary.to_csv,
+            post_clean_trip_summary_path,
+            index=False,
+            description=post_clean_trip_summary_path,
+        )
+        logger.info(
+            "Post-cleaning trips summary saved: "
+            f"{post_clean_trip_summary_path}"
+        )
+    else:
+        logger.warning(
+            "`CALCULATE_SUMMARIES`=False, route/trip summaries were skipped."
+        )
+
+    # TODO: remove when fix is implemented
+    # some GTFS do not have stop_code (optional column in GTFS) and this limits
+    # `viz_stop`. This creates a dummy `stop_code` column that duplicates the
+    # `stop_id` data for the purposes of plotting. A stops-only view is used
+    # to prevent working on the original (prevents saving edited data later)
+    viz_gtfs = gtfs_stops_view(gtfs)
+
+    stops_map_path = os.path.join(dirs["gtfs_outputs_dir"], "stops.html")
+    write(
+        ctx["output_writers"],
+        viz_gtfs.viz_stops,
+        stops_map_path,
+        return_viz=False,
+        description=stops_map_path,
+    )
+    del viz_gtfs  # remove viz_gtfs view TODO: remove when fix is implemented
+    logger.info(f"Post-cleaning stops map saved: {stops_map_path}")
+
+    logger.info("Writing cleaned GTFS to file...")
+    gtfs.filter_to_date(date, delete_empty_feeds=empty_feed)
+
+    # manually create a synthetic calendar.txt for R5PY to detect valid dates
+    add_synthetic_calendar(gtfs, date, logger)
+
+    gtfs.save_feeds(dirs["interim_gtfs"])
+    logger.debug("Removing `gtfs` memory allocation...")
+    del gtfs  # remove gtfs memory alloc
+
+    if cache_dir is not None:
+        # the outputs must be complete before they are cached
+        if ctx["output_writers"] > 0:
+            get_sink(ctx["output_writers"]).flush(logger=logger)
+        store_stage(cache_dir, "gtfs_clean", gtfs_key, gtfs_dirs)
+        logger.info(f"Stored cleaned GTFS in cache: {gtfs_key}")
+    logger.info("GTFS processing complete.")
+
+
+def _process_gtfs_parallel(
+    dirs: dict,
+    feed_paths: list,
+    gtfs_bbox: list,
+    date: Union[str, list],
+    empty_feed: bool,
+    fast_travel: bool,
+    calculate_summaries: bool,
+    workers: int,
+    logger,
+    output_writers: int = 0,
+    cache_dir: str = None,
+) -> None:
+    """Process each GTFS feed in a process pool and merge their outputs."""
+    logger.info(
+        f"Processing {len(feed_paths)} GTFS feeds using {workers} workers..."
+    )
+    results = process_feeds_parallel(
+        feed_paths,
+        dirs["interim_gtfs"],
+        gtfs_bbox,
+        date,
+        empty_feed,
+        fast_travel,
+        calculate_summaries,
+        workers,
+        cache_dir=cache_dir,
+    )
+    results = [r for r in results if r["stops_view"] is not None]
+    if len(results) == 0:
+        raise ValueError("All GTFS feeds are empty after filtering.")
+
+    # display min, max, and no unique dates across all GTFS inputs
+    gtfs_dates = set()
+    for result in results:
+        gtfs_dates.update(result["dates"])
+    logger.info(
+        f"{len(gtfs_dates)} dates available between {min(gtfs_dates)} & "
+        f"{max(gtfs_dates)}."
+    )
+
+    for key, name in [
+        ("pre_clean_validity", "Pre-cleaning validity data"),
+        ("post_clean_validity", "Post-cleaning validity data"),
+    ]:
+        path = os.path.join(dirs["gtfs_outputs_dir"], f"{key}.csv")
+        write(
+            output_writers,
+            combine_validity(results, key).to_csv,
+            path,
+            index=False,
+            description=path,
+        )
+        logger.info(f"{name} saved: {path}")
+
+    if calculate_summaries:
+        for key, file_name in [
+            ("route_summary", "post_cleaning_routes_summary.csv"),
+            ("trip_summary", "post_clean_trips_summary.csv"),
+        ]:
+            path = os.path.join(dirs["gtfs_outputs_dir"], file_name)
+            write(
+                output_writers,
+                combine_summaries(results, key).to_csv,
+                path,
+                index=False,
+                description=path,
+            )
+            logger.info(f"Post-cleaning {key.replace('_', ' ')} saved: {path}")
+    else:
+        logger.warning(
+            "`CALCULATE_SUMMARIES`=False, route/trip summaries were skipped."
+        )
+
+    # same rendering as the serial path, from the per-feed stops views
+    viz_gtfs = combine_stops_views(results)
+    stops_map_path = os.path.join(dirs["gtfs_outputs_dir"], "stops.html")
+    write(
+        output_writers,
+        viz_gtfs.viz_stops,
+        stops_map_path,
+        return_viz=False,
+        description=stops_map_path,
+    )
+    del viz_gtfs
+    logger.info(f"Post-cleaning stops map saved: {stops_map_path}")
+
+
+def crop_osm(ctx: dict, inputs: dict) -> None:
+    """Crop the OSM input to the urban centre bounding box.
+
+    When "use_cache" is True, the crop is taken from the smallest cached OSM
+    extract containing the bounding box (see `cached_filter_osm()`).
+    """
+    logger = logging.getLogger(ctx["logger_name"])
+    osm_config = ctx["config"]["osm"]
+    uc_gdf = inputs["urban_centre"]
+    logger.info("Cropping OSM input to urban centre BBOX...")
+
+    osm_bbox = list(uc_gdf.to_crs("EPSG:4326").loc["bbox"].geometry.bounds)
+    if ctx["use_cache"]:
+        cached_filter_osm(
+            ctx["osm_file"],
+            ctx["filtered_osm_path"],
+            osm_bbox,
+            osm_config["tag_filter"],
+            ctx["cache_dir"],
+            grid_deg=osm_config.get("extract_grid_deg", 2.0),
+            osm_cache_gb=ctx["osm_cache_gb"],
+            logger=logger,
+        )
+    else:
+        filter_osm(
+            pbf_pth=ctx["osm_file"],
+            out_pth=ctx["filtered_osm_path"],
+            bbox=osm_bbox,
+            tag_filter=osm_config["tag_filter"],
+        )
+    logger.info("OSM cropping complete.")
+
+
+def analysis_scenarios(config: dict) -> list:
+    """Expand the OD matrix scenarios of the config.
+
+    The `[analyse_network]` section may list several "dates" (YYYYMMDD),
+    "departures" ("HH:MM") and "transport_modes" (lists of r5py
+    `TransportMode` names). Every combination is a scenario. Without any of
+    these lists, the single scenario of the `[general]` date,
+    `departure_hour`/`departure_minute` and transit is used.
+
+    Parameters
+    ----------
+    config : dict
+        Config TOML.
+
+    Returns
+    -------
+    list
+        Scenario dicts with "name" (output suffix, or None for the single
+        default scenario), "date" (YYYYMMDD), "departure" (datetime) and
+        "transport_modes" (list of mode names).
+
+    """
+    an_config = config["analyse_network"]
+    sweep = any(
+        k in an_config for k in ["dates", "departures", "transport_modes"]
+    )
+    dates = an_config.get("dates", [config["general"]["date"]])
+    departures = an_config.get(
+        "departures",
+        [
+            f"{an_config['departure_hour']:02d}:"
+            f"{an_config['departure_minute']:02d}"
+        ],
+    )
+    mode_sets = [
+        [modes] if isinstance(modes, str) else list(modes)
+        for modes in an_config.get("transport_modes", [["TRANSIT"]])
+    ]
+
+    scenarios = []
+    for date, departure, modes in itertools.product(
+        dates, departures, mode_sets
+    ):
+        hour, minute = (int(x) for x in departure.split(":"))
+        name = None
+        if sweep:
+            name = f"{date}_{hour:02d}{minute:02d}_{'_'.join(modes).lower()}"
+        scenarios.append(
+            {
+                "name": name,
+                "date": date,
+                "departure": datetime.datetime.strptime(
+                    date, "%Y%m%d"
+                ).replace(hour=hour, minute=minute),
+                "transport_modes": modes,
+            }
+        )
+    return scenarios
+
+
+def scenario_dates(config: dict) -> Union[str, list]:
+    """Get the analysis date(s) of the config's scenarios.
+
+    Returns the single analysis date (str) when all scenarios share it,
+    otherwise the sorted list of dates, as accepted by GTFS date filtering.
+    """
+    dates = sorted({s["date"] for s in analysis_scenarios(config)})
+    return dates[0] if len(dates) == 1 else dates
+
+
+def analysis_thresholds(config: dict) -> list:
+    """Expand the transport performance thresholds of the config.
+
+    The `[general]` section may list several "max_times" (minutes) and
+    "max_distances" (km). Every combination is a threshold, falling back to
+    the single `max_time` and `max_distance`. The OD matrix is calculated
+    once for the largest of each (see `od_thresholds()`).
+
+    Parameters
+    ----------
+    config : dict
+        Config TOML.
+
+    Returns
+    -------
+    list
+        Threshold dicts with "max_time", "max_distance" and "name" (output
+        suffix: the max time, and the max distance in km when several are
+        listed).
+
+    """
+    general_config = config["general"]
+    max_times = general_config.get("max_times")
+    if max_times is None:
+        max_times = [general_config["max_time"]]
+    max_distances = general_config.get("max_distances")
+    if max_distances is None:
+        max_distances = [general_config["max_distance"]]
+    thresholds = []
+    for max_distance, max_time in itertools.product(max_distances, max_times):
+        name = f"{max_time}"
+        if len(max_distances) > 1:
+            name = f"{max_time}_{max_distance}km"
+        thresholds.append(
+            {"max_time": max_time, "max_distance": max_distance, "name": name}
+        )
+    return thresholds
+
+
+def od_thresholds(config: dict) -> tuple:
+    """Get the (max_time, max_distance) of the OD matrix calculation."""
+    thresholds = analysis_thresholds(config)
+    return (
+        max(t["max_time"] for t in thresholds),
+        max(t["max_distance"] for t in thresholds),
+    )
+
+
+def od_matrix(ctx: dict, inputs: dict, shard_dir: str = None) -> None:
+    """Build the transport network and calculate the OD matrix.
+
+    The transport network is built once (see `_od_matrix_sharded()`), and
+    the OD matrix of each scenario (see `analysis_scenarios()`) is
+    calculated in origin shards in `shard_dir`, for the largest thresholds
+    (see `od_thresholds()`).
+    """
+    logger = logging.getLogger(ctx["logger_name"])
+    dirs = ctx["dirs"]
+    od_max_time, _ = od_thresholds(ctx["config"])
+    analyse_net_config = ctx["config"]["analyse_network"]
+    centroid_gdf = inputs["population"].centroid_gdf()
+
+    scenarios = analysis_scenarios(ctx["config"])
+    departure_time_window = datetime.timedelta(
+        hours=analyse_net_config["departure_time_window"],
+    )
+    max_time = datetime.timedelta(
+        minutes=od_max_time,
+    )
+    _od_matrix_sharded(
+        ctx,
+        centroid_gdf,
+        shard_dir or dirs["an_outputs_dir"],
+        scenarios,
+        departure_time_window,
+        max_time,
+        logger,
+    )
+    logger.info("Transport network analysis complete.")
+
+
+def _od_matrix_sharded(
+    ctx: dict,
+    centroid_gdf: gpd.GeoDataFrame,
+    shard_dir: str,
+    scenarios: list,
+    departure_time_window: datetime.timedelta,
+    max_time: datetime.timedelta,
+    logger,
+) -> None:
+    """Calculate the OD matrices in origin shards, resuming from `shard_dir`.
+
+    The transport network is built once (or read from the network cache, see
+    `networks.cached_network()`) and shared by all scenarios. Each
+    named scenario is written to its own subdirectory. The parquet parts are
+    written to `shard_dir` and, when this is not the run's `an_outputs_dir`
+    (i.e. a persistent shard directory in the cache), linked into
+    `an_outputs_dir` once all shards of a scenario are complete.
+    """
+    from r5py import TransportMode
+
+    from networks import cached_network
+    from od_shards import compute_od_shards, MANIFEST_NAME, ORIGIN_BLOCK_SIZE
+
+    an_outputs_dir = ctx["dirs"]["an_outputs_dir"]
+    # batched, compact or queued OD matrices are always partitioned into
+    # origin blocks, otherwise all origins are one shard
+    shard_size = ctx["od_shard_size"] or (
+        ORIGIN_BLOCK_SIZE
+        if ctx["batch_orig"]
+        or ctx["compact_od"]
+        or ctx["od_queue"] is not None
+        else len(centroid_gdf)
+    )
+    network = cached_network(
+        ctx["filtered_osm_path"],
+        ctx["dirs"]["interim_gtfs"],
+        cache_dir=(
+            ctx["cache_dir"] if ctx["network_cache_gb"] is not None else None
+        ),
+        network_cache_gb=ctx["network_cache_gb"],
+        logger=logger,
+    )
+
+    for scenario in scenarios:
+        scenario_dir = scenario["name"] or ""
+        scenario_shard_dir = os.path.join(shard_dir, scenario_dir)
+        scenario_outputs_dir = os.path.join(an_outputs_dir, scenario_dir)
+        logger.info(
+            f"Calculating OD matrix of scenario {scenario['name']} in shards "
+            f"at: {scenario_shard_dir}"
+        )
+        shard_args = {
+            "centroid_gdf": centroid_gdf,
+            "shard_dir": scenario_shard_dir,
+            "shard_size": shard_size,
+            "max_distance": od_thresholds(ctx["config"])[1],
+            "departure": scenario["departure"],
+            "departure_time_window": departure_time_window,
+            "max_time": max_time,
+            "compact": ctx["compact_od"],
+        }
+        transport_modes = [
+            TransportMode[mode] for mode in scenario["transport_modes"]
+        ]
+        if ctx["od_queue"] is not None:
+            _distribute_od_shards(
+                ctx, network, shard_args, scenario["transport_modes"], logger
+            )
+        parts = compute_od_shards(
+            network,
+            transport_modes=transport_modes,
+            workers=ctx["od_workers"],
+            logger=logger,
+            **shard_args,
+        )
+        if os.path.normpath(scenario_shard_dir) != os.path.normpath(
+            scenario_outputs_dir
+        ):
+            for path in parts + [
+                os.path.join(scenario_shard_dir, MANIFEST_NAME)
+            ]:
+                link_file(
+                    path,
+                    os.path.join(scenario_outputs_dir, os.path.basename(path)),
+                )
+        logger.info(f"OD matrix written to: {scenario_outputs_dir}")
+    logger.debug("Removing `network` memory allocation...")
+    del network  # remove network memory alloc
+
+
+def _distribute_od_shards(
+    ctx: dict,
+    network,
+    shard_args: dict,
+    transport_modes: list,
+    logger,
+) -> None:
+    """Share the missing OD shards of a scenario with work queue workers.
+
+    The shards are published to the `OD_QUEUE` work queue (see
+    `work_queue.distribute()`), and calculated by this process and any
+    workers of the queue until all are complete. Workers read the transport
+    network from the shared network cache, so `NETWORK_CACHE_GB` should be
+    set.
+    """
+    from od_shards import compute_od_shards, plan_od_shards
+    from r5py import TransportMode
+    from work_queue import FileQueue, distribute
+
+    _, todo = plan_od_shards(
+        shard_args["centroid_gdf"]["id"].tolist(),
+        shard_args["shard_dir"],
+        shard_args["shard_size"],
+    )
+    if len(todo) == 0:
+        return
+    payload = {
+        **shard_args,
+        "transport_modes": transport_modes,
+        "osm_path": ctx["filtered_osm_path"],
+        "gtfs_dir": ctx["dirs"]["interim_gtfs"],
+        "cache_dir": (
+            ctx["cache_dir"] if ctx["network_cache_gb"] is not None else None
+        ),
+        "network_cache_gb": ctx["network_cache_gb"],
+    }
+
+    def _run_shard(item: dict, logger) -> dict:
+        compute_od_shards(
+            network,
+            transport_modes=[TransportMode[m] for m in transport_modes],
+            only=[item["shard"]],
+            logger=logger,
+            **shard_args,
+        )
+        return {"shard": item["shard"]}
+
+    # items of one shard directory share a group, so reruns resume them
+    group = hashlib.sha256(
+        os.path.abspath(shard_args["shard_dir"]).encode()
+    ).hexdigest()[:16]
+    distribute(
+        FileQueue(ctx["od_queue"]),
+        f"od-{group}",
+        "od_shard",
+        {f"{shard:05d}": {"shard": shard} for shard in todo},
+        _run_shard,
+        payload=payload,
+        logger=logger,
+    )
+
+
+def calculate_metrics(ctx: dict, inputs: dict) -> None:
+    """Calculate the transport performance of each scenario.
+
+    The population cells (and, when not streaming, centroids) are built
+    once from the population grid and shared by every scenario.
+    """
+    logger = logging.getLogger(ctx["logger_name"])
+    grid = inputs["population"]
+    pop_gdf = grid.to_gdf()
+    centroid_gdf = None
+    if not ctx["streaming_metrics"] and (
+        len(analysis_thresholds(ctx["config"])) == 1
+    ):
+        centroid_gdf = grid.centroid_gdf()
+    for scenario in analysis_scenarios(ctx["config"]):
+        if scenario["name"] is not None:
+            logger.info(f"Scenario: {scenario['name']}")
+        _scenario_metrics(ctx, inputs, scenario, pop_gdf, centroid_gdf, logger)
+
+
+def _scenario_metrics(
+    ctx: dict,
+    inputs: dict,
+    scenario: dict,
+    pop_gdf: gpd.GeoDataFrame,
+    centroid_gdf: gpd.GeoDataFrame,
+    logger,
+) -> None:
+    """Calculate the transport performance of a scenario and save outputs.
+
+    With several thresholds (see `analysis_thresholds()`), the performance
+    of every threshold is calculated in one streamed pass over the OD
+    matrix, and `centroid_gdf` is not used.
+    """
+    general_config = ctx["config"]["general"]
+    area_name = ctx["area_name"]
+    uc_gdf = inputs["urban_centre"]
+    thresholds = analysis_thresholds(ctx["config"])
+
+    od_path = os.path.join(
+        ctx["dirs"]["an_outputs_dir"], scenario["name"] or ""
+    )
+    if ctx["streaming_metrics"] or len(thresholds) > 1:
+        # bounded memory: the OD matrix is scanned in batches, once for all
+        # thresholds
+        logger.info(
+            "Calculating the transport performance (streaming) of "
+            f"{len(thresholds)} threshold(s)..."
+        )
+        results = streaming_threshold_performance(
+            od_path,
+            pop_gdf,
+            list(dict.fromkeys(t["max_time"] for t in thresholds)),
+            list(dict.fromkeys(t["max_distance"] for t in thresholds)),
+            urban_centre_name=area_name.title(),
+            urban_centre_country=ctx["country_name"].title(),
+            urban_centre_gdf=uc_gdf.reset_index(),
+            coords=np.column_stack(
+                inputs["population"].centroids(CENTROID_CRS)
+            ),
+        )
+    else:
+        logger.info("Calculating the transport performance...")
+        max_time = thresholds[0]["max_time"]
+        max_distance = thresholds[0]["max_distance"]
+        results = {
+            (max_time, max_distance): (
+                transport_performance(
+                    od_path,
+                    centroid_gdf,
+                    pop_gdf,
+                    travel_time_threshold=max_time,
+                    distance_threshold=max_distance,
+                    urban_centre_name=area_name.title(),
+                    urban_centre_country=ctx["country_name"].title(),
+                    urban_centre_gdf=uc_gdf.reset_index(),
+                )
+            )
+        }
+    logger.info("Transport performance calculated. Saving output files...")
+    if scenario["name"] is None:
+        prefix = f"{area_name}_{general_config['date']}_public_transit"
+    else:
+        prefix = f"{area_name}_{scenario['name']}"
+    for threshold in thresholds:
+        tp_df, stats_df = results[
+            (threshold["max_time"], threshold["max_distance"])
+        ]
+        _write_metrics(
+            ctx, uc_gdf, tp_df, stats_df, f"{prefix}_{threshold['name']}"
+        )
+
+
+def _write_metrics(
+    ctx: dict,
+    uc_gdf: gpd.GeoDataFrame,
+    tp_df: gpd.GeoDataFrame,
+    stats_df: pd.DataFrame,
+    suffix: str,
+) -> None:
+    """Save the transport performance maps, stats and parquet of a suffix."""
+    logger = logging.getLogger(ctx["logger_name"])
+    dirs = ctx["dirs"]
+    tp_plot_path = os.path.join(
+        dirs["metrics_outputs_dir"], f"transport_performance_{suffix}.html"
+    )
+    tp_plot_const_cmap_path = os.path.join(
+        dirs["metrics_outputs_dir"],
+        f"transport_performance_const_cmap_{suffix}.html",
+    )
+    tp_output_path = os.path.join(
+        dirs["metrics_outputs_dir"], f"transport_performance_{suffix}.parquet"
+    )
+    tp_stats_path = os.path.join(
+        dirs["metrics_outputs_dir"],
+        f"transport_performance_stats_{suffix}.csv",
+    )
+    # both maps share one (compacted) layer
+    tp_map_df = (
+        compact_layer(tp_df, "transport_performance")
+        if ctx["compact_maps"]
+        else tp_df
+    )
+    write(
+        ctx["output_writers"],
+        plot,
+        tp_map_df,
+        column="transport_performance",
+        column_control_name="Transport Performance",
+        uc_gdf=uc_gdf[0:1],
+        cmap="viridis",
+        caption="Transport Performance (%)",
+        save=tp_plot_path,
+        description=tp_plot_path,
+    )
+    const_cmap = colormap.LinearColormap(
+        colors=[
+            "#440154",
+            "#414487",
+            "#2A788E",
+            "#22A884",
+            "#7AD151",
+            "#FDE725",
+        ],
+        vmin=0,
+        vmax=100,
+        max_labels=11,
+        tick_labels=list(range(0, 110, 10)),
+    )
+    write(
+        ctx["output_writers"],
+        plot,
+        tp_map_df,
+        column="transport_performance",
+        column_control_name="Transport Performance",
+        uc_gdf=uc_gdf[0:1],
+        cmap=const_cmap,
+        caption="Transport Performance (%)",
+        save=tp_plot_const_cmap_path,
+        description=tp_plot_const_cmap_path,
+    )
+    write(
+        ctx["output_writers"],
+        stats_df.to_csv,
+        tp_stats_path,
+        index=False,
+        description=tp_stats_path,
+    )
+    write(
+        ctx["output_writers"],
+        tp_df.to_parquet,
+        tp_output_path,
+        index=False,
+        description=tp_output_path,
+    )
+    logger.info(f"Transport performance map saved: {tp_plot_path}")
+    logger.info(
+        "Transport performance map (constant cmap) saved: "
+        f"{tp_plot_const_cmap_path}"
+    )
+    logger.info(f"Transport performance stats saved: {tp_stats_path}")
+    logger.info(f"Transport performance parquet saved: {tp_output_path}")
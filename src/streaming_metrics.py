@@ -0,0 +1,459 @@
+"""Out-of-core transport performance metrics for run.py."""
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+# maximum number of OD pairs held in memory at once
+BATCH_ROWS = 1_000_000
+# equal area CRS of the urban centre area, as the GHS urban centre grid
+AREA_CRS = "ESRI:54009"
+# CRS of the centroid coordinates OD distances are calculated from
+CENTROID_CRS = "EPSG:4326"
+# mean earth radius (km) of the great circle OD distances
+EARTH_RADIUS_KM = 6371
+
+
+def great_circle_distance(
+    lon1: np.ndarray, lat1: np.ndarray, lon2: np.ndarray, lat2: np.ndarray
+) -> np.ndarray:
+    """Calculate haversine distances (km) between EPSG:4326 coordinates.
+
+    The distances of OD pairs, as used for the proximity population by
+    `transport_performance.metrics` (and written by the OD shards, see
+    `od_shards.compute_od_shards()`).
+    """
+    lon1, lat1, lon2, lat2 = (np.radians(x) for x in (lon1, lat1, lon2, lat2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def accumulate_populations(
+    od_path: str,
+    ids: pd.Index,
+    populations: np.ndarray,
+    travel_time_threshold: float,
+    distance_threshold: float,
+    sources_col: str = "from_id",
+    destinations_col: str = "to_id",
+    distance_col: str = "distance",
+    coords: np.ndarray = None,
+    batch_rows: int = BATCH_ROWS,
+) -> tuple:
+    """Stream an OD matrix, summing the origin populations per destination.
+
+    The OD parquet file(s) are scanned as a pyarrow dataset in batches of at
+    most `batch_rows` pairs, so memory is bounded by the batch size plus two
+    accumulators of `len(ids)` values, regardless of the OD matrix size.
+
+    Parameters
+    ----------
+    od_path : str
+        OD parquet file, or directory of OD parquet parts.
+    ids : pd.Index
+        Centroid ids. The accumulators are in this order.
+    populations : np.ndarray
+        Population of each centroid, in the order of `ids`.
+    travel_time_threshold : float
+        Maximum travel time (minutes) of an accessible destination.
+    distance_threshold : float
+        Maximum distance (km) of a proximal destination.
+    sources_col : str, optional
+        Origin id column, by default "from_id".
+    destinations_col : str, optional
+        Destination id column, by default "to_id".
+    distance_col : str, optional
+        Distance column (km), by default "distance". Not used when `coords`
+        are given.
+    coords : np.ndarray, optional
+        Longitude and latitude (`CENTROID_CRS`) of each centroid, of shape
+        (len(ids), 2), by default None. See
+        `accumulate_threshold_populations()`.
+    batch_rows : int, optional
+        Maximum pairs per batch, by default `BATCH_ROWS`.
+
+    Returns
+    -------
+    tuple
+        Accessible and proximity population of each centroid (as a
+        destination), as arrays in the order of `ids`.
+
+    """
+    accessible, proximity = accumulate_threshold_populations(
+        od_path,
+        ids,
+        populations,
+        [travel_time_threshold],
+        [distance_threshold],
+        sources_col=sources_col,
+        destinations_col=destinations_col,
+        distance_col=distance_col,
+        coords=coords,
+        batch_rows=batch_rows,
+    )
+    return accessible[0, 0], proximity[0]
+
+
+def accumulate_threshold_populations(
+    od_path: str,
+    ids: pd.Index,
+    populations: np.ndarray,
+    travel_time_thresholds: list,
+    distance_thresholds: list,
+    sources_col: str = "from_id",
+    destinations_col: str = "to_id",
+    distance_col: str = "distance",
+    coords: np.ndarray = None,
+    batch_rows: int = BATCH_ROWS,
+) -> tuple:
+    """Stream an OD matrix once, summing populations for many thresholds.
+
+    Each OD pair is binned by the smallest distance and travel time
+    thresholds it is within, and the origin populations are summed per
+    (distance bin, time bin, destination) with a single `np.bincount` per
+    batch. Cumulative sums over the bins then give the populations of every
+    threshold. Memory is bounded by the batch size plus
+    `len(distance_thresholds) * (len(travel_time_thresholds) + 1)`
+    accumulators of `len(ids)` values.
+
+    Parameters
+    ----------
+    od_path : str
+        OD parquet file, or directory of OD parquet parts. Must be calculated
+        for at least the largest thresholds.
+    ids : pd.Index
+        Centroid ids. The accumulators are in this order.
+    populations : np.ndarray
+        Population of each centroid, in the order of `ids`.
+    travel_time_thresholds : list
+        Maximum travel times (minutes) of an accessible destination.
+    distance_thresholds : list
+        Maximum distances (km) of a proximal destination.
+    sources_col : str, optional
+        Origin id column, by default "from_id".
+    destinations_col : str, optional
+        Destination id column, by default "to_id".
+    distance_col : str, optional
+        Distance column (km), by default "distance". Not used when `coords`
+        are given.
+    coords : np.ndarray, optional
+        Longitude and latitude (`CENTROID_CRS`) of each centroid, of shape
+        (len(ids), 2), by default None. When given, the OD distances are
+        the great circle distances between the centroids (see
+        `great_circle_distance()`), as `transport_performance.metrics`,
+        rather than read from `distance_col`.
+    batch_rows : int, optional
+        Maximum pairs per batch, by default `BATCH_ROWS`.
+
+    Returns
+    -------
+    tuple
+        Accessible population, of shape (len(distance_thresholds),
+        len(travel_time_thresholds), len(ids)), and proximity population, of
+        shape (len(distance_thresholds), len(ids)), in the order of the
+        given thresholds and `ids`.
+
+    Raises
+    ------
+    ValueError
+        When `coords` are not given and the OD matrix has no `distance_col`
+        column.
+
+    """
+    times = np.asarray(travel_time_thresholds, dtype=float)
+    distances = np.asarray(distance_thresholds, dtype=float)
+    time_order = np.argsort(times)
+    distance_order = np.argsort(distances)
+    sorted_times = times[time_order]
+    sorted_distances = distances[distance_order]
+    n_ids = len(ids)
+    # the last time bin holds pairs beyond every travel time threshold (or
+    # unreachable), which only count as proximal
+    n_time_bins = len(times) + 1
+    counts = np.zeros(len(distances) * n_time_bins * n_ids)
+
+    dataset = ds.dataset(od_path, format="parquet")
+    columns = [sources_col, destinations_col, "travel_time"]
+    if coords is None:
+        if distance_col not in dataset.schema.names:
+            raise ValueError(
+                f"The OD matrix at {od_path} has no `{distance_col}` column. "
+                "Pass the centroid `coords` to calculate the distances."
+            )
+        scanner = dataset.scanner(
+            columns=columns + [distance_col],
+            filter=pc.field(distance_col) <= sorted_distances[-1],
+            batch_size=batch_rows,
+        )
+    else:
+        scanner = dataset.scanner(columns=columns, batch_size=batch_rows)
+    for batch in scanner.to_batches():
+        if batch.num_rows == 0:
+            continue
+        origins = ids.get_indexer(batch.column(sources_col).to_numpy())
+        destinations = ids.get_indexer(
+            batch.column(destinations_col).to_numpy()
+        )
+        travel_time = (
+            batch.column("travel_time")
+            .to_numpy(zero_copy_only=False)
+            .astype(float)
+        )
+        if coords is None:
+            distance = (
+                batch.column(distance_col)
+                .to_numpy(zero_copy_only=False)
+                .astype(float)
+            )
+        else:
+            distance = great_circle_distance(
+                coords[origins, 0],
+                coords[origins, 1],
+                coords[destinations, 0],
+                coords[destinations, 1],
+            )
+            within = distance <= sorted_distances[-1]
+            origins = origins[within]
+            destinations = destinations[within]
+            travel_time = travel_time[within]
+            distance = distance[within]
+        # index of the smallest threshold each pair is within (nan sorts
+        # last, so null travel times fall in the last bin)
+        time_bin = np.searchsorted(sorted_times, travel_time, side="left")
+        distance_bin = np.searchsorted(sorted_distances, distance, side="left")
+        counts += np.bincount(
+            (distance_bin * n_time_bins + time_bin) * n_ids + destinations,
+            weights=populations[origins],
+            minlength=len(counts),
+        )
+
+    # a pair within a threshold is within every larger threshold
+    counts = counts.reshape(len(distances), n_time_bins, n_ids).cumsum(axis=0)
+    proximity = counts.sum(axis=1)
+    accessible = counts[:, :-1].cumsum(axis=1)
+
+    # back to the order of the given thresholds
+    distance_rank = np.argsort(distance_order)
+    time_rank = np.argsort(time_order)
+    return (
+        accessible[distance_rank][:, time_rank],
+        proximity[distance_rank],
+    )
+
+
+def transport_performance_stats(
+    tp_df: pd.DataFrame,
+    urban_centre_name: str = None,
+    urban_centre_country: str = None,
+    urban_centre_gdf: gpd.GeoDataFrame = None,
+) -> pd.DataFrame:
+    """Summarise the transport performance distribution of an urban centre.
+
+    Parameters
+    ----------
+    tp_df : pd.DataFrame
+        Transport performance per cell, with "transport_performance" and
+        "population" columns.
+    urban_centre_name : str, optional
+        Urban centre name, by default None.
+    urban_centre_country : str, optional
+        Urban centre country, by default None.
+    urban_centre_gdf : gpd.GeoDataFrame, optional
+        Urban centre, with a "label" column, by default None. Used for the
+        urban centre area, in km2 of the equal area `AREA_CRS`.
+
+    Returns
+    -------
+    pd.DataFrame
+        A single row of urban centre details and the transport performance
+        percentiles. The urban centre population is that of the cells in
+        `tp_df`, i.e. the urban centre cells in the OD matrix.
+
+    """
+    stats = {
+        "urban centre name": urban_centre_name,
+        "urban centre country": urban_centre_country,
+        "urban centre area": None,
+        "urban centre population": tp_df["population"].sum(),
+    }
+    if urban_centre_gdf is not None:
+        uc = urban_centre_gdf[urban_centre_gdf["label"] == "vectorized_uc"]
+        stats["urban centre area"] = uc.to_crs(AREA_CRS).area.sum() / 1e6
+    percentiles = tp_df["transport_performance"].quantile(
+        [0, 0.25, 0.5, 0.75, 1]
+    )
+    stats.update(
+        {
+            "min": percentiles[0],
+            "25 percentile": percentiles[0.25],
+            "median": percentiles[0.5],
+            "75 percentile": percentiles[0.75],
+            "max": percentiles[1],
+        }
+    )
+    return pd.DataFrame([stats])
+
+
+def streaming_transport_performance(
+    od_path: str,
+    pop_gdf: gpd.GeoDataFrame,
+    travel_time_threshold: float = 45,
+    distance_threshold: float = 11.25,
+    urban_centre_name: str = None,
+    urban_centre_country: str = None,
+    urban_centre_gdf: gpd.GeoDataFrame = None,
+    coords: np.ndarray = None,
+    batch_rows: int = BATCH_ROWS,
+) -> tuple:
+    """Calculate transport performance without loading the OD matrix.
+
+    Equivalent to `transport_performance.metrics.transport_performance()`:
+    the transport performance of a destination cell is the population that
+    can reach it within `travel_time_threshold` (accessible population) as a
+    percentage of the population within `distance_threshold` of it
+    (proximity population). The OD matrix is streamed in batches (see
+    `accumulate_populations()`).
+
+    Parameters
+    ----------
+    od_path : str
+        OD parquet file, or directory of OD parquet parts.
+    pop_gdf : gpd.GeoDataFrame
+        Population grid, with "id", "population" and (optionally)
+        "within_urban_centre" columns.
+    travel_time_threshold : float, optional
+        Maximum travel time in minutes, by default 45.
+    distance_threshold : float, optional
+        Maximum distance in km, by default 11.25.
+    urban_centre_name : str, optional
+        Urban centre name, by default None.
+    urban_centre_country : str, optional
+        Urban centre country, by default None.
+    urban_centre_gdf : gpd.GeoDataFrame, optional
+        Urban centre, with a "label" column, by default None.
+    coords : np.ndarray, optional
+        Longitude and latitude of each cell centroid, by default None. See
+        `streaming_threshold_performance()`.
+    batch_rows : int, optional
+        Maximum OD pairs per batch, by default `BATCH_ROWS`.
+
+    Returns
+    -------
+    tuple
+        Transport performance per urban centre cell (GeoDataFrame) and the
+        descriptive statistics (see `transport_performance_stats()`).
+
+    """
+    results = streaming_threshold_performance(
+        od_path,
+        pop_gdf,
+        [travel_time_threshold],
+        [distance_threshold],
+        urban_centre_name=urban_centre_name,
+        urban_centre_country=urban_centre_country,
+        urban_centre_gdf=urban_centre_gdf,
+        coords=coords,
+        batch_rows=batch_rows,
+    )
+    return results[(travel_time_threshold, distance_threshold)]
+
+
+def streaming_threshold_performance(
+    od_path: str,
+    pop_gdf: gpd.GeoDataFrame,
+    travel_time_thresholds: list,
+    distance_thresholds: list,
+    urban_centre_name: str = None,
+    urban_centre_country: str = None,
+    urban_centre_gdf: gpd.GeoDataFrame = None,
+    coords: np.ndarray = None,
+    batch_rows: int = BATCH_ROWS,
+) -> dict:
+    """Calculate the transport performance of many thresholds in one pass.
+
+    As `streaming_transport_performance()`, for every combination of the
+    travel time and distance thresholds, from a single scan of an OD matrix
+    calculated for (at least) the largest thresholds (see
+    `accumulate_threshold_populations()`).
+
+    Parameters
+    ----------
+    od_path : str
+        OD parquet file, or directory of OD parquet parts.
+    pop_gdf : gpd.GeoDataFrame
+        Population grid, with "id", "population" and (optionally)
+        "within_urban_centre" columns.
+    travel_time_thresholds : list
+        Maximum travel times in minutes.
+    distance_thresholds : list
+        Maximum distances in km.
+    urban_centre_name : str, optional
+        Urban centre name, by default None.
+    urban_centre_country : str, optional
+        Urban centre country, by default None.
+    urban_centre_gdf : gpd.GeoDataFrame, optional
+        Urban centre, with a "label" column, by default None.
+    coords : np.ndarray, optional
+        Longitude and latitude (`CENTROID_CRS`) of each cell centroid, in
+        the order of `pop_gdf`, by default None meaning the centroids of the
+        `pop_gdf` geometries. The OD distances are calculated from these
+        (see `accumulate_threshold_populations()`), so OD matrices without
+        a distance column (e.g. of `AnalyseNetwork`) can be used.
+    batch_rows : int, optional
+        Maximum OD pairs per batch, by default `BATCH_ROWS`.
+
+    Returns
+    -------
+    dict
+        Transport performance per urban centre cell (GeoDataFrame) and the
+        descriptive statistics (see `transport_performance_stats()`), keyed
+        by (travel time threshold, distance threshold).
+
+    """
+    ids = pd.Index(pop_gdf["id"])
+    populations = pop_gdf["population"].fillna(0).to_numpy(dtype=float)
+    if coords is None:
+        centroids = pop_gdf.geometry.centroid.to_crs(CENTROID_CRS)
+        coords = np.column_stack([centroids.x, centroids.y])
+    accessible, proximity = accumulate_threshold_populations(
+        od_path,
+        ids,
+        populations,
+        travel_time_thresholds,
+        distance_thresholds,
+        coords=coords,
+        batch_rows=batch_rows,
+    )
+
+    results = {}
+    for i, distance_threshold in enumerate(distance_thresholds):
+        for j, travel_time_threshold in enumerate(travel_time_thresholds):
+            tp_df = pop_gdf.copy()
+            tp_df["accessible_population"] = accessible[i, j]
+            tp_df["proximity_population"] = proximity[i]
+            tp_df["transport_performance"] = (
+                100
+                * accessible[i, j]
+                / np.where(proximity[i] > 0, proximity[i], np.nan)
+            )
+            if "within_urban_centre" in tp_df.columns:
+                tp_df = tp_df[tp_df["within_urban_centre"]]
+            tp_df = tp_df[tp_df["proximity_population"] > 0].reset_index(
+                drop=True
+            )
+            stats_df = transport_performance_stats(
+                tp_df,
+                urban_centre_name,
+                urban_centre_country,
+                urban_centre_gdf,
+            )
+            results[(travel_time_threshold, distance_threshold)] = (
+                tp_df,
+                stats_df,
+            )
+    return results
@@ -0,0 +1,464 @@
+"""Synthetic input generators for the offline benchmark (see benchmark.py)."""
+
+import csv
+import io
+import math
+import numpy as np
+import os
+import rasterio
+import subprocess
+import toml
+import zipfile
+
+from pyproj import Transformer
+from rasterio.transform import from_origin
+from xml.sax.saxutils import quoteattr
+
+# benchmark scales: urban extent (km), GTFS feeds/stops/routes/trips and the
+# OSM street grid spacing (m)
+SCALES = {
+    "small": {
+        "extent_km": 10,
+        "feeds": 1,
+        "stops": 100,
+        "routes": 10,
+        "trips_per_route": 20,
+        "osm_spacing_m": 500,
+    },
+    "medium": {
+        "extent_km": 20,
+        "feeds": 2,
+        "stops": 1000,
+        "routes": 50,
+        "trips_per_route": 50,
+        "osm_spacing_m": 250,
+    },
+    "large": {
+        "extent_km": 40,
+        "feeds": 4,
+        "stops": 5000,
+        "routes": 200,
+        "trips_per_route": 100,
+        "osm_spacing_m": 150,
+    },
+}
+
+# synthetic area set-up. The centre is in England, so the default
+# `BUFFER_ESTIMATION_CRS` applies
+CENTRE_LON_LAT = (-1.5, 53.8)
+DATE = "20231212"
+COUNTRY_NAME = "synthetic"
+
+# raster file name prefixes, matching the default config `subset_regex`
+UC_PREFIX = "GHS_POP_E2020_GLOBE_R2023A_54009_1000_"
+POP_PREFIX = "GHS_POP_E2020_GLOBE_R2023A_54009_100_"
+
+# margin (km) added around the urban extent, covering the urban centre
+# buffer (`buffer_size`) so all inputs cover the analysed area
+MARGIN_KM = 15
+PEAK_DENSITY = 8000  # people per km2 at the centre
+NODATA = -200
+
+
+def area_env(scale: str) -> dict:
+    """Get the area environment variables of a synthetic input scale."""
+    lon, lat = CENTRE_LON_LAT
+    half_deg_lat = SCALES[scale]["extent_km"] / 2 / 111.32
+    half_deg_lon = half_deg_lat / math.cos(math.radians(lat))
+    return {
+        "COUNTRY_NAME": COUNTRY_NAME,
+        "AREA_NAME": f"synthetic_{scale}",
+        "BBOX": ",".join(
+            str(round(v, 6))
+            for v in [
+                lon - half_deg_lon,
+                lat - half_deg_lat,
+                lon + half_deg_lon,
+                lat + half_deg_lat,
+            ]
+        ),
+        "CENTRE": f"{lat},{lon}",
+    }
+
+
+def _density(x: np.ndarray, y: np.ndarray, sigma_m: float) -> np.ndarray:
+    """Gaussian population density (per km2) around the origin."""
+    return PEAK_DENSITY * np.exp(-(x**2 + y**2) / (2 * sigma_m**2))
+
+
+def write_raster_tiles(
+    out_dir: str,
+    prefix: str,
+    resolution: int,
+    extent_km: float,
+    tiles: int = 2,
+) -> list:
+    """Write a gaussian population raster as a grid of GeoTIFF tiles.
+
+    The rasters are in ESRI:54009 (as the GHS-POP inputs), centred on
+    `CENTRE_LON_LAT` and snapped to a 1km grid, so the 100m and 1km rasters
+    align.
+
+    Parameters
+    ----------
+    out_dir : str
+        Directory to write the tiles to.
+    prefix : str
+        Tile file name prefix (e.g. `POP_PREFIX`).
+    resolution : int
+        Cell size in m.
+    extent_km : float
+        Width of the urban extent, in km. `MARGIN_KM` is added on each side.
+    tiles : int, optional
+        Number of tiles per side, by default 2.
+
+    Returns
+    -------
+    list
+        Paths to the written tiles.
+
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    cx, cy = Transformer.from_crs(
+        "EPSG:4326", "ESRI:54009", always_xy=True
+    ).transform(*CENTRE_LON_LAT)
+    cx, cy = round(cx, -3), round(cy, -3)
+    half_m = (extent_km / 2 + MARGIN_KM) * 1000
+    cells = int(math.ceil(2 * half_m / resolution / tiles))
+    sigma_m = extent_km * 1000 / 4
+
+    paths = []
+    for row in range(tiles):
+        for col in range(tiles):
+            left = cx - half_m + col * cells * resolution
+            top = cy + half_m - row * cells * resolution
+            xs = left + (np.arange(cells) + 0.5) * resolution - cx
+            ys = top - (np.arange(cells) + 0.5) * resolution - cy
+            grid_x, grid_y = np.meshgrid(xs, ys)
+            population = (
+                _density(grid_x, grid_y, sigma_m) * (resolution / 1000) ** 2
+            )
+
+            path = os.path.join(out_dir, f"{prefix}R{row}_C{col}.tif")
+            with rasterio.open(
+                path,
+                "w",
+                driver="GTiff",
+                height=cells,
+                width=cells,
+                count=1,
+                dtype="float32",
+                crs="ESRI:54009",
+                transform=from_origin(left, top, resolution, resolution),
+                nodata=NODATA,
+                compress="lzw",
+            ) as dst:
+                dst.write(population.astype("float32"), 1)
+            paths.append(path)
+    return paths
+
+
+def _csv_bytes(header: list, rows: list) -> bytes:
+    """Write rows to CSV bytes."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def _gtfs_time(seconds: float) -> str:
+    """Format seconds after midnight as a GTFS HH:MM:SS time."""
+    seconds = int(round(seconds))
+    return (
+        f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    )
+
+
+def write_gtfs(
+    path: str,
+    extent_km: float,
+    stops: int,
+    routes: int,
+    trips_per_route: int,
+    seed: int = 0,
+) -> str:
+    """Write a synthetic bus GTFS zip.
+
+    Stops are placed uniformly within the urban extent. Each route visits a
+    chain of nearest-neighbour stops, with trips evenly spread between 06:00
+    and 22:00 on every day around `DATE`, at 25 km/h.
+
+    Parameters
+    ----------
+    path : str
+        Path of the GTFS zip to write.
+    extent_km : float
+        Width of the urban extent, in km.
+    stops : int
+        Number of stops.
+    routes : int
+        Number of routes.
+    trips_per_route : int
+        Number of trips per route (per day).
+    seed : int, optional
+        Random seed, by default 0.
+
+    Returns
+    -------
+    str
+        `path`.
+
+    """
+    rng = np.random.default_rng(seed)
+    lon, lat = CENTRE_LON_LAT
+    half_deg_lat = extent_km / 2 / 111.32
+    half_deg_lon = half_deg_lat / math.cos(math.radians(lat))
+    stop_lat = lat + rng.uniform(-half_deg_lat, half_deg_lat, stops)
+    stop_lon = lon + rng.uniform(-half_deg_lon, half_deg_lon, stops)
+    stop_ids = [f"S{seed}_{i}" for i in range(stops)]
+    km_per_deg_lon = 111.32 * math.cos(math.radians(lat))
+
+    route_rows, trip_rows, stop_time_rows = [], [], []
+    stops_per_route = min(stops, 15)
+    for r in range(routes):
+        # chain nearest unvisited stops from a random start
+        chain = [int(rng.integers(stops))]
+        while len(chain) < stops_per_route:
+            d = np.hypot(
+                (stop_lat - stop_lat[chain[-1]]) * 111.32,
+                (stop_lon - stop_lon[chain[-1]]) * km_per_deg_lon,
+            )
+            d[chain] = np.inf
+            chain.append(int(np.argmin(d)))
+        leg_km = np.hypot(
+            np.diff(stop_lat[chain]) * 111.32,
+            np.diff(stop_lon[chain]) * km_per_deg_lon,
+        )
+        offsets = np.concatenate([[0], np.cumsum(leg_km / 25 * 3600 + 30)])
+
+        route_id = f"R{seed}_{r}"
+        route_rows.append([route_id, "A1", route_id, 3])
+        for t, start in enumerate(
+            np.linspace(6 * 3600, 22 * 3600, trips_per_route)
+        ):
+            trip_id = f"{route_id}_T{t}"
+            trip_rows.append([route_id, "WEEK", trip_id])
+            for seq, (stop, offset) in enumerate(zip(chain, offsets)):
+                time = _gtfs_time(start + offset)
+                stop_time_rows.append(
+                    [trip_id, time, time, stop_ids[stop], seq + 1]
+                )
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(
+            "agency.txt",
+            _csv_bytes(
+                ["agency_id", "agency_name", "agency_url", "agency_timezone"],
+                [["A1", "Synthetic", "https://example.com", "Europe/London"]],
+            ),
+        )
+        zf.writestr(
+            "stops.txt",
+            _csv_bytes(
+                ["stop_id", "stop_name", "stop_lat", "stop_lon"],
+                [
+                    [sid, sid, round(y, 6), round(x, 6)]
+                    for sid, y, x in zip(stop_ids, stop_lat, stop_lon)
+                ],
+            ),
+        )
+        zf.writestr(
+            "routes.txt",
+            _csv_bytes(
+                [
+                    "route_id",
+                    "agency_id",
+                    "route_short_name",
+                    "route_type",
+                ],
+                route_rows,
+            ),
+        )
+        zf.writestr(
+            "trips.txt",
+            _csv_bytes(["route_id", "service_id", "trip_id"], trip_rows),
+        )
+        zf.writestr(
+            "stop_times.txt",
+            _csv_bytes(
+                [
+                    "trip_id",
+                    "arrival_time",
+                    "departure_time",
+                    "stop_id",
+                    "stop_sequence",
+                ],
+                stop_time_rows,
+            ),
+        )
+        year = int(DATE[:4])
+        zf.writestr(
+            "calendar.txt",
+            _csv_bytes(
+                [
+                    "service_id",
+                    "monday",
+                    "tuesday",
+                    "wednesday",
+                    "thursday",
+                    "friday",
+                    "saturday",
+                    "sunday",
+                    "start_date",
+                    "end_date",
+                ],
+                [["WEEK", 1, 1, 1, 1, 1, 1, 1, f"{year}0101", f"{year}1231"]],
+            ),
+        )
+    return path
+
+
+def write_osm(path: str, extent_km: float, spacing_m: float) -> str:
+    """Write a synthetic street grid `.osm.pbf`.
+
+    The grid covers the urban extent plus `MARGIN_KM`. An OSM XML file is
+    written first and converted to PBF using osmosis (as installed in the
+    docker image), so no network access is needed.
+
+    Parameters
+    ----------
+    path : str
+        Path of the `.osm.pbf` to write.
+    extent_km : float
+        Width of the urban extent, in km.
+    spacing_m : float
+        Street spacing, in m.
+
+    Returns
+    -------
+    str
+        `path`.
+
+    """
+    lon, lat = CENTRE_LON_LAT
+    half_km = extent_km / 2 + MARGIN_KM
+    n = int(2 * half_km * 1000 / spacing_m) + 1
+    lats = lat + np.linspace(-half_km, half_km, n) / 111.32
+    lons = lon + np.linspace(-half_km, half_km, n) / (
+        111.32 * math.cos(math.radians(lat))
+    )
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    xml_path = path.replace(".osm.pbf", ".osm")
+    attrs = 'version="1" timestamp="2023-01-01T00:00:00Z"'
+    with open(xml_path, "w") as f:
+        f.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        f.write('<osm version="0.6" generator="tp-benchmark">\n')
+        for i, y in enumerate(lats):
+            for j, x in enumerate(lons):
+                f.write(
+                    f'<node id="{i * n + j + 1}" {attrs} '
+                    f'lat="{y:.7f}" lon="{x:.7f}"/>\n'
+                )
+        way_id = 1
+        for orientation in ["row", "col"]:
+            for i in range(n):
+                f.write(f'<way id="{way_id}" {attrs}>\n')
+                for j in range(n):
+                    node = i * n + j if orientation == "row" else j * n + i
+                    f.write(f'<nd ref="{node + 1}"/>\n')
+                highway = "primary" if i % 10 == 0 else "residential"
+                f.write(f'<tag k="highway" v={quoteattr(highway)}/>\n')
+                f.write("</way>\n")
+                way_id += 1
+        f.write("</osm>\n")
+
+    subprocess.run(
+        [
+            "osmosis",
+            "--read-xml",
+            f"file={xml_path}",
+            "--write-pbf",
+            f"file={path}",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    os.remove(xml_path)
+    return path
+
+
+def write_config(path: str, default_config: str) -> str:
+    """Write the benchmark config, using the synthetic GTFS date."""
+    config = toml.load(default_config)
+    config["general"]["date"] = DATE
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        toml.dump(config, f)
+    return path
+
+
+def generate_inputs(root: str, scale: str, default_config: str) -> dict:
+    """Generate all synthetic inputs of a scale under `root`.
+
+    Inputs are written into `root/data/inputs/` with the pipeline's input
+    directory structure, so `run.run_area()` can run with `root` as the
+    working directory. Existing inputs are reused.
+
+    Parameters
+    ----------
+    root : str
+        Benchmark root directory.
+    scale : str
+        One of the `SCALES` keys.
+    default_config : str
+        Path to the config TOML used as the benchmark config template.
+
+    Returns
+    -------
+    dict
+        Area environment variables of the scale (see `area_env()`).
+
+    """
+    params = SCALES[scale]
+    inputs_dir = os.path.join(root, "data", "inputs")
+    marker = os.path.join(inputs_dir, ".complete")
+    if os.path.exists(marker):
+        return area_env(scale)
+
+    write_raster_tiles(
+        os.path.join(inputs_dir, "urban_centre"),
+        UC_PREFIX,
+        1000,
+        params["extent_km"],
+    )
+    write_raster_tiles(
+        os.path.join(inputs_dir, "population"),
+        POP_PREFIX,
+        100,
+        params["extent_km"],
+    )
+    for feed in range(params["feeds"]):
+        write_gtfs(
+            os.path.join(
+                inputs_dir, COUNTRY_NAME, "gtfs", f"synthetic_{feed}.zip"
+            ),
+            params["extent_km"],
+            params["stops"] // params["feeds"],
+            params["routes"] // params["feeds"],
+            params["trips_per_route"],
+            seed=feed,
+        )
+    write_osm(
+        os.path.join(inputs_dir, COUNTRY_NAME, "osm", "synthetic.osm.pbf"),
+        params["extent_km"],
+        params["osm_spacing_m"],
+    )
+    write_config(
+        os.path.join(inputs_dir, "config", "benchmark_config.toml"),
+        default_config,
+    )
+    open(marker, "w").close()
+    return area_env(scale)
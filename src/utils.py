@@ -1,13 +1,70 @@
-"""Utility functions for run.py."""
+"""Utility functions for run.py.
 
+The geospatial and plotting libraries are only imported by the functions
+using them, so the light helpers (e.g. those of `preflight.py`) can be
+imported without them.
+"""
+
+# type annotations (e.g. `gpd.GeoDataFrame`) are not evaluated at import
+from __future__ import annotations
+
+import copy
+import csv
 import datetime
-import folium
-import geopandas as gpd
+import glob
 import logging
 import os
+import re
 import sys
+import toml
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import folium
+    import geopandas as gpd
+
+# compact maps: decimal places of the WGS84 coordinates (~1 m), and number of
+# equal width steps the mapped values are quantised to before dissolving
+COMPACT_MAP_DECIMALS = 5
+COMPACT_MAP_STEPS = 100
+
+# GTFS tables of a `gtfs_kit` feed
+GTFS_TABLES = [
+    "agency",
+    "stops",
+    "routes",
+    "trips",
+    "stop_times",
+    "calendar",
+    "calendar_dates",
+    "fare_attributes",
+    "fare_rules",
+    "shapes",
+    "frequencies",
+    "transfers",
+    "feed_info",
+    "attributions",
+]
+
+
+def close_logger(logger_name: str) -> None:
+    """Close and remove the handlers of a logger, and release the logger.
+
+    Used by long-lived processes (e.g. the service) that set up a logger per
+    run, so each run's log file is closed once the run is complete.
+
+    Parameters
+    ----------
+    logger_name : str
+        name of logger.
 
-from folium.map import Icon
+    """
+    logger = logging.getLogger(logger_name)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    logging.Logger.manager.loggerDict.pop(logger_name, None)
 
 
 def create_dir_structure(area_name: str, add_time: bool = True) -> dict:
@@ -106,6 +163,65 @@ def setup_logger(
     return logger
 
 
+def compact_layer(
+    gdf: gpd.GeoDataFrame,
+    column: str,
+    steps: int = COMPACT_MAP_STEPS,
+    decimals: int = COMPACT_MAP_DECIMALS,
+) -> gpd.GeoDataFrame:
+    """Shrink a layer before plotting, by merging cells and rounding.
+
+    Numeric `column` values are quantised to `steps` equal width steps
+    across their range, cells with the same (quantised) value are dissolved
+    into one geometry (removing the shared edges of neighbouring grid
+    cells), and the coordinates are rounded to `decimals` decimal places in
+    EPSG:4326. Only `column` and the geometry are kept.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        Layer to shrink (e.g. the population grid).
+    column : str
+        Column to be visualised.
+    steps : int, optional
+        Number of value steps, by default `COMPACT_MAP_STEPS`.
+    decimals : int, optional
+        Coordinate decimal places, by default `COMPACT_MAP_DECIMALS`.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        Compact layer, in EPSG:4326.
+
+    """
+    import geopandas as gpd
+    import numpy as np
+    import shapely
+
+    from pandas.api.types import is_numeric_dtype
+
+    gdf = gdf[[column, gdf.geometry.name]]
+    values = gdf[column]
+    if is_numeric_dtype(values) and values.max() > values.min():
+        low = values.min()
+        step = (values.max() - low) / steps
+        gdf = gdf.assign(
+            **{column: (low + ((values - low) / step).round() * step)}
+        )
+    gdf = gdf.dissolve(by=column, as_index=False, dropna=False)
+    gdf = gdf.to_crs("EPSG:4326")
+    return gdf.set_geometry(
+        gpd.GeoSeries(
+            shapely.transform(
+                gdf.geometry.to_numpy(),
+                lambda coords: np.round(coords, decimals),
+            ),
+            index=gdf.index,
+            crs=gdf.crs,
+        )
+    )
+
+
 def plot(
     gdf: gpd.GeoDataFrame,
     column: str = None,
@@ -185,6 +301,10 @@ def plot(
         Folium visualisation output
 
     """
+    import folium
+
+    from folium.map import Icon
+
     # create an empty map layer so individual tiles can be addeded
     m = folium.Map(tiles=None, control_scale=True, zoom_control=True)
 
@@ -363,3 +483,136 @@ def _gtfs_osm_dir_check(subdir: str):
         raise FileNotFoundError(f"{osm_check} does not exist.")
     elif not os.path.exists(gtfs_check):
         raise FileNotFoundError(f"{gtfs_check} does not exist.")
+
+
+def raster_input_files(input_dir: str, subset_regex: str = None) -> list:
+    """List the raster files that will be merged from an input directory.
+
+    Parameters
+    ----------
+    input_dir : str
+        Directory containing the input raster (.tif) files.
+    subset_regex : str, optional
+        Regex pattern used to subset the raster files, by default None meaning
+        all raster files in `input_dir` are returned.
+
+    Returns
+    -------
+    list
+        Sorted list of raster file paths.
+
+    """
+    files = glob.glob(os.path.join(input_dir, "*.tif"))
+    if subset_regex is not None:
+        files = [
+            f for f in files if re.search(subset_regex, os.path.basename(f))
+        ]
+    return sorted(files)
+
+
+def read_area_manifest(manifest_file: str) -> list:
+    """Read a manifest of areas to analyse in a batch.
+
+    Each area is described using the same names as the area environment
+    variables (case insensitive), e.g. `country_name`, `area_name`, `bbox`,
+    `centre` and, optionally, `bbox_crs`, `centre_crs`,
+    `buffer_estimation_crs`, `gtfs_osm_subdir`, etc. A toml manifest has one
+    `[[area]]` table per area. A csv manifest has one row per area, with the
+    names as column headers (empty cells are ignored).
+
+    Parameters
+    ----------
+    manifest_file : str
+        Path to the manifest, with a .toml or .csv extension.
+
+    Returns
+    -------
+    list
+        One dictionary per area, keyed by (upper case) environment variable
+        name with string values.
+
+    Raises
+    ------
+    ValueError
+        When the manifest has an unsupported extension, has no areas, or an
+        area is missing a required value.
+
+    """
+    if manifest_file.endswith(".toml"):
+        raw_areas = toml.load(manifest_file).get("area", [])
+    elif manifest_file.endswith(".csv"):
+        with open(manifest_file, newline="") as f:
+            raw_areas = list(csv.DictReader(f))
+    else:
+        raise ValueError(
+            f"Unsupported manifest type: {manifest_file}. Expected a .toml or "
+            ".csv file."
+        )
+    if len(raw_areas) == 0:
+        raise ValueError(f"No areas found in manifest: {manifest_file}")
+
+    areas = []
+    for raw_area in raw_areas:
+        area = {}
+        for key, value in raw_area.items():
+            if value is None or value == "":
+                continue
+            if isinstance(value, list):
+                value = ",".join(str(v) for v in value)
+            elif isinstance(value, bool):
+                value = int(value)
+            area[key.strip().upper()] = str(value)
+        for var_name in ["COUNTRY_NAME", "AREA_NAME", "BBOX", "CENTRE"]:
+            env_var_none_defence(area.get(var_name), var_name)
+        areas.append(area)
+
+    return areas
+
+
+def gtfs_stops_view(gtfs, stops_only: bool = False):
+    """Build a view of a `MultiGtfsInstance` for plotting stops.
+
+    The view is a shallow copy that shares every GTFS table with `gtfs`
+    (including `stop_times`), except for `stops`, which is only copied when a
+    dummy `stop_code` column (duplicating `stop_id`) has to be added. Changes
+    to the view's `stops` do not affect `gtfs`, and memory use does not scale
+    with the size of the other GTFS tables.
+
+    Parameters
+    ----------
+    gtfs : MultiGtfsInstance
+        The GTFS instances to build a view of.
+    stops_only : bool, optional
+        Whether the view's feeds only keep `stops` and the unique `stop_id`
+        values of `stop_times` used by `viz_stops` (the other tables are set
+        to None), by default False. Used to send small views between
+        processes (see `gtfs_feeds.combine_stops_views()`).
+
+    Returns
+    -------
+    MultiGtfsInstance
+        Stops-only view of `gtfs`.
+
+    """
+    view = copy.copy(gtfs)
+    view.instances = []
+    for inst in gtfs.instances:
+        inst_view = copy.copy(inst)
+        inst_view.feed = copy.copy(inst.feed)
+        stops = inst.feed.stops
+        if "stop_code" not in stops.columns:
+            inst_view.feed.stops = stops.assign(stop_code=stops["stop_id"])
+        if stops_only:
+            # so the view does not grow with the size of `stop_times`
+            inst_view.feed.stop_times = (
+                inst.feed.stop_times[["stop_id"]]
+                .drop_duplicates()
+                .reset_index(drop=True)
+            )
+            for table in GTFS_TABLES:
+                if table not in ["stops", "stop_times"] and hasattr(
+                    inst_view.feed, table
+                ):
+                    setattr(inst_view.feed, table, None)
+        view.instances.append(inst_view)
+    return view
@@ -0,0 +1,840 @@
+"""File-based work queue, to spread analyses across hosts sharing `data/`.
+
+Work items (whole areas, or OD matrix shards of one area) are JSON files
+moving between the `pending/`, `claimed/`, `done/` and `failed/`
+directories of a queue directory on the shared volume. Items are claimed by
+atomically linking a record holding the claim's token into `claimed/`
+(which fails when the item is already claimed), so exactly one worker gets
+each.
+The claiming worker touches the claimed file every `HEARTBEAT_S` seconds,
+and any worker moves claimed items without a heartbeat for `STALE_S`
+seconds back to `pending/`, so the items of a dead worker are re-run. Each
+claim records a token, so a worker whose item was re-queued (and possibly
+claimed by another worker) drops its result rather than finishing the item.
+
+Usage (from the repo root, or within the docker image)::
+
+    python src/work_queue.py publish --queue data/queue/national \\
+        --manifest england_manifest.toml
+    python src/work_queue.py work --queue data/queue/national --processes 2
+    python src/work_queue.py status --queue data/queue/national
+    python src/work_queue.py selftest --processes 4
+
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import toml
+import uuid
+
+from typing import Callable
+
+from preflight import preflight
+from run import AREA_DEFAULTS, CONFIG_PREFIX, LOGGER_NAME
+from utils import read_area_manifest, setup_logger
+
+QUEUE_STATES = ["pending", "claimed", "done", "failed"]
+# seconds between heartbeats of a claimed item
+HEARTBEAT_S = 30
+# seconds without a heartbeat after which a claimed item is re-queued
+STALE_S = 300
+# seconds between checks of an empty queue
+POLL_S = 5
+# claims of an item (e.g. re-queued after killing its workers) after which
+# it is failed
+MAX_ATTEMPTS = 3
+
+
+class FileQueue:
+    """Work queue held in a (shared) directory.
+
+    Only atomic renames and (hard) links within the queue directory are used
+    to move items between states, so the queue is safe to share between
+    processes on several hosts (e.g. over NFS), without a broker.
+
+    Parameters
+    ----------
+    root : str
+        Queue directory, created when needed.
+
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        for name in QUEUE_STATES + ["claims", "payloads", "tmp"]:
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+        self._clock = os.path.join(
+            root, "tmp", f".clock-{socket.gethostname()}-{os.getpid()}"
+        )
+
+    def _path(self, state: str, item_id: str) -> str:
+        return os.path.join(self.root, state, f"{item_id}.json")
+
+    def _write(self, path: str, record: dict) -> None:
+        """Atomically write a JSON record."""
+        tmp_path = os.path.join(
+            self.root, "tmp", f"{os.path.basename(path)}.{uuid.uuid4().hex}"
+        )
+        with open(tmp_path, "w") as f:
+            json.dump(record, f, indent=2, default=str)
+        os.replace(tmp_path, path)
+
+    def _read(self, path: str) -> dict:
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _timestamp(self) -> str:
+        """Get the current file system time (see `now()`), as ISO 8601."""
+        return datetime.datetime.fromtimestamp(self.now()).isoformat()
+
+    def now(self) -> float:
+        """Get the current time of the queue's file system.
+
+        Heartbeats are file modification times, so staleness is judged
+        against the file system clock rather than the (possibly skewed)
+        clock of this host.
+        """
+        with open(self._clock, "a"):
+            os.utime(self._clock)
+        return os.stat(self._clock).st_mtime
+
+    def ids(self, state: str, prefix: str = "") -> list:
+        """List the ids of the items in a state, in publication order."""
+        return sorted(
+            name[: -len(".json")]
+            for name in os.listdir(os.path.join(self.root, state))
+            if name.endswith(".json") and name.startswith(prefix)
+        )
+
+    def counts(self, prefix: str = "") -> dict:
+        """Count the items in each state."""
+        return {state: len(self.ids(state, prefix)) for state in QUEUE_STATES}
+
+    def get(self, item_id: str) -> tuple:
+        """Get the (state, record) of an item, or (None, None)."""
+        for state in QUEUE_STATES:
+            try:
+                return state, self._read(self._path(state, item_id))
+            except FileNotFoundError:
+                continue
+        return None, None
+
+    def publish(self, item: dict, item_id: str = None) -> str:
+        """Add an item to the queue.
+
+        Parameters
+        ----------
+        item : dict
+            Item values, with a "kind" (see `HANDLERS`). Must be JSON
+            serialisable.
+        item_id : str, optional
+            Item id, by default None meaning a new timestamped id. Items
+            already pending or claimed are left as they are, and earlier
+            done or failed records of the id are replaced.
+
+        Returns
+        -------
+        str
+            The item id.
+
+        """
+        if item_id is None:
+            timestamp = datetime.datetime.fromtimestamp(self.now()).strftime(
+                "%Y%m%d%H%M%S"
+            )
+            item_id = f"{timestamp}-{uuid.uuid4().hex[:8]}"
+        if any(
+            os.path.exists(self._path(state, item_id))
+            for state in ["pending", "claimed"]
+        ):
+            return item_id
+        # a re-published item starts again from its first attempt
+        for path in [
+            self._path("done", item_id),
+            self._path("failed", item_id),
+            os.path.join(self.root, "claims", f"{item_id}.log"),
+        ]:
+            if os.path.exists(path):
+                os.remove(path)
+        self._write(
+            self._path("pending", item_id),
+            {
+                **item,
+                "id": item_id,
+                "published_at": self._timestamp(),
+            },
+        )
+        return item_id
+
+    def write_payload(self, name: str, payload) -> str:
+        """Pickle an item payload too large (or not JSON) for the item."""
+        path = os.path.join(self.root, "payloads", f"{name}.pkl")
+        tmp_path = os.path.join(self.root, "tmp", f"{name}.{uuid.uuid4().hex}")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(payload, f)
+        os.replace(tmp_path, path)
+        return path
+
+    def claim(
+        self,
+        worker_id: str,
+        prefix: str = "",
+        max_attempts: int = MAX_ATTEMPTS,
+    ) -> dict:
+        """Claim the oldest pending item.
+
+        Parameters
+        ----------
+        worker_id : str
+            Id of the claiming worker, recorded in the claim token and
+            `claims/<item id>.log`.
+        prefix : str, optional
+            Only claim items whose id starts with this, by default "".
+        max_attempts : int, optional
+            Items claimed more than this many times are failed rather than
+            returned, by default `MAX_ATTEMPTS`.
+
+        Returns
+        -------
+        dict
+            The claimed item, with its "attempt" number and "claim" token
+            (see `heartbeat()` and `complete()`), or None when there is no
+            pending item.
+
+        """
+        for item_id in self.ids("pending", prefix):
+            path = self._path("claimed", item_id)
+            try:
+                record = self._read(self._path("pending", item_id))
+            except FileNotFoundError:
+                # claimed by another worker
+                continue
+            # re-queued items keep the attempt number of their last claim
+            attempt = record.get("attempt", 0) + 1
+            record.update(
+                attempt=attempt,
+                claim=f"{worker_id}:{attempt}:{uuid.uuid4().hex[:8]}",
+                worker_id=worker_id,
+                claimed_at=self._timestamp(),
+            )
+            # the claim is a (hard) link of a record already holding the
+            # token, which fails when the item is claimed, so a claimed item
+            # always has its token (and a fresh heartbeat)
+            tmp_path = os.path.join(
+                self.root, "tmp", f"{item_id}.{uuid.uuid4().hex}.claim"
+            )
+            with open(tmp_path, "w") as f:
+                json.dump(record, f, indent=2, default=str)
+            try:
+                os.link(tmp_path, path)
+            except FileExistsError:
+                # claimed by another worker
+                continue
+            finally:
+                os.remove(tmp_path)
+            try:
+                os.remove(self._path("pending", item_id))
+            except FileNotFoundError:
+                # claimed (and finished) by another worker since the item
+                # was read: drop this claim, which no other worker holds
+                os.remove(path)
+                continue
+            claims_path = os.path.join(self.root, "claims", f"{item_id}.log")
+            with open(claims_path, "a") as f:
+                f.write(f"{record['claimed_at']}\t{worker_id}\n")
+            if attempt > max_attempts:
+                self.fail(
+                    item_id,
+                    record["claim"],
+                    f"Claimed {attempt} times without completing.",
+                )
+                continue
+            return record
+        return None
+
+    def owns(self, item_id: str, claim: str) -> bool:
+        """Check whether an item is still claimed with the `claim` token."""
+        try:
+            return self._read(self._path("claimed", item_id))["claim"] == claim
+        except (FileNotFoundError, KeyError, ValueError):
+            return False
+
+    def heartbeat(self, item_id: str, claim: str) -> bool:
+        """Refresh the heartbeat of a claimed item.
+
+        Returns False when the item is no longer claimed with the `claim`
+        token (e.g. it was re-queued as stale, and possibly claimed by
+        another worker).
+        """
+        if not self.owns(item_id, claim):
+            return False
+        try:
+            os.utime(self._path("claimed", item_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, item_id: str, claim: str, result=None) -> bool:
+        """Move a claimed item to `done/`, recording its result.
+
+        Returns False, leaving the item as it is, when the item is no longer
+        claimed with the `claim` token.
+        """
+        return self._finish("done", item_id, claim, result=result)
+
+    def fail(self, item_id: str, claim: str, error: str) -> bool:
+        """Move a claimed item to `failed/`, recording its error.
+
+        Returns False, leaving the item as it is, when the item is no longer
+        claimed with the `claim` token.
+        """
+        return self._finish("failed", item_id, claim, error=error)
+
+    def _finish(self, state: str, item_id: str, claim: str, **values) -> bool:
+        path = self._path("claimed", item_id)
+        if not self.owns(item_id, claim):
+            return False
+        # move the claim aside first, so it cannot be re-queued (or finished
+        # by another worker) between the token check and the removal
+        finishing = os.path.join(
+            self.root, "tmp", f"{item_id}.{uuid.uuid4().hex}.finishing"
+        )
+        try:
+            os.rename(path, finishing)
+        except FileNotFoundError:
+            return False
+        record = self._read(finishing)
+        if record.get("claim") != claim:
+            # re-queued and claimed by another worker since the check: put
+            # its claim back
+            os.rename(finishing, path)
+            return False
+        self._write(
+            self._path(state, item_id),
+            {**record, **values, "finished_at": self._timestamp()},
+        )
+        os.remove(finishing)
+        return True
+
+    def requeue_stale(self, stale_s: float = STALE_S) -> list:
+        """Move claimed items without a recent heartbeat back to pending.
+
+        Returns
+        -------
+        list
+            Ids of the re-queued items.
+
+        """
+        now = self.now()
+        requeued = []
+        for item_id in self.ids("claimed"):
+            path = self._path("claimed", item_id)
+            try:
+                if now - os.stat(path).st_mtime <= stale_s:
+                    continue
+                os.rename(path, self._path("pending", item_id))
+                requeued.append(item_id)
+            except FileNotFoundError:
+                # finished, or re-queued by another worker
+                continue
+        return requeued
+
+
+def _heartbeat(
+    queue: FileQueue,
+    item: dict,
+    interval: float,
+    stop: threading.Event,
+    lost: threading.Event,
+    logger=None,
+) -> None:
+    """Refresh an item's heartbeat until stopped, or its claim is lost."""
+    while not stop.wait(interval):
+        if not queue.heartbeat(item["id"], item["claim"]):
+            if logger is not None:
+                logger.warning(
+                    f"Lost the claim of item {item['id']} (re-queued as "
+                    "stale), its result will be dropped"
+                )
+            lost.set()
+            return
+
+
+def run_worker(
+    queue: FileQueue,
+    handlers: dict = None,
+    worker_id: str = None,
+    prefix: str = "",
+    heartbeat_s: float = HEARTBEAT_S,
+    stale_s: float = STALE_S,
+    poll_s: float = POLL_S,
+    exit_when_empty: bool = True,
+    logger=None,
+) -> int:
+    """Claim and run queued items until the queue is empty.
+
+    Parameters
+    ----------
+    queue : FileQueue
+        Queue to work on.
+    handlers : dict, optional
+        Functions running each item kind, called as `handler(item, logger)`
+        and returning a JSON serialisable result, by default `HANDLERS`.
+    worker_id : str, optional
+        Id of this worker, by default None meaning "<host>-<pid>".
+    prefix : str, optional
+        Only claim items whose id starts with this, by default "".
+    heartbeat_s : float, optional
+        Seconds between heartbeats of the running item, by default
+        `HEARTBEAT_S`.
+    stale_s : float, optional
+        Seconds without a heartbeat after which claimed items are re-queued,
+        by default `STALE_S`.
+    poll_s : float, optional
+        Seconds between checks of the queue while other workers' items are
+        running, by default `POLL_S`.
+    exit_when_empty : bool, optional
+        Whether to return once no item is pending or claimed, by default
+        True. Otherwise the queue is polled until interrupted.
+    logger : logging.Logger, optional
+        Logger instance, by default None.
+
+    Returns
+    -------
+    int
+        Number of items run by this worker.
+
+    """
+    handlers = handlers or HANDLERS
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    n_items = 0
+    while True:
+        for item_id in queue.requeue_stale(stale_s):
+            if logger is not None:
+                logger.warning(f"Re-queued stale item: {item_id}")
+        item = queue.claim(worker_id, prefix)
+        if item is None:
+            counts = queue.counts(prefix)
+            if exit_when_empty and counts["pending"] + counts["claimed"] == 0:
+                return n_items
+            time.sleep(poll_s)
+            continue
+
+        if logger is not None:
+            logger.info(
+                f"{worker_id} running {item['kind']} item {item['id']} "
+                f"(attempt {item['attempt']})..."
+            )
+        stop = threading.Event()
+        lost = threading.Event()
+        beat = threading.Thread(
+            target=_heartbeat,
+            args=(queue, item, heartbeat_s, stop, lost, logger),
+            daemon=True,
+        )
+        beat.start()
+        try:
+            result = handlers[item["kind"]](item, logger)
+            finish, values = queue.complete, {"result": result}
+        except Exception as error:
+            if logger is not None:
+                logger.exception(f"{worker_id} failed item {item['id']}")
+            finish = queue.fail
+            values = {"error": f"{type(error).__name__}: {error}"}
+        finally:
+            # stopped first, so the item's removal is not seen as a lost claim
+            stop.set()
+            beat.join()
+        if not lost.is_set() and finish(item["id"], item["claim"], **values):
+            if logger is not None:
+                logger.info(f"{worker_id} finished item {item['id']}")
+        elif logger is not None:
+            logger.warning(
+                f"{worker_id} dropped the result of item {item['id']}, as "
+                "its claim was lost"
+            )
+        n_items += 1
+
+
+def distribute(
+    queue: FileQueue,
+    group: str,
+    kind: str,
+    items: dict,
+    handler: Callable,
+    payload=None,
+    logger=None,
+) -> None:
+    """Publish a group of items, and work on them until all are finished.
+
+    Used by a running analysis to share its work (e.g. OD shards) with the
+    workers of `queue`, while also working on it itself.
+
+    Parameters
+    ----------
+    queue : FileQueue
+        Queue to publish to.
+    group : str
+        Group name, prefixing the item ids.
+    kind : str
+        Kind of the items.
+    items : dict
+        Values of each item, keyed by item name (unique within the group).
+    handler : Callable
+        Function running an item in this process, called as
+        `handler(item, logger)`.
+    payload : optional
+        Values shared by the items, pickled to the queue directory and
+        referenced by each item's "payload" path, by default None.
+    logger : logging.Logger, optional
+        Logger instance, by default None.
+
+    Raises
+    ------
+    RuntimeError
+        When any item of the group failed.
+
+    """
+    shared = {}
+    if payload is not None:
+        shared["payload"] = queue.write_payload(group, payload)
+    for name, values in items.items():
+        queue.publish({"kind": kind, **shared, **values}, f"{group}-{name}")
+    if logger is not None:
+        logger.info(
+            f"Published {len(items)} {kind} items to {queue.root} ({group})"
+        )
+    run_worker(queue, {kind: handler}, prefix=f"{group}-", logger=logger)
+    failed = queue.ids("failed", f"{group}-")
+    if len(failed) > 0:
+        raise RuntimeError(f"{len(failed)} work item(s) failed: {failed}")
+
+
+def _run_area(item: dict, logger) -> dict:
+    """Run an "area" item: a whole area analysis (see `run.run_area()`)."""
+    from run import run_area
+
+    dirs = run_area(item["config_file"], {**os.environ, **item["env"]})
+    return {"files_dir": dirs["files_dir"]}
+
+
+def _run_od_shard(item: dict, logger) -> dict:
+    """Run an "od_shard" item: one shard of an area's OD matrix.
+
+    The payload (see `stages._od_matrix_sharded()`) holds the network inputs
+    and the `od_shards.compute_od_shards()` arguments. The network is read
+    from the shared network cache when possible, and kept in memory for the
+    next shard of the same area.
+    """
+    from r5py import TransportMode
+
+    from networks import cached_network, set_memo_size
+    from od_shards import compute_od_shards
+
+    with open(item["payload"], "rb") as f:
+        payload = pickle.load(f)
+    set_memo_size(1)
+    network = cached_network(
+        payload.pop("osm_path"),
+        payload.pop("gtfs_dir"),
+        cache_dir=payload.pop("cache_dir"),
+        network_cache_gb=payload.pop("network_cache_gb"),
+        logger=logger,
+    )
+    payload["transport_modes"] = [
+        TransportMode[mode] for mode in payload["transport_modes"]
+    ]
+    compute_od_shards(network, only=[item["shard"]], logger=logger, **payload)
+    return {"shard": item["shard"]}
+
+
+def _run_sleep(item: dict, logger) -> dict:
+    """Run a "sleep" item, used by `selftest()`.
+
+    Sleeps for the item's "seconds", then records the run in the item's
+    "runs_log", so double runs can be counted.
+    """
+    time.sleep(item["seconds"])
+    with open(item["runs_log"], "a") as f:
+        f.write(f"{item['id']}\t{item['claim']}\n")
+    return {"claim": item["claim"]}
+
+
+# functions running each item kind (see `run_worker()`)
+HANDLERS = {
+    "area": _run_area,
+    "od_shard": _run_od_shard,
+    "sleep": _run_sleep,
+}
+
+
+def publish_areas(
+    queue: FileQueue, config_file: str, manifest_file: str, logger=None
+) -> list:
+    """Publish an "area" item per area of a manifest.
+
+    All areas are checked first (see `preflight.preflight()`), so no area is
+    published when any would fail.
+
+    Raises
+    ------
+    ValueError
+        When any area fails the preflight checks.
+
+    """
+    config = toml.load(os.path.join(CONFIG_PREFIX, config_file))
+    areas = read_area_manifest(os.path.join(CONFIG_PREFIX, manifest_file))
+    problems = []
+    for area in areas:
+        problems += [
+            f"{area.get('AREA_NAME')}: {problem}"
+            for problem in preflight(
+                config, {**AREA_DEFAULTS, **os.environ, **area}
+            )
+        ]
+    if len(problems) > 0:
+        raise ValueError(
+            "Preflight checks failed:\n"
+            + "\n".join(f"- {problem}" for problem in problems)
+        )
+
+    item_ids = []
+    for area in areas:
+        name = area["AREA_NAME"].replace(" ", "_").replace("-", "_")
+        item_ids.append(
+            queue.publish(
+                {"kind": "area", "config_file": config_file, "env": area},
+                f"area-{name}",
+            )
+        )
+    if logger is not None:
+        logger.info(f"Published {len(item_ids)} areas to {queue.root}")
+    return item_ids
+
+
+def _worker_process(root: str, worker_id: str, kwargs: dict) -> int:
+    logger = setup_logger(f"{LOGGER_NAME}-worker-{worker_id}")
+    return run_worker(
+        FileQueue(root), worker_id=worker_id, logger=logger, **kwargs
+    )
+
+
+def _start_workers(root: str, worker_id: str, n: int, kwargs: dict) -> list:
+    """Start `n` local worker processes (see `_worker_process()`)."""
+    mp_context = multiprocessing.get_context("spawn")
+    processes = [
+        mp_context.Process(
+            target=_worker_process,
+            args=(root, f"{worker_id}-{i}", kwargs),
+        )
+        for i in range(n)
+    ]
+    for process in processes:
+        process.start()
+    return processes
+
+
+def selftest(
+    root: str = None,
+    processes: int = 4,
+    n_items: int = 40,
+    seconds: float = 0.5,
+    kill: bool = True,
+    logger=None,
+) -> bool:
+    """Check the queue with several local worker processes.
+
+    Publishes `n_items` "sleep" items to a queue and runs them with
+    `processes` workers (with short heartbeats). One worker is killed while
+    it runs an item, so the item must be re-queued as stale and run by
+    another worker. Claimed items are sampled throughout, and must always
+    hold the token of their claim.
+
+    Parameters
+    ----------
+    root : str, optional
+        Queue directory, by default None meaning a new temporary directory
+        (removed afterwards). Use a directory on a shared volume, with
+        workers started on other hosts, to check the queue across hosts.
+    processes : int, optional
+        Number of local worker processes, by default 4.
+    n_items : int, optional
+        Number of items, by default 40.
+    seconds : float, optional
+        Run time of each item, by default 0.5.
+    kill : bool, optional
+        Whether to kill a worker, by default True.
+    logger : logging.Logger, optional
+        Logger instance, by default None.
+
+    Returns
+    -------
+    bool
+        Whether every item was completed exactly once, no claimed item was
+        seen without its token (and, when a worker was killed, its item was
+        re-run).
+
+    """
+    temporary = root is None
+    root = root or tempfile.mkdtemp(prefix="tp-queue-")
+    queue = FileQueue(root)
+    runs_log = os.path.join(root, "runs.log")
+    group = f"selftest-{uuid.uuid4().hex[:8]}"
+    for i in range(n_items):
+        queue.publish(
+            {"kind": "sleep", "seconds": seconds, "runs_log": runs_log},
+            f"{group}-{i:05d}",
+        )
+    kwargs = {
+        "prefix": f"{group}-",
+        "heartbeat_s": max(seconds / 5, 0.05),
+        "stale_s": 4 * seconds,
+        "poll_s": seconds / 2,
+    }
+    workers = _start_workers(root, "selftest", processes, kwargs)
+
+    killed = None
+    untokened = set()
+    while any(worker.is_alive() for worker in workers):
+        for item_id in queue.ids("claimed", group):
+            try:
+                record = queue._read(queue._path("claimed", item_id))
+            except FileNotFoundError:
+                continue
+            # the token of this claim, rather than one of an earlier claim
+            if record.get("claim", "").split(":")[:2] != [
+                record.get("worker_id"),
+                str(record.get("attempt")),
+            ]:
+                untokened.add(item_id)
+            # kill the first worker once it is running an item
+            if (
+                kill
+                and killed is None
+                and record.get("worker_id") == "selftest-0"
+            ):
+                os.kill(workers[0].pid, signal.SIGKILL)
+                killed = item_id
+                if logger is not None:
+                    logger.info(f"Killed worker selftest-0 running {item_id}")
+        time.sleep(0.01)
+    for worker in workers:
+        worker.join()
+
+    with open(runs_log, "r") as f:
+        runs = [line.split("\t")[0] for line in f.read().splitlines()]
+    counts = queue.counts(group)
+    ok = (
+        counts["done"] == n_items
+        and counts["failed"] == 0
+        and sorted(runs) == queue.ids("done", group)
+        and len(untokened) == 0
+    )
+    if kill:
+        # the killed item must have been claimed again
+        _, record = queue.get(killed) if killed else (None, None)
+        ok &= record is not None and record["attempt"] > 1
+    if logger is not None:
+        log = logger.info if ok else logger.error
+        log(
+            f"Queue selftest {'passed' if ok else 'failed'}: {counts}, "
+            f"{len(runs)} completed runs of {len(set(runs))} items, "
+            f"{len(untokened)} claimed items seen without their token"
+        )
+    if temporary:
+        shutil.rmtree(root)
+    return ok
+
+
+def main(argv: list = None) -> None:
+    """Publish to, work on, or report the status of a work queue."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    publish = subparsers.add_parser("publish", help="publish areas")
+    work = subparsers.add_parser("work", help="run a worker")
+    status = subparsers.add_parser("status", help="count items per state")
+    test = subparsers.add_parser(
+        "selftest", help="check the queue with local worker processes"
+    )
+    for subparser in [publish, work, status]:
+        subparser.add_argument("--queue", required=True, help="queue dir")
+    test.add_argument(
+        "--queue", default=None, help="queue dir, by default a temporary dir"
+    )
+    test.add_argument("--processes", type=int, default=4)
+    test.add_argument("--items", type=int, default=40)
+    test.add_argument("--seconds", type=float, default=0.5)
+    test.add_argument(
+        "--no-kill", action="store_true", help="do not kill a worker"
+    )
+    publish.add_argument(
+        "--manifest", required=True, help="area manifest, in the config dir"
+    )
+    publish.add_argument(
+        "--config", default=os.getenv("CONFIG_FILE", "default_config.toml")
+    )
+    work.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="number of local worker processes",
+    )
+    work.add_argument("--worker-id", default=None)
+    work.add_argument("--heartbeat", type=float, default=HEARTBEAT_S)
+    work.add_argument("--stale", type=float, default=STALE_S)
+    work.add_argument("--poll", type=float, default=POLL_S)
+    work.add_argument(
+        "--wait",
+        action="store_true",
+        help="keep polling once the queue is empty",
+    )
+    args = parser.parse_args(argv)
+
+    logger = setup_logger(f"{LOGGER_NAME}-queue")
+    if args.command == "selftest":
+        ok = selftest(
+            args.queue,
+            args.processes,
+            args.items,
+            args.seconds,
+            not args.no_kill,
+            logger,
+        )
+        raise SystemExit(0 if ok else 1)
+    queue = FileQueue(args.queue)
+    if args.command == "publish":
+        publish_areas(queue, args.config, args.manifest, logger)
+        return
+    if args.command == "status":
+        logger.info(f"{args.queue}: {queue.counts()}")
+        return
+
+    worker_id = args.worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    kwargs = {
+        "heartbeat_s": args.heartbeat,
+        "stale_s": args.stale,
+        "poll_s": args.poll,
+        "exit_when_empty": not args.wait,
+    }
+    if args.processes <= 1:
+        _worker_process(args.queue, worker_id, kwargs)
+    else:
+        for process in _start_workers(
+            args.queue, worker_id, args.processes, kwargs
+        ):
+            process.join()
+    logger.info(f"{args.queue}: {queue.counts()}")
+
+
+if __name__ == "__main__":
+    main()